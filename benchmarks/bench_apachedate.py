@@ -0,0 +1,51 @@
+"""
+Compares `vaineye.apachelog.parse_apache_date` with the
+``strptime``/``mktime`` parsing it replaced, on a sample of dates
+like a busy log's (a few dozen lines each second).
+
+Run with ``python benchmarks/bench_apachedate.py [LINES]``
+"""
+import sys
+import time
+import timeit
+from datetime import datetime, timedelta
+from vaineye import apachelog
+
+def old_parse(value):
+    """The old parsing (zone offset bug included)"""
+    date = datetime.fromtimestamp(
+        time.mktime(time.strptime(value.split(None, 1)[0],
+                                  apachelog.apache_date_format)))
+    return date + timedelta(hours=int(value.split(None, 1)[1]))
+
+def make_sample(count, per_second=40):
+    start = datetime(2010, 3, 27, 22, 0, 0)
+    dates = []
+    for i in xrange(count):
+        date = start + timedelta(seconds=i // per_second)
+        dates.append(date.strftime(apachelog.apache_date_format) + ' +0100')
+    return dates
+
+def main(count=1000000):
+    dates = make_sample(count)
+    def run_old():
+        for value in dates:
+            old_parse(value)
+    def run_new():
+        parse = apachelog.parse_apache_date
+        for value in dates:
+            parse(value)
+    results = []
+    for name, func in [('strptime/mktime', run_old),
+                       ('parse_apache_date', run_new)]:
+        best = min(timeit.repeat(func, number=1, repeat=3))
+        results.append((name, best))
+        print '%-20s %6.3f sec (%.2f usec/line)' % (
+            name, best, best / count * 1e6)
+    print 'speedup: %.1fx' % (results[0][1] / results[1][1])
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,50 @@
+"""
+Compares `vaineye.ziptostate.zip_to_state` with the chain of range
+comparisons it replaced (which is rebuilt here from the same table).
+
+Run with ``python benchmarks/bench_ziptostate.py``
+"""
+import random
+import timeit
+from vaineye import ziptostate
+
+def make_chain():
+    """Builds the old ``if``/``elif`` implementation from
+    `ziptostate.zip_ranges`"""
+    lines = ['def zip_to_state(zip):']
+    keyword = 'if'
+    for low, high, state in ziptostate.zip_ranges:
+        lines.append('    %s zip >= %d and zip <= %d:' % (keyword, low, high))
+        lines.append('        return %r' % state)
+        keyword = 'elif'
+    lines.append('    return None')
+    namespace = {}
+    exec '\n'.join(lines) in namespace
+    return namespace['zip_to_state']
+
+def main(count=200000):
+    chain = make_chain()
+    rand = random.Random(0)
+    zips = [rand.randint(0, 99999) for i in xrange(count)]
+    for zip in zips[:1000]:
+        assert chain(zip) == ziptostate.zip_to_state(zip), zip
+    def run_chain():
+        for zip in zips:
+            chain(zip)
+    def run_bisect():
+        lookup = ziptostate.zip_to_state
+        for zip in zips:
+            lookup(zip)
+    def run_many():
+        ziptostate.zip_to_state_many(zips)
+    results = []
+    for name, func in [('if/elif chain', run_chain),
+                       ('bisect', run_bisect),
+                       ('zip_to_state_many', run_many)]:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        results.append((name, best))
+        print '%-20s %6.3f usec/lookup' % (name, best / count * 1e6)
+    print 'bisect speedup: %.1fx' % (results[0][1] / results[1][1])
+
+if __name__ == '__main__':
+    main()
@@ -46,6 +46,10 @@ setup(name='VaingloriousEye',
       entry_points="""
       [console_scripts]
       import-vaineye = vaineye.importer:main
+      vaineye-collector = vaineye.collector:main
+      vaineye-ingest = vaineye.ingest:main
+      vaineye-indexes = vaineye.indexes:main
+      vaineye-compact = vaineye.compact:main
       
       [paste.filter_app_factory]
       main = vaineye.statuswatch:make_status_watcher
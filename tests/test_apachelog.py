@@ -0,0 +1,61 @@
+import os
+import calendar
+import tempfile
+from datetime import datetime
+from vaineye.apachelog import parse_lines, parse_range, split_file
+from vaineye.apachelog import parse_apache_date
+from vaineye.apachelog import unpack_requests
+
+line = ('1.2.3.4 - - [02/Jan/2010:03:04:05 +0000] "GET /%s?a=b HTTP/1.1" '
+        '200 512 "http://example.com/" "Mozilla/5.0"\n')
+
+def test_parse_lines():
+    packed, count, errors = parse_lines(
+        [line % 'one', 'junk\n', line % 'two.css'], 'https', 'example.com')
+    assert count == 2
+    assert len(errors) == 1 and 'junk' in errors[0]
+    requests = unpack_requests(packed)
+    assert [r.path for r in requests] == ['/one', '/two.css']
+    assert requests[0].scheme == 'https'
+    assert requests[0].host == 'example.com'
+    assert requests[0].query_string == 'a=b'
+    assert requests[0].response_bytes == 512
+    assert requests[1].content_type == 'text/css'
+
+def test_split_file():
+    fd, filename = tempfile.mkstemp()
+    try:
+        f = os.fdopen(fd, 'wb')
+        for i in range(100):
+            f.write(line % i)
+        f.close()
+        ranges = split_file(filename, chunk_size=1000)
+        assert len(ranges) > 1
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == os.path.getsize(filename)
+        paths = []
+        for start, end in ranges:
+            packed, count, errors = parse_range(filename, start, end)
+            assert not errors
+            paths.extend(r.path for r in unpack_requests(packed))
+        assert paths == ['/%s' % i for i in range(100)]
+    finally:
+        os.unlink(filename)
+
+def test_parse_apache_date():
+    date = parse_apache_date('02/Jan/2010:03:04:05 +0100')
+    assert date == datetime.fromtimestamp(
+        calendar.timegm((2010, 1, 2, 2, 4, 5, 0, 0, 0)))
+    # Cached:
+    assert parse_apache_date('02/Jan/2010:03:04:05 +0100') is date
+    assert date == parse_apache_date('01/Jan/2010:21:34:05 -0430')
+    assert parse_apache_date('02/Jan/2010:03:04:05') == datetime(
+        2010, 1, 2, 3, 4, 5)
+    for bad in ['02/Foo/2010:03:04:05 +0100', '02/Jan/2010 03:04:05',
+                '02/Jan/2010:03:04:05 0100', '']:
+        try:
+            parse_apache_date(bad)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Parsed %r' % bad
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from sqlalchemy import create_engine, MetaData, Table, Column
+from sqlalchemy import Integer, String, DateTime, select, func
+from vaineye.bulkload import make_writer, BulkWriteError, _copy_value
+
+def make_table():
+    engine = create_engine('sqlite://')
+    metadata = MetaData()
+    table = Table('things', metadata,
+                  Column('id', Integer, primary_key=True),
+                  Column('name', String(10)),
+                  Column('date', DateTime))
+    return engine, metadata, table
+
+def test_writers():
+    for name in ['executemany', 'values']:
+        engine, metadata, table = make_table()
+        writer = make_writer(engine, table, ['name', 'date'], name=name,
+                             chunk_size=300)
+        metadata.create_all(engine)
+        conn = engine.connect()
+        date = datetime(2010, 1, 2, 3, 4, 5)
+        writer.write(conn, [(u'x%s' % i, date) for i in range(1000)])
+        rows = list(conn.execute(select([table.c.name, table.c.date])))
+        assert len(rows) == 1000, (name, len(rows))
+        assert rows[999] == (u'x999', date)
+        # Stored the way SQLAlchemy compares them:
+        matching = select([func.count()]).where(table.c.date == date)
+        assert conn.execute(matching).scalar() == 1000, name
+        assert writer.rows_written == 1000
+        assert writer.rate() > 0
+
+def test_configured_once():
+    dir = tempfile.mkdtemp()
+    try:
+        engine = create_engine('sqlite:///%s' % os.path.join(dir, 'r.db'))
+        table = make_table()[2]
+        make_writer(engine, table, ['name'], name='values')
+        pool = engine.pool
+        # Another writer (for another partition) changes nothing:
+        make_writer(engine, table, ['name'], name='values')
+        assert engine.pool is pool
+        assert len(list(engine.pool.dispatch.connect)) == 1
+        assert engine.execute('PRAGMA journal_mode').scalar() == 'wal'
+    finally:
+        shutil.rmtree(dir)
+
+def test_failed_chunk():
+    engine, metadata, table = make_table()
+    writer = make_writer(engine, table, ['id', 'name'], chunk_size=10)
+    metadata.create_all(engine)
+    conn = engine.connect()
+    rows = [(i, u'x') for i in range(25)]
+    rows[15] = (3, u'x')
+    try:
+        writer.write(conn, rows)
+    except BulkWriteError, e:
+        assert e.written == 10
+        assert 'rows 10-19 (of 25) into things' in str(e)
+    else:
+        assert 0
+    assert len(list(conn.execute(select([table.c.id])))) == 10
+    try:
+        writer.write(conn, [(100, u'x'), (1, u'x')], atomic=True)
+    except BulkWriteError, e:
+        assert e.written == 0
+    else:
+        assert 0
+    assert len(list(conn.execute(select([table.c.id])))) == 10
+
+def test_copy_value():
+    assert _copy_value(None) == '\\N'
+    assert _copy_value(u'a\tb\\c\n') == 'a\\tb\\\\c\\n'
+    assert _copy_value(u'\xe9') == '\xc3\xa9'
+    assert _copy_value(datetime(2010, 1, 2, 3, 4, 5)) == '2010-01-02T03:04:05'
+    assert _copy_value(3) == '3'
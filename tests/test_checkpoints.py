@@ -0,0 +1,47 @@
+import gzip
+import os
+import shutil
+import tempfile
+from sqlalchemy import select, func
+from vaineye.importer import ParallelImporter
+from vaineye.model import RequestTracker
+
+line = ('1.2.3.4 - - [02/Jan/2010:03:04:05 +0000] "GET /%s HTTP/1.1" '
+        '200 512 "-" "Mozilla/5.0"\n')
+
+def count(rt):
+    return rt.engine.execute(select([func.count(rt.table.c.id)])).scalar()
+
+def import_files(rt, *filenames):
+    importer = ParallelImporter(rt, batch_size=10)
+    importer.stream_chunk_lines = 7
+    for filename in filenames:
+        importer.import_file(filename)
+    importer.close()
+    return importer.lines
+
+def test_resume():
+    dir = tempfile.mkdtemp()
+    try:
+        rt = RequestTracker('sqlite:///%s' % os.path.join(dir, 'r.db'))
+        filename = os.path.join(dir, 'access.log')
+        f = open(filename, 'wb')
+        f.write(''.join([line % i for i in range(25)]))
+        f.close()
+        assert import_files(rt, filename) == 25
+        assert count(rt) == 25
+        # The file grows, then is imported again:
+        f = open(filename, 'ab')
+        f.write(''.join([line % i for i in range(25, 30)]))
+        f.close()
+        assert import_files(rt, filename) == 5
+        assert count(rt) == 30
+        # Rotated and compressed, it is still the same file:
+        f = gzip.open(filename + '.1.gz', 'wb')
+        f.write(open(filename, 'rb').read() + line % 30)
+        f.close()
+        assert import_files(rt, filename + '.1.gz', filename) == 1
+        assert count(rt) == 31
+        assert rt.import_checkpoint('nothing') == (0, 0)
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from vaineye.capture import CapturedRequest
+from vaineye.compact import Compactor
+from vaineye.model import RequestTracker
+
+def make_request(date, path='/', code=200, referrer='', weight=1):
+    return CapturedRequest(
+        '8.8.8.8', date, 1000.0, 1000.5, 'GET', 'http', 'example.com',
+        path, '', 'Mozilla/5.0', referrer, code, 100,
+        'text/html; charset=utf8', sample_weight=weight,
+        ip_location=dict(country_code='US', country_name='United States',
+                         state='IL', city='Chicago'))
+
+def test_compact():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        for partition in [None, 'month']:
+            rt = RequestTracker(db, table_prefix='%s_' % partition,
+                                partition=partition)
+            for date in [datetime(2010, 1, 5, 1), datetime(2010, 1, 5, 2),
+                         datetime(2010, 2, 1), datetime(2010, 3, 1)]:
+                rt.add_record(make_request(date, referrer='http://a.com/'))
+            rt.add_record(make_request(datetime(2010, 1, 5), code=404))
+            rt.add_record(make_request(datetime(2010, 1, 5), path='/b',
+                                       weight=10))
+            rt.write_pending()
+            moved = Compactor(rt, batch_size=2).compact(
+                datetime(2010, 2, 15, 12))
+            assert moved == 5
+            assert rt.compacted_until() == datetime(2010, 2, 15)
+            remaining = list(rt.requests(rt.table.c.id > 0))
+            assert [r['date'] for r in remaining] == [datetime(2010, 3, 1)]
+            hits = sorted([(r['date'], r['url'], r['sample_weight'],
+                            r['content_type'])
+                           for r in rt.aggregated_requests('hits')])
+            assert hits == [
+                (datetime(2010, 1, 5), 'http://example.com/', 2, 'text/html'),
+                (datetime(2010, 1, 5), 'http://example.com/b', 10, 'text/html'),
+                (datetime(2010, 2, 1), 'http://example.com/', 1, 'text/html'),
+                ], hits
+            referrers = list(rt.aggregated_requests(
+                'referrers', end=datetime(2010, 1, 6)))
+            assert len(referrers) == 1
+            assert referrers[0]['referrer'] == 'http://a.com/'
+            locations = list(rt.aggregated_requests('locations'))
+            assert sum([r['sample_weight'] for r in locations]) == 13
+            assert locations[0]['ip_city'] == 'Chicago'
+    finally:
+        shutil.rmtree(dir)
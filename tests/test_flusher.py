@@ -0,0 +1,124 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+from datetime import datetime
+from sqlalchemy import select
+from vaineye.capture import CapturedRequest
+from vaineye.model import RequestTracker
+from vaineye.statuswatch import BackgroundFlusher
+
+def make_request(path):
+    return CapturedRequest(
+        '8.8.8.8', datetime(2010, 1, 2, 3, 4, 5), 1000.0, 1000.5, 'GET',
+        'http', 'example.com', path, '', 'Mozilla/5.0', '', 200, 100,
+        'text/html')
+
+class RecordingTracker(object):
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.pending = []
+        self.writes = []
+    def add_record(self, record):
+        self.pending.append(record)
+    def write_pending(self, atomic=False):
+        if self.failures:
+            self.failures -= 1
+            self.pending = []
+            raise IOError('database is down')
+        self.writes.append([r.path for r in self.pending])
+        self.pending = []
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition() and time.time() < end:
+        time.sleep(0.01)
+    return condition()
+
+def test_flush_interval():
+    tracker = RecordingTracker()
+    flusher = BackgroundFlusher(tracker, flush_interval=0.05,
+                                batch_size=1000)
+    try:
+        for i in range(3):
+            flusher.put(make_request('/%s' % i))
+        # Written once the interval is up, without a full batch:
+        assert wait_for(lambda: tracker.writes)
+        assert tracker.writes == [['/0', '/1', '/2']]
+    finally:
+        flusher.close()
+
+def test_batch_size():
+    tracker = RecordingTracker()
+    flusher = BackgroundFlusher(tracker, flush_interval=60, batch_size=5)
+    try:
+        for i in range(12):
+            flusher.put(make_request('/%s' % i))
+        # Full batches don't wait for the interval:
+        assert wait_for(lambda: len(tracker.writes) == 2)
+        assert tracker.writes == [['/%s' % i for i in range(5)],
+                                  ['/%s' % i for i in range(5, 10)]]
+    finally:
+        flusher.close()
+    assert tracker.writes[2:] == [['/10', '/11']]
+
+def test_close():
+    tracker = RecordingTracker()
+    flusher = BackgroundFlusher(tracker, flush_interval=60, batch_size=1000)
+    for i in range(20):
+        flusher.put(make_request('/%s' % i))
+    flusher.close()
+    assert not flusher.thread.isAlive()
+    assert tracker.writes == [['/%s' % i for i in range(20)]]
+    # Closing again does nothing:
+    flusher.close()
+
+def test_errors():
+    tracker = RecordingTracker(failures=1)
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        flusher = BackgroundFlusher(tracker, flush_interval=0.01,
+                                    batch_size=1000)
+        flusher.put(make_request('/lost'))
+        assert wait_for(lambda: not tracker.failures)
+        # The thread carries on after the error:
+        assert flusher.thread.isAlive()
+        flusher.put(make_request('/kept'))
+        flusher.close()
+        output = sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+    assert tracker.writes == [['/kept']]
+    assert 'Error writing vaineye requests' in output
+    assert 'database is down' in output
+
+def test_fork():
+    dir = tempfile.mkdtemp()
+    try:
+        rt = RequestTracker('sqlite:///%s' % os.path.join(dir, 'r.db'))
+        # Made before the fork, as a pre-forking server would:
+        flusher = BackgroundFlusher(rt, flush_interval=0.01,
+                                    journal_dir=os.path.join(dir, 'journal'))
+        flusher.put(make_request('/parent'))
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                flusher.put(make_request('/child'))
+                # Journaled to its own file:
+                if flusher.journal.filename.endswith(
+                    'vaineye-%s.journal' % os.getpid()):
+                    flusher.close()
+                    status = 0
+            finally:
+                os._exit(status)
+        assert os.waitpid(pid, 0)[1] == 0
+        flusher.close()
+        paths = sorted(row[0] for row in
+                       rt.engine.execute(select([rt.table.c.path])))
+        assert paths == ['/child', '/parent']
+    finally:
+        shutil.rmtree(dir)
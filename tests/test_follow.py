@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+from sqlalchemy import select
+from vaineye.follow import LogFollower
+from vaineye.model import RequestTracker
+
+line = ('1.2.3.4 - - [02/Jan/2010:03:04:05 +0000] "GET /%s HTTP/1.1" '
+        '200 512 "-" "Mozilla/5.0"\n')
+
+def append(filename, data):
+    f = open(filename, 'ab')
+    f.write(data)
+    f.close()
+
+def paths(rt):
+    return sorted(row[0] for row in rt.engine.execute(select([rt.table.c.path])))
+
+def test_follow():
+    dir = tempfile.mkdtemp()
+    try:
+        rt = RequestTracker('sqlite:///%s' % os.path.join(dir, 'r.db'))
+        filename = os.path.join(dir, 'access.log')
+        append(filename, line % 'a' + line % 'b')
+        follower = LogFollower(rt, [filename], flush_interval=0)
+        assert follower.poll() == 2
+        assert paths(rt) == ['/a', '/b']
+        # Half a line is left until the rest is written:
+        append(filename, (line % 'c')[:20])
+        assert follower.poll() == 0
+        append(filename, (line % 'c')[20:])
+        assert follower.poll() == 1
+        # Rotated by renaming, with a line written to the old file
+        # just before:
+        append(filename, line % 'd')
+        os.rename(filename, filename + '.1')
+        append(filename, line % 'e')
+        assert follower.poll() == 1
+        assert follower.poll() == 1
+        assert paths(rt) == ['/a', '/b', '/c', '/d', '/e']
+        # Truncated and written again:
+        open(filename, 'wb').close()
+        append(filename, line % 'f')
+        follower.poll()
+        follower.poll()
+        assert paths(rt) == ['/a', '/b', '/c', '/d', '/e', '/f']
+        follower.close()
+        # Starting again carries on from the checkpoint:
+        append(filename, line % 'g')
+        follower = LogFollower(rt, [filename], flush_interval=0)
+        assert follower.poll() == 1
+        follower.close()
+        assert paths(rt) == ['/a', '/b', '/c', '/d', '/e', '/f', '/g']
+    finally:
+        shutil.rmtree(dir)
+
+def test_follow_backlog():
+    dir = tempfile.mkdtemp()
+    try:
+        rt = RequestTracker('sqlite:///%s' % os.path.join(dir, 'r.db'))
+        filename = os.path.join(dir, 'access.log')
+        append(filename, ''.join(line % i for i in range(5)))
+        follower = LogFollower(rt, [filename], batch_size=2,
+                               flush_interval=60)
+        # Less than two lines at a time:
+        follower.files[0].read_size = len(line) + 10
+        writes = []
+        write_pending = rt.write_pending
+        def counting_write_pending(**kw):
+            writes.append(paths(rt))
+            return write_pending(**kw)
+        rt.write_pending = counting_write_pending
+        assert follower.poll() == 5
+        # Written in batches as the backlog was read, with the last
+        # line left for the flush interval:
+        assert writes == [[], ['/0', '/1']]
+        assert paths(rt) == ['/0', '/1', '/2', '/3']
+        follower.close()
+        assert len(writes) == 3
+        assert paths(rt) == ['/0', '/1', '/2', '/3', '/4']
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,62 @@
+from vaineye.geolocate import is_private_address, GeoLocator, LRUCache
+
+def test_private():
+    for ip in ['127.0.0.1', '10.1.2.3', '172.16.0.1', '172.31.255.255',
+               '192.168.1.1', '169.254.1.1', '224.0.0.1', '::1', '::',
+               'fe80::1', 'fd00::1', '::ffff:10.0.0.1', '2001:db8::1',
+               'unknown', '']:
+        assert is_private_address(ip), ip
+    for ip in ['8.8.8.8', '192.1.2.3', '172.32.0.1', '193.0.0.1',
+               '2a00:1450::1', '::ffff:8.8.8.8']:
+        assert not is_private_address(ip), ip
+
+def test_lru():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert (cache.hits, cache.misses) == (3, 1)
+
+class FakeGeoIP(object):
+    def __init__(self):
+        self.lookups = []
+    def record_by_addr(self, ip):
+        self.lookups.append(ip)
+        if ip.startswith('8.'):
+            return {'country_code': 'US', 'postal_code': '60601'}
+        if ':' in ip:
+            raise ValueError('IPv4 database')
+        return None
+
+def test_locator():
+    geo_ip = FakeGeoIP()
+    locator = GeoLocator(geo_ip, cache_size=10)
+    assert locator.lookup('8.8.8.8')['state'] == 'IL'
+    assert locator.lookup('8.8.8.8')['state'] == 'IL'
+    assert locator.lookup('9.9.9.9') is None
+    assert locator.lookup('9.9.9.9') is None
+    assert locator.lookup('10.0.0.1') is None
+    assert locator.lookup('2a00:1450::1') is None
+    assert locator.lookup('::ffff:8.8.4.4')['country_code'] == 'US'
+    assert geo_ip.lookups == ['8.8.8.8', '9.9.9.9', '2a00:1450::1', '8.8.4.4']
+    assert locator.stats()['hits'] == 2
+
+def test_locator_prefix():
+    geo_ip = FakeGeoIP()
+    locator = GeoLocator(geo_ip, cache_by_prefix=True)
+    locator.lookup('8.8.8.8')
+    locator.lookup('8.8.8.9')
+    locator.lookup('8.8.9.9')
+    assert geo_ip.lookups == ['8.8.8.8', '8.8.9.9']
+
+def test_lookup_many():
+    geo_ip = FakeGeoIP()
+    locator = GeoLocator(geo_ip)
+    recs = locator.lookup_many(['8.8.8.8', '9.9.9.9', '8.8.8.8', '10.0.0.1'])
+    assert recs[0] is recs[2]
+    assert recs[0]['state'] == 'IL'
+    assert recs[1] is None and recs[3] is None
+    assert geo_ip.lookups == ['8.8.8.8', '9.9.9.9']
@@ -0,0 +1,21 @@
+from sqlalchemy import MetaData, Table, Column, Integer, DateTime
+from vaineye.indexes import profile_indexes, add_profile_indexes
+
+def test_profile_indexes():
+    table = Table('requests', MetaData(),
+                  Column('id', Integer, primary_key=True),
+                  Column('date', DateTime),
+                  Column('response_code', Integer))
+    assert profile_indexes(table, 'write-optimized') == [
+        ('ix_requests_date', ('date',)),
+        ('ix_requests_date_response_code', ('date', 'response_code'))]
+    assert [name for name, columns in profile_indexes(table, 'default')] == [
+        'ix_requests_date', 'ix_requests_response_code']
+    add_profile_indexes(table, 'write-optimized')
+    assert len(table.indexes) == 2
+    try:
+        profile_indexes(table, 'fast')
+    except ValueError:
+        pass
+    else:
+        assert 0
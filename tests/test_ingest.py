@@ -0,0 +1,70 @@
+import os
+import shutil
+import socket
+import tempfile
+from datetime import datetime
+from vaineye.capture import CapturedRequest, pack_request
+from vaineye.datagram import DatagramEmitter, parse_sink
+from vaineye.ingest import IngestServer
+from vaineye.model import RequestTracker
+
+def make_request(path, user_agent='Mozilla/5.0'):
+    return CapturedRequest(
+        '8.8.8.8', datetime(2010, 1, 2, 3, 4, 5), 1000.0, 1000.5, 'GET',
+        'http', 'example.com', path, '', user_agent, '', 200, 100,
+        'text/html', sample_weight=2)
+
+def test_parse_sink():
+    assert parse_sink('unix:/tmp/vaineye.sock') == (
+        socket.AF_UNIX, '/tmp/vaineye.sock')
+    assert parse_sink('udp://:9999') == (socket.AF_INET, ('127.0.0.1', 9999))
+    for sink in ['unix:', 'udp://localhost', 'tcp://localhost:9999']:
+        try:
+            parse_sink(sink)
+        except ValueError:
+            pass
+        else:
+            assert 0, 'No error for %r' % sink
+
+def test_ingest():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        sink = 'unix:%s' % os.path.join(dir, 'ingest.sock')
+        rt = RequestTracker(db)
+        server = IngestServer(rt, sink)
+        emitter = DatagramEmitter(sink)
+        emitter.put(make_request('/a'))
+        emitter.put(make_request('/b'))
+        # Garbage, and a request cut short:
+        emitter._socket.sendto('garbage', emitter.address)
+        emitter._socket.sendto('x' * 200, emitter.address)
+        emitter._socket.sendto(pack_request(make_request('/c'))[:-3],
+                               emitter.address)
+        # Bigger than the server reads:
+        emitter.put(make_huge_request())
+        received = [server.receive(1) for i in range(6)]
+        assert received == [True, True, False, False, False, False]
+        assert server.receive(0.01) is False
+        assert server.bad_datagrams == 4
+        server.close()
+        emitter.close()
+        requests = sorted(rt.requests(rt.table.c.id > 0),
+                          key=lambda request: request['path'])
+        assert [r['path'] for r in requests] == ['/a', '/b']
+        assert requests[0]['sample_weight'] == 2
+        assert requests[0]['user_agent'] == 'Mozilla/5.0'
+        stats = dict(captured=0, flushed=0, dropped=0)
+        emitter.update_stats(stats)
+        assert stats == dict(captured=3, flushed=3, dropped=0)
+        # With no daemon listening the request is dropped:
+        emitter.put(make_request('/e'))
+        assert emitter.dropped == 1
+    finally:
+        shutil.rmtree(dir)
+
+def make_huge_request():
+    request = make_request('/huge')
+    request.user_agent = request.referrer = request.query_string = (
+        'x' * 60000)
+    return request
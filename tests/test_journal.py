@@ -0,0 +1,148 @@
+import glob
+import os
+import shutil
+import sys
+import tempfile
+from cStringIO import StringIO
+from datetime import datetime
+from vaineye.capture import CapturedRequest
+from vaineye.journal import Journal
+from vaineye.statuswatch import BackgroundFlusher
+
+def make_request(path):
+    return CapturedRequest(
+        '8.8.8.8', datetime(2010, 1, 2, 3, 4, 5), 1000.0, 1000.5, 'GET',
+        'http', 'example.com', path, '', 'Mozilla/5.0', '', 200, 100,
+        'text/html')
+
+def test_journal():
+    dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dir, 'vaineye-1.journal')
+        journal = Journal(filename, sync_count=2)
+        for i in range(5):
+            journal.append(make_request('/%s' % i))
+        requests, end = journal.read(3)
+        assert [r.path for r in requests] == ['/0', '/1', '/2']
+        journal.commit(end)
+        journal.close()
+        # Another process takes up where this left off:
+        journal = Journal(filename)
+        journal.append(make_request('/5'))
+        requests, end = journal.read()
+        assert [r.path for r in requests] == ['/3', '/4', '/5']
+        journal.commit(end)
+        assert not journal.has_pending()
+        assert os.path.getsize(filename) == 16
+        # A request cut short by a crash is skipped:
+        journal.append(make_request('/6'))
+        journal.sync()
+        journal._file.truncate(journal.end - 3)
+        journal.end -= 3
+        requests, end = journal.read()
+        assert requests == []
+        journal.commit(end)
+        assert not journal.has_pending()
+    finally:
+        shutil.rmtree(dir)
+
+def test_corrupt_tail():
+    dir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dir, 'vaineye-1.journal')
+        for tail in ['\0' * 200, '\xff' * 200, '\x08\0\0\0' + 'x' * 10]:
+            journal = Journal(filename)
+            journal.append(make_request('/good'))
+            journal.close()
+            good_end = os.path.getsize(filename)
+            # A power loss leaves zeroes (or junk) after it:
+            f = open(filename, 'ab')
+            f.write(tail)
+            f.close()
+            journal = Journal(filename)
+            assert journal.end == good_end + len(tail)
+            requests, end = journal.read()
+            assert [r.path for r in requests] == ['/good']
+            assert end == good_end
+            assert os.path.getsize(filename) == good_end
+            journal.commit(end)
+            assert not journal.has_pending()
+            assert journal.read() == ([], 16)
+            journal.close()
+    finally:
+        shutil.rmtree(dir)
+
+class FlakyTracker(object):
+    def __init__(self, failures):
+        self.failures = failures
+        self.pending = []
+        self.written = []
+    def add_record(self, record):
+        self.pending.append(record)
+    def write_pending(self, atomic=False):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('database is down')
+        self.written.extend(self.pending)
+        self.pending = []
+    def discard_pending(self):
+        self.pending = []
+
+def test_flusher_journal():
+    dir = tempfile.mkdtemp()
+    try:
+        tracker = FlakyTracker(1000)
+        flusher = BackgroundFlusher(tracker, flush_interval=0.01,
+                                    journal_dir=dir)
+        for i in range(50):
+            flusher.put(make_request('/%s' % i))
+        flusher.close()
+        # Left for the next process:
+        assert tracker.written == []
+        assert flusher.backoff >= 0.01
+        tracker.failures = 0
+        left = os.listdir(dir)
+        assert len(left) == 1
+        os.rename(os.path.join(dir, left[0]),
+                  os.path.join(dir, 'vaineye-999999999.journal'))
+        flusher = BackgroundFlusher(tracker, flush_interval=0.01,
+                                    journal_dir=dir)
+        flusher.put(make_request('/50'))
+        flusher.close()
+        assert len(tracker.written) == 51
+        assert len(os.listdir(dir)) == 1
+    finally:
+        shutil.rmtree(dir)
+
+def test_flusher_bad_journal():
+    dir = tempfile.mkdtemp()
+    try:
+        # Left by a process that died, with junk in the middle:
+        filename = os.path.join(dir, 'vaineye-999999999.journal')
+        journal = Journal(filename)
+        for i in range(3):
+            journal.append(make_request('/%s' % i))
+        journal.close()
+        f = open(filename, 'r+b')
+        size = (os.path.getsize(filename) - 16) // 3
+        # The date of the second request:
+        f.seek(16 + size + 28)
+        f.write('\x7f' * 8)
+        f.close()
+        tracker = FlakyTracker(0)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            flusher = BackgroundFlusher(tracker, flush_interval=0.01,
+                                        journal_dir=dir)
+            flusher.put(make_request('/new'))
+            flusher.close()
+            output = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        assert 'Cannot read the vaineye journal' in output
+        # The thread carried on:
+        assert [r.path for r in tracker.written] == ['/new']
+        assert len(glob.glob(os.path.join(dir, '*.journal.bad'))) == 1
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,69 @@
+from vaineye.apachelog import parse_apache_line
+from vaineye.capture import CapturedRequest
+from vaineye.logformat import LogParser
+
+combined_line = (
+    '1.2.3.4 - frank [02/Jan/2010:03:04:05 +0100] '
+    '"GET /a/b.css?x=1 HTTP/1.1" 200 512 "http://r.com/" "Mozilla/5.0 (X)"')
+
+def test_combined():
+    request = LogParser('combined', 'https', 'example.com').parse(
+        combined_line)
+    expected = parse_apache_line(combined_line, 'https', 'example.com')
+    for name in CapturedRequest.__slots__:
+        if name not in ('start_time', 'end_time'):
+            assert getattr(request, name) == getattr(expected, name), name
+    assert request.end_time is None
+
+def test_apache_vhost_duration():
+    parser = LogParser('%v %h %l %u %t "%r" %>s %b %D')
+    # Only the fields that are used are captured:
+    assert parser.regex.groups == 8
+    request = parser.parse(
+        'www.example.com 1.2.3.4 - - [02/Jan/2010:03:04:05 +0000] '
+        '"POST /q HTTP/1.0" 404 - 250000')
+    assert request.host == 'www.example.com'
+    assert request.method == 'POST'
+    assert request.path == '/q'
+    assert request.response_code == 404
+    assert request.response_bytes == 0
+    assert abs(request.end_time - request.start_time - 0.25) < 1e-6
+
+def test_vhost_combined():
+    request = LogParser('vhost_combined').parse(
+        'www.example.com:80 1.2.3.4 - - [02/Jan/2010:03:04:05 +0000] '
+        '"GET /a HTTP/1.1" 200 12 "-" "Mozilla/5.0 (X)"')
+    assert request.host == 'www.example.com'
+    assert request.response_bytes == 12
+    assert request.user_agent == 'Mozilla/5.0 (X)'
+
+def test_nginx():
+    parser = LogParser(
+        '$remote_addr - $remote_user [$time_local] "$request_method '
+        '$request_uri $server_protocol" $status $body_bytes_sent '
+        '"$http_referer" "$http_user_agent" $host $request_time')
+    request = parser.parse(
+        '1.2.3.4 - - [02/Jan/2010:03:04:05 +0100] "GET /x?y=1 HTTP/1.1" '
+        '200 5 "-" "UA" example.com 1.500')
+    assert request.ip == '1.2.3.4'
+    assert request.path == '/x'
+    assert request.query_string == 'y=1'
+    assert request.referrer == ''
+    assert request.user_agent == 'UA'
+    assert request.host == 'example.com'
+    assert request.end_time - request.start_time == 1.5
+
+def test_bad():
+    parser = LogParser('common')
+    try:
+        parser.parse('junk')
+    except ValueError:
+        pass
+    else:
+        assert False
+    try:
+        LogParser('%h %s')
+    except ValueError:
+        pass
+    else:
+        assert False
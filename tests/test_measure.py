@@ -0,0 +1,117 @@
+import os
+import shutil
+import tempfile
+import time
+from cStringIO import StringIO
+from wsgiref.util import FileWrapper
+from webob import Request
+from vaineye.statuswatch import StatusWatcher, MeasuredAppIter
+
+class Watcher(object):
+    def __init__(self):
+        self.records = []
+    def record(self, record):
+        self.records.append(record)
+
+class Body(object):
+    """A body that takes a while to start, and notes when it is
+    closed"""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.closed = False
+    def __iter__(self):
+        time.sleep(0.05)
+        for chunk in self.chunks:
+            yield chunk
+    def close(self):
+        self.closed = True
+
+def measure(app_iter, headers=(), environ=None):
+    watcher = Watcher()
+    if environ is None:
+        environ = Request.blank('/', remote_addr='8.8.8.8').environ
+    measured = ['200 OK', list(headers)]
+    wrapped = MeasuredAppIter.wrap(watcher, environ, time.time(),
+                                   app_iter, measured)
+    return watcher, wrapped
+
+def test_counts_bytes():
+    body = Body(['', 'abc', 'defg', ''])
+    watcher, wrapped = measure(body, [('Content-Length', '100')])
+    start = time.time()
+    assert ''.join(wrapped) == 'abcdefg'
+    assert watcher.records == []
+    wrapped.close()
+    assert body.closed
+    record, = watcher.records
+    # What was sent, not what the header said:
+    assert record.response_bytes == 7
+    assert start + 0.05 <= record.first_byte_time <= record.end_time
+    assert record.end_time - record.start_time >= 0.05
+
+def test_empty_body():
+    watcher, wrapped = measure([])
+    assert list(wrapped) == []
+    wrapped.close()
+    record, = watcher.records
+    assert record.response_bytes == 0
+    assert record.first_byte_time is None
+
+def test_close_errors():
+    class Failing(Body):
+        def close(self):
+            raise IOError('closing failed')
+    watcher, wrapped = measure(Failing(['abc']))
+    list(wrapped)
+    try:
+        wrapped.close()
+    except IOError:
+        pass
+    else:
+        assert 0, 'No error'
+    # Recorded all the same:
+    assert len(watcher.records) == 1
+
+def test_len():
+    watcher, wrapped = measure(['abc', 'de'])
+    assert len(wrapped) == 2
+    watcher, wrapped = measure(Body(['abc']))
+    assert not hasattr(wrapped, '__len__')
+
+def test_file_wrapper():
+    environ = Request.blank('/', remote_addr='8.8.8.8').environ
+    environ['wsgi.file_wrapper'] = FileWrapper
+    file = StringIO('x' * 10)
+    body = FileWrapper(file)
+    watcher, wrapped = measure(body, [('Content-Length', '10')], environ)
+    # Given to the server as it is:
+    assert wrapped is body
+    assert ''.join(wrapped) == 'x' * 10
+    wrapped.close()
+    assert file.closed
+    record, = watcher.records
+    assert record.response_bytes == 10
+    assert record.first_byte_time is None
+
+def test_status_watcher():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        def app(environ, start_response):
+            def body():
+                start_response('200 OK', [('Content-Type', 'text/plain')])
+                yield 'hello '
+                yield 'world'
+            return body()
+        watcher = StatusWatcher(app, db=db, measure_body=True,
+                                _synchronous=True)
+        request = Request.blank('/page', remote_addr='8.8.8.8')
+        response = request.get_response(watcher)
+        assert response.body == 'hello world'
+        rt = watcher.request_tracker
+        request, = list(rt.requests(rt.table.c.id > 0))
+        assert request['path'] == '/page'
+        assert request['response_bytes'] == 11
+        assert request['time_to_first_byte'] is not None
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,101 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from vaineye.capture import CapturedRequest
+from vaineye.dimensions import _digest
+from vaineye.model import RequestTracker
+
+def make_request(path, user_agent='Mozilla/5.0', location=None):
+    return CapturedRequest(
+        '8.8.8.8', datetime(2010, 1, 2, 3, 4, 5), 1000.0, 1000.5, 'GET',
+        'http', 'example.com', path, 'a=b', user_agent, '',
+        200, 100, 'text/html', ip_location=location)
+
+def test_normalized():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db, normalized=True)
+        location = dict(country_code='US', city='Chicago', latitude=41.5,
+                        state='IL')
+        rt.add_record(make_request('/a', location=location))
+        rt.add_record(make_request('/b', location=location))
+        rt.add_record(make_request('/a', user_agent=None))
+        rt.write_pending()
+        rt.add_record(make_request('/a'))
+        rt.write_pending()
+        conn = rt.engine.connect()
+        paths = [dimension for dimension, indexes in rt.dimensions
+                 if dimension.name == 'request_paths'][0]
+        assert len(list(conn.execute(paths.table.select()))) == 2
+        # A new tracker finds the normalized tables by itself:
+        rt = RequestTracker(db)
+        assert rt.normalized
+        rows = list(rt.requests(rt.table.c.path == '/a'))
+        assert len(rows) == 3
+        assert rows[0]['url'] == 'http://example.com/a?a=b'
+        assert rows[0]['ip_city'] == 'Chicago'
+        assert rows[0]['ip_latitude'] == 41.5
+        assert rows[0]['referrer'] == ''
+        assert rows[1]['user_agent'] is None
+        assert rows[1]['ip_city'] is None
+        assert rows[2]['user_agent'] == 'Mozilla/5.0'
+        assert rows[2]['processing_time'] == 0.5
+    finally:
+        shutil.rmtree(dir)
+
+def stored_paths(rt):
+    return sorted([request['path']
+                   for request in rt.requests(rt.table.c.id > 0)])
+
+def test_rolled_back():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db, normalized=True)
+        def fail(conn):
+            raise IOError('database is down')
+        rt.add_record(make_request('/first'))
+        try:
+            rt.write_pending(before_commit=fail)
+        except IOError:
+            pass
+        else:
+            assert 0, 'No error'
+        assert stored_paths(rt) == []
+        # The id /first had is given to another path:
+        other = RequestTracker(db)
+        other.add_record(make_request('/other'))
+        other.write_pending()
+        # The retry doesn't use the id that was rolled back:
+        rt.write_pending(before_commit=lambda conn: None)
+        rt.add_record(make_request('/first'))
+        rt.write_pending()
+        assert stored_paths(rt) == ['/first', '/first', '/other']
+    finally:
+        shutil.rmtree(dir)
+
+def test_added_by_another_writer():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db, normalized=True)
+        paths = [dimension for dimension, indexes in rt.dimensions
+                 if dimension.name == 'request_paths'][0]
+        # /a is added (as if by another writer) between looking it up
+        # and adding it, so adding it fails:
+        find = paths._find
+        def find_too_early(conn, keys):
+            paths._find = find
+            conn.execute(paths.table.insert(), path=u'/a',
+                         digest=_digest((u'/a',)))
+            return {}
+        paths._find = find_too_early
+        rt.add_record(make_request('/a'))
+        rt.add_record(make_request('/b'))
+        rt.write_pending(before_commit=lambda conn: None)
+        assert stored_paths(rt) == ['/a', '/b']
+        assert len(list(rt.engine.execute(paths.table.select()))) == 2
+    finally:
+        shutil.rmtree(dir)
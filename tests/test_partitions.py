@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from sqlalchemy import and_
+from vaineye.capture import CapturedRequest
+from vaineye.compact import Compactor
+from vaineye.model import RequestTracker
+from vaineye import partitions
+
+def make_request(date, path='/'):
+    return CapturedRequest(
+        '8.8.8.8', date, 1000.0, 1000.5, 'GET', 'http', 'example.com',
+        path, '', 'Mozilla/5.0', '', 200, 100, 'text/html')
+
+def test_partition_names():
+    start = partitions.partition_start('month', datetime(2010, 12, 5, 3))
+    assert start == datetime(2010, 12, 1)
+    assert partitions.partition_end('month', start) == datetime(2011, 1, 1)
+    assert partitions.partition_name('requests', 'month', start) == (
+        'requests_m201012')
+    week = partitions.partition_start('week', datetime(2010, 1, 6, 3))
+    assert week == datetime(2010, 1, 4)
+    assert partitions.parse_partition_name('requests', 'requests_w20100104') == (
+        'week', week)
+    assert partitions.parse_partition_name('requests', 'requests_m2010') is None
+    assert partitions.parse_partition_name('requests', 'other_m201001') is None
+
+def test_partitioned_tracker():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db, partition='month')
+        for date in [datetime(2010, 1, 5), datetime(2010, 3, 1),
+                     datetime(2010, 1, 31, 23), datetime(2010, 2, 14)]:
+            rt.add_record(make_request(date))
+        rt.write_pending()
+        assert [p.name for p in rt.partitions()] == [
+            'requests_m201001', 'requests_m201002', 'requests_m201003']
+        # A new tracker finds the partitions by itself:
+        rt = RequestTracker(db)
+        assert rt.partition == 'month'
+        table = rt.table
+        query = and_(table.c.date >= datetime(2010, 1, 20),
+                     table.c.date < datetime(2010, 2, 15),
+                     table.c.response_code < 300)
+        assert [t.name for t, q in rt.storage_tables(query)] == [
+            'requests_m201001', 'requests_m201002']
+        dates = [row['date'] for row in rt.requests(query)]
+        assert dates == [datetime(2010, 1, 31, 23), datetime(2010, 2, 14)]
+        assert len(list(rt.requests(table.c.path == '/'))) == 4
+        assert rt.drop_partitions(datetime(2010, 2, 1)) == ['requests_m201001']
+        assert len(list(rt.requests(table.c.path == '/'))) == 2
+    finally:
+        shutil.rmtree(dir)
+
+def test_partitioned_later():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db)
+        rt.add_record(make_request(datetime(2010, 1, 5), path='/old'))
+        rt.write_pending()
+        rt = RequestTracker(db, partition='month')
+        rt.add_record(make_request(datetime(2010, 1, 6), path='/new'))
+        rt.write_pending()
+        # The requests from before are still there:
+        for rt in [rt, RequestTracker(db)]:
+            assert rt.partition == 'month'
+            assert [t.name for t, q in rt.storage_tables()] == [
+                'requests', 'requests_m201001']
+            paths = sorted([row['path']
+                            for row in rt.requests(rt.table.c.id > 0)])
+            assert paths == ['/new', '/old']
+            groups = sorted([(row['path'], row['sample_weight']) for row in
+                             rt.grouped_requests(rt.table.c.id > 0,
+                                                 ['path'])])
+            assert groups == [('/new', 1), ('/old', 1)]
+        # And compacted with the rest:
+        assert Compactor(rt).compact(datetime(2010, 2, 1)) == 2
+        assert list(rt.requests(rt.table.c.id > 0)) == []
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from vaineye import model
+from vaineye.capture import CapturedRequest
+from vaineye.model import RequestTracker
+
+def make_request(path):
+    return CapturedRequest(
+        '8.8.8.8', datetime(2010, 1, 2, 3, 4, 5), 1000.0, 1000.5, 'GET',
+        'http', 'example.com', path, '', 'Mozilla/5.0', '', 200, 100,
+        'text/html')
+
+def pending_paths(rt):
+    return [request.path for request in rt._pending]
+
+def stored_paths(rt):
+    return sorted([request['path']
+                   for request in rt.requests(rt.table.c.id > 0)])
+
+def test_bad_policy():
+    try:
+        RequestTracker('sqlite://', overflow='drop-everything')
+    except ValueError:
+        pass
+    else:
+        assert 0, 'No error'
+
+def test_drop_oldest():
+    rt = RequestTracker('sqlite://', max_pending=3)
+    for i in range(5):
+        rt.add_record(make_request('/%s' % i))
+    assert pending_paths(rt) == ['/2', '/3', '/4']
+    stats = rt.stats()
+    assert stats['captured'] == 5
+    assert stats['dropped'] == 2
+    assert stats['pending'] == 3
+
+def test_drop_newest():
+    rt = RequestTracker('sqlite://', max_pending=3, overflow='drop-newest')
+    for i in range(5):
+        rt.add_record(make_request('/%s' % i))
+    assert pending_paths(rt) == ['/0', '/1', '/2']
+    assert rt.stats()['dropped'] == 2
+
+def test_sample():
+    rt = RequestTracker('sqlite://', max_pending=2, overflow='sample',
+                        overflow_sample_rate=0.5)
+    randoms = [0.9, 0.1, 0.7]
+    old_random = model.random.random
+    model.random.random = lambda: randoms.pop(0)
+    try:
+        for i in range(5):
+            rt.add_record(make_request('/%s' % i))
+    finally:
+        model.random.random = old_random
+    # /2 and /4 are dropped, /3 is kept in place of /0:
+    assert pending_paths(rt) == ['/1', '/3']
+    assert rt.stats()['dropped'] == 3
+
+def test_added_while_writing():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db, max_pending=3)
+        rt.add_record(make_request('/0'))
+        rt.add_record(make_request('/1'))
+        def add_during_write(conn):
+            rt.add_record(make_request('/during'))
+        rt.write_pending(before_commit=add_during_write)
+        # Left for the next write:
+        assert pending_paths(rt) == ['/during']
+        assert stored_paths(rt) == ['/0', '/1']
+        rt.write_pending()
+        assert stored_paths(rt) == ['/0', '/1', '/during']
+        assert rt.stats()['flushed'] == 3
+    finally:
+        shutil.rmtree(dir)
+
+def test_put_back():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        for overflow, kept in [('drop-oldest', ['/2', '/3', '/during']),
+                               ('drop-newest', ['/1', '/2', '/3'])]:
+            rt = RequestTracker(db, table_prefix=overflow[5:] + '_',
+                                max_pending=3, overflow=overflow)
+            for i in range(1, 4):
+                rt.add_record(make_request('/%s' % i))
+            def fail(conn):
+                rt.add_record(make_request('/during'))
+                raise IOError('database is down')
+            try:
+                rt.write_pending(before_commit=fail)
+            except IOError:
+                pass
+            else:
+                assert 0, 'No error'
+            # The failed requests go back in front of the new one, and
+            # the list is trimmed back to max_pending:
+            assert pending_paths(rt) == kept, pending_paths(rt)
+            assert rt.stats()['dropped'] == 1
+            assert stored_paths(rt) == []
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,108 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from sqlalchemy import select
+from webob import Request
+from vaineye.capture import CapturedRequest
+from vaineye.compact import Compactor
+from vaineye.model import RequestTracker
+from vaineye.view import VaineyeView, HitsSummary, LocationSummary
+
+def make_request(date, path='/', code=200, weight=1):
+    return CapturedRequest(
+        '8.8.8.8', date, 1000.0, 1000.5, 'GET', 'http', 'example.com',
+        path, '', 'Mozilla/5.0', '', code, 100, 'text/html',
+        sample_weight=weight,
+        ip_location=dict(country_code='US', country_name='United States',
+                         state='IL', city='Chicago'))
+
+def test_rollups():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db, rollups=True)
+        assert rt.rollups_since() > datetime.now()
+        hits = rt.rollups.tables['hits']
+        for batch in range(2):
+            for date in [datetime(2010, 1, 5, 1, 10),
+                         datetime(2010, 1, 5, 1, 50),
+                         datetime(2010, 1, 5, 2, 30)]:
+                rt.add_record(make_request(date, weight=2))
+            rt.add_record(make_request(datetime(2010, 1, 5, 1), code=404))
+            rt.add_record(make_request(datetime(2010, 1, 5, 1), path='/b'))
+            rt.write_pending()
+        # The same keys are added to, not inserted again:
+        rows = rt.engine.execute(
+            select([hits.c.hour, hits.c.path, hits.c.hits])
+            .order_by(hits.c.hour, hits.c.path)).fetchall()
+        assert [tuple(row) for row in rows] == [
+            (datetime(2010, 1, 5, 1), '/', 8),
+            (datetime(2010, 1, 5, 1), '/b', 2),
+            (datetime(2010, 1, 5, 2), '/', 4)]
+        # Other trackers keep them up too:
+        rt = RequestTracker(db)
+        assert rt.rollups is not None
+        totals = dict((request['url'], request['sample_weight'])
+                      for request in rt.rollup_requests(
+                          'hits', datetime(2010, 1, 5, 1),
+                          datetime(2010, 1, 5, 3)))
+        assert totals == {'http://example.com/': 12,
+                          'http://example.com/b': 2}
+    finally:
+        shutil.rmtree(dir)
+
+def test_compacted():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db, rollups=True)
+        for hour in [1, 2, 3, 4, 5]:
+            rt.add_record(make_request(datetime(2010, 1, 5, hour)))
+        rt.add_record(make_request(datetime(2010, 1, 6, 1)))
+        rt.write_pending()
+        view = VaineyeView(db, dir, _synchronous=True)
+        # The rollups start part way through a day:
+        since = datetime(2010, 1, 5, 3)
+        expected = [(6.0, 'http://example.com/')]
+        assert summary_counts(view, HitsSummary, 'requests',
+                              since) == expected
+        Compactor(rt).compact(datetime(2010, 1, 6))
+        for since in [datetime(2010, 1, 5, 3), datetime(2010, 1, 5),
+                      datetime(2010, 1, 6, 3)]:
+            assert summary_counts(view, HitsSummary, 'requests', since,
+                                  'compacted') == expected, since
+    finally:
+        shutil.rmtree(dir)
+
+def summary_counts(view, cls, bag, rollups_since, label=''):
+    rt = view.request_tracker
+    state = rt.rollups.state_table
+    rt.engine.execute(state.update(), since=rollups_since)
+    summary = cls(view, Request.blank('/?date_range=01/01/2010-'))
+    # Each is worked out again rather than read from the last:
+    summary.id += rollups_since.strftime('_%Y%m%d%H') + label
+    data = summary.update_data(None)
+    return sorted(getattr(data, bag).counts())
+
+def test_summaries():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db, rollups=True)
+        for hour in range(5):
+            for minute in (0, 30):
+                rt.add_record(make_request(
+                    datetime(2010, 1, 5, hour, minute), path='/%s' % minute))
+        rt.write_pending()
+        view = VaineyeView(db, dir, _synchronous=True)
+        for cls, bag in [(HitsSummary, 'requests'),
+                         (LocationSummary, 'cities')]:
+            # Read from the requests table only, from the rollups only,
+            # and from both:
+            expected = summary_counts(view, cls, bag, datetime(2011, 1, 1))
+            assert expected
+            for since in [datetime(2009, 1, 1), datetime(2010, 1, 5, 3)]:
+                assert summary_counts(view, cls, bag, since) == expected
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,34 @@
+from vaineye.capture import CapturedRequest
+from vaineye.sampling import Sampler, SamplingRule
+
+def make_request(path, content_type, status=200):
+    return CapturedRequest(
+        '127.0.0.1', None, None, None, 'GET', 'http', 'localhost',
+        path, '', '', '', status, None, content_type)
+
+def test_parse():
+    rule = SamplingRule.parse('type:image/*=0.01')
+    assert rule.kind == 'type'
+    assert rule.pattern == 'image/*'
+    assert rule.weight == 100
+    assert SamplingRule.parse('*=0.5').kind is None
+    for bad in ['type:image/*', 'image/*=0.5', 'size:1=0.5', 'type:x=2']:
+        try:
+            SamplingRule.parse(bad)
+        except ValueError:
+            pass
+        else:
+            assert 0, 'Should have rejected %r' % bad
+
+def test_weights():
+    values = [0.5]
+    sampler = Sampler('status:5*=1, type:image/*=0.25 path:/static/*=0.1',
+                      random=lambda: values[0])
+    assert sampler.weight(make_request('/', 'text/html; charset=utf8')) == 1
+    assert sampler.weight(make_request('/a.png', 'image/png', 500)) == 1
+    assert sampler.weight(make_request('/a.png', 'image/png')) == 0
+    assert sampler.weight(make_request('/static/a.css', 'text/css')) == 0
+    assert sampler.skipped == 2
+    values[0] = 0.01
+    assert sampler.weight(make_request('/a.png', 'image/png')) == 4
+    assert sampler.weight(make_request('/static/a.css', 'text/css')) == 10
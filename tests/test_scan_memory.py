@@ -0,0 +1,66 @@
+"""
+Scans a large number of requests and checks that memory stays flat
+
+The number of requests is ``VAINEYE_SCAN_ROWS`` (default 100,000, so
+the suite stays quick); set it to 10000000 for the full run, which
+takes a minute or two.
+"""
+import os
+import shutil
+import tempfile
+from datetime import datetime, timedelta
+from nose import SkipTest
+from sqlalchemy import text, event
+from vaineye.model import RequestTracker
+
+# How much the process may grow while scanning:
+ceiling = 64 * 1024 * 1024
+
+def rss():
+    """The resident size of this process in bytes (Linux only)"""
+    for line in open('/proc/self/status'):
+        if line.startswith('VmRSS:'):
+            return int(line.split()[1]) * 1024
+
+def test_scan_memory():
+    if not os.path.exists('/proc/self/status'):
+        raise SkipTest('Needs /proc to measure memory')
+    count = int(os.environ.get('VAINEYE_SCAN_ROWS', 100000))
+    dir = tempfile.mkdtemp()
+    try:
+        rt = RequestTracker('sqlite:///%s' % os.path.join(dir, 'r.db'),
+                            index_profile='write-optimized')
+        start = datetime(2010, 1, 1)
+        # Made by the database, as inserting this many from Python
+        # would take far longer than the scan:
+        rt.engine.execute(text(
+            'INSERT INTO requests (date, scheme, host, path, query_string, '
+            'response_code, content_type, user_agent, sample_weight) '
+            'WITH RECURSIVE seq(n) AS '
+            '(SELECT 0 UNION ALL SELECT n+1 FROM seq WHERE n < :count - 1) '
+            "SELECT datetime(:start, '+' || (n / 100) || ' seconds'), "
+            "'http', 'example.com', '/page' || (n % 1000), '', 200, "
+            "'text/html', 'Mozilla/5.0 (X11; Linux x86_64)', 1 FROM seq"),
+            count=count, start=start.strftime('%Y-%m-%d %H:%M:%S'))
+        query = rt.table.c.date >= start - timedelta(days=1)
+        before = highest = rss()
+        scanned = 0
+        for row in rt.requests(query, columns=['path', 'date']):
+            scanned += 1
+            if not scanned % 100000:
+                highest = max(highest, rss())
+        assert scanned == count
+        assert highest - before < ceiling, (
+            'Grew by %d MB' % ((highest - before) / 1024 / 1024))
+        # Stopped part way, the connection is given back:
+        checked_out = []
+        event.listen(rt.engine, 'checkout',
+                     lambda *args: checked_out.append(1))
+        event.listen(rt.engine, 'checkin', lambda *args: checked_out.pop())
+        rows = rt.requests(query, columns=['path'])
+        rows.next()
+        assert checked_out
+        rows.close()
+        assert not checked_out
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,105 @@
+import os
+import shutil
+import struct
+import tempfile
+from datetime import datetime
+from vaineye.capture import CapturedRequest, pack_request
+from vaineye.collector import SpoolCollector
+from vaineye.model import RequestTracker
+from vaineye.spool import SpoolWriter, SpoolSegment, _write_end_offset
+
+def make_request(path):
+    return CapturedRequest(
+        '8.8.8.8', datetime(2010, 1, 2, 3, 4, 5), 1000.0, 1000.5, 'GET',
+        'http', 'example.com', path, '', 'Mozilla/5.0', '', 200, 100,
+        'text/html')
+
+def stored_paths(rt):
+    return sorted([request['path']
+                   for request in rt.requests(rt.table.c.id > 0)])
+
+def test_spool():
+    dir = tempfile.mkdtemp()
+    try:
+        spool_dir = os.path.join(dir, 'spool')
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        size = len(pack_request(make_request('/0')))
+        # Room for 4 requests in each segment:
+        writer = SpoolWriter(spool_dir, segment_size=64 + 4*size)
+        for i in range(6):
+            writer.put(make_request('/%s' % i))
+        assert len(SpoolSegment.find(spool_dir)) == 2
+        rt = RequestTracker(db)
+        collector = SpoolCollector(rt, spool_dir, batch_size=5)
+        assert collector.collect() == 5
+        assert collector.collect() == 1
+        assert stored_paths(rt) == ['/%s' % i for i in range(6)]
+        # The first segment is sealed and written, the second is
+        # still being written to:
+        assert len(SpoolSegment.find(spool_dir)) == 1
+        stats = dict(captured=0, flushed=0, dropped=0)
+        writer.update_stats(stats)
+        assert stats == dict(captured=6, flushed=6, dropped=0)
+    finally:
+        shutil.rmtree(dir)
+
+def test_partial_record():
+    dir = tempfile.mkdtemp()
+    try:
+        spool_dir = os.path.join(dir, 'spool')
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        writer = SpoolWriter(spool_dir)
+        writer.put(make_request('/0'))
+        writer.put(make_request('/1'))
+        # A writer part way through copying in a request:
+        data = pack_request(make_request('/2'))
+        start = writer._write_end
+        half = len(data) // 2
+        writer._map[start:start+half] = data[:half]
+        rt = RequestTracker(db)
+        collector = SpoolCollector(rt, spool_dir)
+        assert collector.collect() == 2
+        assert collector.collect() == 0
+        assert stored_paths(rt) == ['/0', '/1']
+        # The rest of it is written:
+        writer._map[start+half:start+len(data)] = data[half:]
+        struct.pack_into('<Q', writer._map, _write_end_offset,
+                         start + len(data))
+        writer._write_end = start + len(data)
+        assert collector.collect() == 1
+        assert stored_paths(rt) == ['/0', '/1', '/2']
+        assert len(SpoolSegment.find(spool_dir)) == 1
+        writer.close()
+        assert collector.collect() == 0
+        assert SpoolSegment.find(spool_dir) == []
+    finally:
+        shutil.rmtree(dir)
+
+def test_failed_write():
+    dir = tempfile.mkdtemp()
+    try:
+        spool_dir = os.path.join(dir, 'spool')
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        writer = SpoolWriter(spool_dir)
+        writer.put(make_request('/0'))
+        writer.close()
+        rt = RequestTracker(db)
+        collector = SpoolCollector(rt, spool_dir)
+        write_pending = rt.write_pending
+        def fail(**kw):
+            raise IOError('database is down')
+        rt.write_pending = fail
+        try:
+            collector.collect()
+        except IOError:
+            pass
+        else:
+            assert 0, 'No error'
+        assert rt.stats()['pending'] == 0
+        # Read again the next time:
+        rt.write_pending = write_pending
+        assert collector.collect() == 1
+        assert stored_paths(rt) == ['/0']
+        assert SpoolSegment.find(spool_dir) == []
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from sqlalchemy import MetaData, Table, create_engine, inspect
+from vaineye.capture import CapturedRequest
+from vaineye.model import RequestTracker
+
+def make_request(path):
+    return CapturedRequest(
+        '8.8.8.8', datetime(2010, 1, 2, 3, 4, 5), 1000.0, 1000.5, 'GET',
+        'http', 'example.com', path, '', 'Mozilla/5.0', '', 200, 100,
+        'text/html', first_byte_time=1000.25)
+
+def make_old_tables(db, table_prefix, normalized):
+    """Creates the tables as they were before the `added_columns`"""
+    rt = RequestTracker(db, table_prefix='template_', normalized=normalized)
+    metadata = MetaData()
+    for table in rt.sql_metadata.sorted_tables:
+        columns = [column.copy() for column in table.columns
+                   if table is not rt.insert_table
+                   or column.name not in rt.added_columns]
+        Table(table_prefix + table.name[len('template_'):], metadata,
+              *columns)
+    metadata.create_all(rt.engine)
+
+def test_old_tables():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        for normalized in [False, True]:
+            prefix = 'old%s_' % int(normalized)
+            make_old_tables(db, prefix, normalized)
+            rt = RequestTracker(db, table_prefix=prefix)
+            assert rt.normalized == normalized
+            names = [column['name'] for column in
+                     inspect(create_engine(db)).get_columns(
+                         rt.insert_table.name)]
+            for name in rt.added_columns:
+                assert name in names
+            rt.add_record(make_request('/new'))
+            rt.write_pending()
+            requests = list(rt.requests(rt.table.c.id > 0))
+            assert [r['path'] for r in requests] == ['/new']
+            assert requests[0]['time_to_first_byte'] == 0.25
+            assert requests[0]['sample_weight'] == 1
+            # Nothing to do the second time:
+            RequestTracker(db, table_prefix=prefix)
+    finally:
+        shutil.rmtree(dir)
@@ -0,0 +1,181 @@
+import fnmatch
+import os
+import re
+import shutil
+import tempfile
+from datetime import datetime
+from sqlalchemy import create_engine, MetaData, Table, Column, String
+from sqlalchemy import select, event
+from webob import Request
+from vaineye.capture import CapturedRequest
+from vaineye.model import RequestTracker
+from vaineye.bag import Bag
+from vaineye.view import VaineyeView, Summary, HitsSummary, ReferrerSummary
+from vaineye.view import Data
+from vaineye.view import glob_clause
+
+def make_request(path, content_type='text/html', referrer='', code=200,
+                 weight=1):
+    return CapturedRequest(
+        '8.8.8.8', datetime(2010, 1, 2, 3, 4, 5), 1000.0, 1000.5, 'GET',
+        'http', 'example.com', path, '', 'Mozilla/5.0', referrer, code, 100,
+        content_type, sample_weight=weight)
+
+def summary_data(cls, view, group_by, query=''):
+    summary = cls(view, Request.blank('/?' + query))
+    summary.group_by = group_by
+    summary.id += '_%s' % bool(group_by)
+    return summary.update_data(None)
+
+def test_grouped_summaries():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db)
+        for request in [
+            make_request('/a'), make_request('/a', weight=10),
+            make_request('/a', 'text/html; charset=utf8'),
+            make_request('/b', referrer='http://other.com/'),
+            make_request('/b', referrer='http://other.com/', weight=5),
+            make_request('/b.css', 'text/css'),
+            make_request('/c', code=404)]:
+            rt.add_record(request)
+        rt.write_pending()
+        view = VaineyeView(db, dir, _synchronous=True)
+        for query in ['', 'all_content=1', 'path=/b*']:
+            grouped = summary_data(HitsSummary, view, HitsSummary.group_by,
+                                   query)
+            rows = summary_data(HitsSummary, view, None, query)
+            assert (grouped.requests.counts_most_frequent()
+                    == rows.requests.counts_most_frequent())
+        data = summary_data(HitsSummary, view, HitsSummary.group_by)
+        assert data.requests.counts_most_frequent() == [
+            (12, 'http://example.com/a'), (6, 'http://example.com/b')]
+        grouped = summary_data(ReferrerSummary, view,
+                               ReferrerSummary.group_by)
+        rows = summary_data(ReferrerSummary, view, None)
+        assert (grouped.referrers.counts_most_frequent()
+                == rows.referrers.counts_most_frequent())
+        assert grouped.referrers.counts() == [
+            (6, ('http://other.com/', 'http://example.com/b'))]
+    finally:
+        shutil.rmtree(dir)
+
+def test_glob_clause():
+    engine = create_engine('sqlite://')
+    metadata = MetaData()
+    table = Table('paths', metadata, Column('path', String(100)))
+    metadata.create_all(engine)
+    paths = ['/', '/a', '/a/b.css', '/a_b', '/a%b', '/ab', '/b/a', '/b1',
+             '/b2', '/bx']
+    engine.execute(table.insert(), [dict(path=path) for path in paths])
+    for pattern in ['/a*', '/a_*', '/a%*', '/?', '*.css', '/b[12]',
+                    '/b[!1]', '/a', '*']:
+        expected = [path for path in paths
+                    if fnmatch.fnmatchcase(path, pattern)]
+        for dialect_name in ['sqlite', 'postgresql']:
+            clause, exact = glob_clause(table.c.path, pattern, dialect_name)
+            found = [row[0] for row in
+                     engine.execute(select([table.c.path], clause))]
+            if exact:
+                assert sorted(found) == sorted(expected), (
+                    pattern, dialect_name)
+            else:
+                assert set(expected) <= set(found), (pattern, dialect_name)
+
+def test_rows_fetched():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db)
+        for path, content_type in [
+            ('/a', 'text/html'), ('/a.css', 'text/css'),
+            ('/a.png', 'image/png'), ('/b', 'text/html; charset=utf8'),
+            ('/b', None), ('/c', 'text/html')]:
+            rt.add_record(make_request(path, content_type))
+        rt.write_pending()
+        view = VaineyeView(db, dir, _synchronous=True)
+        summary = HitsSummary(view, Request.blank('/?path=/[ab]*'))
+        summary.group_by = None
+        fetched = []
+        def callback(index=None, total=None, total_callback=None):
+            if index is not None:
+                fetched.append(index)
+        data = summary.update_data(callback)
+        assert len(fetched) == 3
+        assert sum(count for count, url in data.requests.counts()) == 3
+    finally:
+        shutil.rmtree(dir)
+
+class PathSummary(Summary):
+    """Looks at each request, using only its path"""
+    name = 'paths'
+    description = 'Paths'
+    only_200 = True
+    columns = ('path',)
+
+    def merge_request(self, request, data, weight=1):
+        data.requests.add(request['path'], weight)
+
+    def blank_data(self):
+        data = Data()
+        data.requests = Bag()
+        return data
+
+def test_columns_read():
+    dir = tempfile.mkdtemp()
+    try:
+        db = 'sqlite:///%s' % os.path.join(dir, 'requests.db')
+        rt = RequestTracker(db)
+        rt.add_record(make_request('/a', weight=2))
+        rt.add_record(make_request('/b'))
+        rt.write_pending()
+        view = VaineyeView(db, dir, _synchronous=True)
+        statements = []
+        def before_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+            if re.search(r'FROM requests\b', statement):
+                statements.append(statement)
+        event.listen(view.request_tracker.engine, 'before_cursor_execute',
+                     before_execute)
+        data = PathSummary(view, Request.blank('/?all_content=1')
+                           ).update_data(None)
+        assert sorted(data.requests.counts()) == [(1, '/b'), (2, '/a')]
+        scan = [statement for statement in statements
+                if 'count(' not in statement]
+        assert len(scan) == 1
+        selected = scan[0].split('FROM')[0]
+        assert 'requests.path' in selected
+        assert 'requests.sample_weight' in selected
+        assert 'user_agent' not in selected
+        assert 'requests.host' not in selected
+    finally:
+        shutil.rmtree(dir)
+
+def test_request_rows():
+    dir = tempfile.mkdtemp()
+    try:
+        rt = RequestTracker('sqlite:///%s' % os.path.join(dir, 'r.db'))
+        rt.add_record(make_request('/a', weight=3))
+        rt.write_pending()
+        row, = rt.requests(rt.table.c.id > 0,
+                           columns=['scheme', 'host', 'path', 'query_string'])
+        assert row['url'] == 'http://example.com/a'
+        assert row['sample_weight'] == 3
+        assert 'url' in row and 'user_agent' not in row
+        assert row.get('user_agent') is None
+        assert sorted(dict(row)) == ['host', 'path', 'query_string',
+                                     'sample_weight', 'scheme', 'url']
+        row, = rt.requests(rt.table.c.id > 0, columns=['path'])
+        assert 'url' not in row
+        try:
+            row['url']
+        except KeyError:
+            pass
+        else:
+            assert False
+        row, = rt.requests(rt.table.c.id > 0)
+        assert row['user_agent'] == 'Mozilla/5.0'
+        assert row['url'] == 'http://example.com/a'
+    finally:
+        shutil.rmtree(dir)
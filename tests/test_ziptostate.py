@@ -0,0 +1,18 @@
+from vaineye.ziptostate import zip_to_state, zip_to_state_many
+
+def test_zip_to_state():
+    assert zip_to_state('60601') == 'IL'
+    assert zip_to_state(60601) == 'IL'
+    assert zip_to_state('99501-1234') == 'AK'
+    assert zip_to_state('06001') == 'CT'
+    # In both the DC and VA ranges; DC is listed first:
+    assert zip_to_state('20042') == 'DC'
+    assert zip_to_state('20040') == 'VA'
+    assert zip_to_state('00000') is None
+    assert zip_to_state('99999') is None
+    assert zip_to_state('SW1A') is None
+    assert zip_to_state(None) is None
+
+def test_zip_to_state_many():
+    assert zip_to_state_many(['60601', 'x', 99501, '60601']) == [
+        'IL', None, 'AK', 'IL']
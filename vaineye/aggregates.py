@@ -0,0 +1,293 @@
+"""
+Counts of requests by day or hour, for the summaries to read instead
+of the requests
+
+Daily counts are kept after the requests themselves are gone:
+``vaineye-compact`` (`vaineye.compact`) folds old requests into these
+tables, moving each batch of requests in one transaction, so every
+request is counted either here or in the requests table.  The
+summaries read both.
+
+Hourly counts (`Rollups`) are optional; when they are kept,
+`RequestTracker.write_pending` adds each batch of requests to them in
+the same transaction as the requests, so the summaries can read whole
+hours from them.
+
+There is a table for each kind of summary, counting what that summary
+counts, with the columns it filters on:
+
+``hits``
+    The URL (scheme, host, path and query string) and content type.
+
+``referrers``
+    The same plus the referrer, for requests that have one.
+
+``locations``
+    The path, content type, country, state and city, for requests that
+    have a location.
+
+Only successful requests (``response_code < 300``) are counted, as
+that is all the summaries look at.  The counts are the sum of the
+requests' `sample_weight`.
+"""
+import urlparse
+from datetime import datetime, timedelta
+from hashlib import sha1
+from sqlalchemy import Table, Column, Integer, String, DateTime, Float
+from sqlalchemy import Index, select, func, and_, bindparam
+
+# The key columns of each kind, with their types:
+_key_types = {
+    'scheme': String(10),
+    'host': String(100),
+    'path': String(250),
+    'query_string': String(250),
+    'content_type': String(200),
+    'referrer': String(250),
+    'ip_country_code': String(100),
+    'ip_country_name': String(100),
+    'ip_state': String(2),
+    'ip_city': String(250),
+    }
+
+key_columns = {
+    'hits': ('scheme', 'host', 'path', 'query_string', 'content_type'),
+    'referrers': ('scheme', 'host', 'path', 'query_string', 'content_type',
+                  'referrer'),
+    'locations': ('path', 'content_type', 'ip_country_code',
+                  'ip_country_name', 'ip_state', 'ip_city'),
+    }
+
+kinds = ('hits', 'referrers', 'locations')
+
+def day_start(date):
+    return datetime(date.year, date.month, date.day)
+
+def hour_start(date):
+    return datetime(date.year, date.month, date.day, date.hour)
+
+def next_hour(date):
+    """The start of the first hour at or after `date`"""
+    start = hour_start(date)
+    if start < date:
+        start += timedelta(hours=1)
+    return start
+
+def next_day(date):
+    """The start of the first day at or after `date`"""
+    start = day_start(date)
+    if start < date:
+        start += timedelta(days=1)
+    return start
+
+def request_key(kind, request):
+    """Returns the key `request` (a dictionary of the request's
+    columns) is counted under in `kind`, or None if it isn't
+    counted"""
+    if kind == 'referrers' and not (request['referrer'] or '').strip():
+        return None
+    if kind == 'locations' and not request['ip_country_code']:
+        return None
+    key = []
+    for name in key_columns[kind]:
+        value = request[name]
+        if name == 'content_type' and value:
+            value = value.split(';')[0].strip()
+        key.append(value)
+    return tuple(key)
+
+def count_requests(requests, period_start=day_start):
+    """Counts `requests` (dictionaries of their columns) into
+    ``{kind: {(day, key): count}}`` (or by hour, with
+    `hour_start`)"""
+    counts = dict((kind, {}) for kind in kinds)
+    for request in requests:
+        if request['response_code'] is None or request['response_code'] >= 300:
+            continue
+        day = period_start(request['date'])
+        weight = request['sample_weight'] or 1
+        for kind in kinds:
+            key = request_key(kind, request)
+            if key is None:
+                continue
+            kind_counts = counts[kind]
+            kind_counts[day, key] = kind_counts.get((day, key), 0) + weight
+    return counts
+
+class Aggregates(object):
+    """The aggregate tables of one `RequestTracker`"""
+
+    # The name of the period column, and the part of the table names:
+    period = 'day'
+    table_name = 'daily'
+
+    def __init__(self, metadata, table_prefix=''):
+        self.tables = {}
+        for kind in kinds:
+            self.tables[kind] = Table(
+                '%srequests_%s_%s' % (table_prefix, self.table_name, kind),
+                metadata,
+                Column('id', Integer, primary_key=True),
+                Column(self.period, DateTime, index=True),
+                Column('hits', Float),
+                *([Column(name, _key_types[name])
+                   for name in key_columns[kind]] + self.extra_columns()))
+        self.make_state_table(metadata, table_prefix)
+
+    def extra_columns(self):
+        return []
+
+    def make_state_table(self, metadata, table_prefix):
+        self.state_table = Table(
+            table_prefix+'requests_compaction', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('compacted_until', DateTime))
+
+    def compacted_until(self, conn):
+        """There are no counts for this date or later (None if
+        nothing has been compacted)"""
+        return conn.execute(
+            select([func.max(self.state_table.c.compacted_until)])).scalar()
+
+    def set_compacted_until(self, conn, date):
+        state = self.state_table
+        if conn.execute(select([func.count(state.c.id)])).scalar():
+            conn.execute(state.update(), compacted_until=date)
+        else:
+            conn.execute(state.insert(), compacted_until=date)
+
+    def add(self, conn, counts):
+        """Adds the counts from `count_requests`
+
+        A key may end up in more than one row for a day; readers add
+        them up.
+        """
+        for kind, kind_counts in counts.iteritems():
+            if not kind_counts:
+                continue
+            names = key_columns[kind]
+            rows = []
+            for (day, key), hits in kind_counts.iteritems():
+                row = dict(zip(names, key))
+                row['day'] = day
+                row['hits'] = hits
+                rows.append(row)
+            conn.execute(self.tables[kind].insert(), rows)
+
+    def requests(self, conn, kind, start=None, end=None, by_period=True):
+        """Yields dictionaries that look like requests (with the keys
+        the summaries use), one for each day and key of `kind` from
+        `start` up to `end`, with the count as its `sample_weight`
+
+        If not `by_period` there is one for each key, dated `start`.
+        """
+        table = self.tables[kind]
+        names = key_columns[kind]
+        columns = [table.c[name] for name in names]
+        period = table.c[self.period]
+        if by_period:
+            group = [period] + columns
+            query = select([period, func.sum(table.c.hits)] + columns)
+        else:
+            group = columns
+            query = select([func.min(period), func.sum(table.c.hits)]
+                           + columns)
+        if start is not None:
+            query = query.where(period >= start)
+        if end is not None:
+            query = query.where(period < end)
+        query = query.group_by(*group)
+        for row in conn.execute(query):
+            request = dict(zip(names, row[2:]))
+            if by_period or start is None:
+                request['date'] = row[0]
+            else:
+                request['date'] = start
+            request['sample_weight'] = row[1]
+            request['response_code'] = 200
+            if 'host' in request:
+                request['url'] = urlparse.urlunsplit((
+                    request['scheme'], request['host'], request['path'],
+                    request['query_string'], ''))
+            yield request
+
+def key_digest(key):
+    return sha1(repr(key)).hexdigest()
+
+class Rollups(Aggregates):
+    """Hourly counts, added to as requests are written
+
+    Each hour has one row per key (found by the digest of the key),
+    which is updated in place.  The counts are only complete from
+    `since`: the first whole hour after they were started.
+    """
+
+    period = 'hour'
+    table_name = 'hourly'
+
+    def __init__(self, metadata, table_prefix=''):
+        super(Rollups, self).__init__(metadata, table_prefix)
+        for table in self.tables.values():
+            Index('ix_%s_hour_key' % table.name, table.c.hour,
+                  table.c.key_hash, unique=True)
+
+    def extra_columns(self):
+        return [Column('key_hash', String(40))]
+
+    def make_state_table(self, metadata, table_prefix):
+        self.state_table = Table(
+            table_prefix+'requests_rollups', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('since', DateTime))
+
+    def since(self, conn):
+        """The first hour counted completely (None if the counts
+        haven't been started)"""
+        return conn.execute(select([func.min(self.state_table.c.since)])).scalar()
+
+    def start(self, conn, now=None):
+        """Starts counting (if that hasn't been done), from the next
+        whole hour"""
+        if self.since(conn) is None:
+            conn.execute(self.state_table.insert(),
+                         since=next_hour(now or datetime.now()))
+
+    def add(self, conn, counts):
+        """Adds the counts from `count_requests` (by hour) to the
+        existing rows, creating the rows that don't exist yet"""
+        for kind, kind_counts in counts.iteritems():
+            if not kind_counts:
+                continue
+            table = self.tables[kind]
+            names = key_columns[kind]
+            items = [(hour, key_digest(key), key, hits)
+                     for (hour, key), hits in kind_counts.iteritems()]
+            # Keeps the parameters under SQLite's limit:
+            for start in xrange(0, len(items), 400):
+                self._add_chunk(conn, table, names, items[start:start+400])
+
+    def _add_chunk(self, conn, table, names, items):
+        hours = set([hour for hour, digest, key, hits in items])
+        existing = dict(
+            ((row[1], row[2]), row[0]) for row in conn.execute(
+                select([table.c.id, table.c.hour, table.c.key_hash],
+                       and_(table.c.hour.in_(list(hours)),
+                            table.c.key_hash.in_(
+                                [digest for hour, digest, key, hits
+                                 in items])))))
+        updates = []
+        inserts = []
+        for hour, digest, key, hits in items:
+            if (hour, digest) in existing:
+                updates.append(dict(row_id=existing[hour, digest],
+                                    added=hits))
+            else:
+                row = dict(zip(names, key))
+                row.update(hour=hour, key_hash=digest, hits=hits)
+                inserts.append(row)
+        if updates:
+            conn.execute(
+                table.update().where(table.c.id == bindparam('row_id'))
+                .values(hits=table.c.hits + bindparam('added')), updates)
+        if inserts:
+            conn.execute(table.insert(), inserts)
@@ -0,0 +1,194 @@
+"""
+Parses the lines of Apache log files into captured requests
+"""
+import re
+import time
+import calendar
+import mimetypes
+import gzip
+import bz2
+from datetime import datetime
+from vaineye.capture import CapturedRequest, pack_request, unpack_request
+
+apache_line_re = re.compile(r'''
+(?P<ip>[\d.:a-fA-F]+)          \s+  # IP Address
+(?P<ident>[^\s]+)              \s+  # ident (usually -)
+(?P<user>[^\s]+)               \s+  # logged-in user (usually -)
+\[(?P<date>[^\]]*)\]           \s+  # date
+"(?P<method>[A-Z]+)            \s+  # Start of the request string
+(?P<path>[^ ]+)                \s+  # Requested path
+HTTP/(?P<http_version>[\d.]*)" \s+  # The version
+(?P<status>\d+)                \s+  # Response status version
+(?P<bytes>\d+|-)               \s+  # Bytes in response (- is 0)
+"(?P<referrer>[^"]*)"          \s+  # Referrer
+"(?P<user_agent>[^"]*)"             # User-Agent
+''', re.VERBOSE)
+
+apache_date_format = '%d/%b/%Y:%H:%M:%S'
+
+_months = dict((name, index) for index, name in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+     'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'], 1))
+
+# The last date parsed, as (string, (datetime, timestamp)); log lines
+# come in order, so many in a row have the same date:
+_last_date = (None, None)
+
+def parse_apache_date(value):
+    """Parses an Apache log date like ``02/Jan/2010:03:04:05 +0100``
+    into a local datetime (like the dates of captured requests)
+
+    A date without a zone is taken to be local time already.  Raises
+    ValueError if the date can't be parsed.
+    """
+    return parse_apache_time(value)[0]
+
+def parse_apache_time(value):
+    """Like `parse_apache_date`, but returns ``(datetime,
+    timestamp)``"""
+    global _last_date
+    last_value, last_result = _last_date
+    if value == last_value:
+        return last_result
+    if (len(value) < 20 or value[2] != '/' or value[6] != '/'
+        or value[11] != ':' or value[14] != ':' or value[17] != ':'):
+        raise ValueError('Bad date: %r' % value)
+    try:
+        day = int(value[0:2])
+        month = _months[value[3:6]]
+        year = int(value[7:11])
+        hour = int(value[12:14])
+        minute = int(value[15:17])
+        second = int(value[18:20])
+    except (KeyError, ValueError):
+        raise ValueError('Bad date: %r' % value)
+    zone = value[20:].strip()
+    if zone:
+        if len(zone) != 5 or zone[0] not in '+-' or not zone[1:].isdigit():
+            raise ValueError('Bad time zone in date: %r' % value)
+        offset = int(zone[1:3]) * 3600 + int(zone[3:5]) * 60
+        if zone[0] == '-':
+            offset = -offset
+        timestamp = calendar.timegm(
+            (year, month, day, hour, minute, second, 0, 0, 0)) - offset
+    else:
+        timestamp = time.mktime(
+            (year, month, day, hour, minute, second, 0, 0, -1))
+    result = (datetime.fromtimestamp(timestamp), timestamp)
+    _last_date = (value, result)
+    return result
+
+def parse_apache_line(line, default_scheme='http', default_host='localhost'):
+    """Parses one line of an Apache combined-format log file into a
+    `CapturedRequest`
+
+    Apache log files do not contain the request domain or scheme,
+    so these must be provided.  Raises ValueError if the line can't
+    be parsed."""
+    match = apache_line_re.match(line)
+    if not match:
+        raise ValueError("Bad line, cannot parse: %r" % line)
+    d = match.groupdict()
+    date = parse_apache_date(d['date'])
+    if '?' in d['path']:
+        path, query_string = d['path'].split('?', 1)
+    else:
+        path = d['path']
+        query_string = ''
+    if not d.get('bytes') or d['bytes'] == '-':
+        bytes = 0
+    else:
+        bytes = int(d['bytes'])
+    referrer = d['referrer']
+    if referrer == '-':
+        referrer = ''
+    user_agent = d['user_agent']
+    if user_agent == '-':
+        user_agent = '-'
+    content_type, encoding = mimetypes.guess_type(path)
+    return CapturedRequest(
+        d['ip'], date, None, None, d['method'],
+        default_scheme, default_host, path, query_string,
+        user_agent, referrer, int(d['status']), bytes, content_type)
+
+def parse_lines(lines, default_scheme='http', default_host='localhost',
+                log_format=None):
+    """Parses `lines`, returning ``(packed, count, errors)``
+
+    The requests are packed together (see
+    `vaineye.capture.pack_request`), which is much smaller to send
+    between processes than the requests themselves.  ``errors`` are
+    the messages for lines that couldn't be parsed.  Lines are in the
+    combined format unless a `log_format` is given (see
+    `vaineye.logformat`).
+    """
+    if log_format:
+        from vaineye.logformat import get_parser
+        parse = get_parser(log_format, default_scheme, default_host)
+    else:
+        parse = lambda line: parse_apache_line(
+            line, default_scheme, default_host)
+    packed = []
+    errors = []
+    for line in lines:
+        try:
+            request = parse(line)
+        except ValueError, e:
+            errors.append(str(e))
+            continue
+        packed.append(pack_request(request))
+    return ''.join(packed), len(packed), errors
+
+def parse_range(filename, start, end, default_scheme='http',
+                default_host='localhost', log_format=None):
+    """Parses the lines of `filename` from byte offset `start` to
+    `end` (which should both be at the start of a line); see
+    `parse_lines`"""
+    f = open(filename, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    return parse_lines(data.splitlines(True), default_scheme, default_host,
+                       log_format)
+
+def unpack_requests(packed):
+    """The requests in a string from `parse_lines`"""
+    requests = []
+    pos = 0
+    while pos < len(packed):
+        request, pos = unpack_request(packed, pos)
+        requests.append(request)
+    return requests
+
+def is_compressed(filename):
+    return filename.endswith('.gz') or filename.endswith('.bz2')
+
+def open_log(filename):
+    """Opens `filename` for reading, uncompressing it if it ends in
+    ``.gz`` or ``.bz2``"""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.bz2'):
+        return bz2.BZ2File(filename, 'rb')
+    return open(filename, 'rb')
+
+def split_file(filename, chunk_size=8*1024*1024, start=0):
+    """Splits `filename` (from byte `start`) into ``(start, end)``
+    ranges of about `chunk_size` bytes that start and end at line
+    boundaries"""
+    f = open(filename, 'rb')
+    try:
+        f.seek(0, 2)
+        size = f.tell()
+        ranges = []
+        while start < size:
+            f.seek(start + chunk_size)
+            f.readline()
+            end = min(f.tell(), size)
+            ranges.append((start, end))
+            start = end
+    finally:
+        f.close()
+    return ranges
@@ -8,16 +8,16 @@ class Bag(object):
         if items:
             for item in items:
                 self.add(item)
-    def add(self, item):
+    def add(self, item, count=1):
         if item in self._data:
-            self._data[item] += 1
+            self._data[item] += count
         else:
-            self._data[item] = 1
+            self._data[item] = count
     def __len__(self):
         return sum(self._data.values())
     def __iter__(self):
         for item, count in self._data.items():
-            for i in xrange(count):
+            for i in xrange(int(round(count))):
                 yield item
     def __contains__(self, item):
         return item in self._data
@@ -0,0 +1,332 @@
+"""
+Writers that insert many request rows at once
+
+`RequestTracker.write_pending` hands its rows (tuples, in the order of
+the columns given to the writer) to one of these:
+
+``executemany``
+    Chunks of rows sent with the driver's ``executemany``; works
+    everywhere.
+
+``values``
+    Chunks of rows sent as one ``INSERT ... VALUES (...), (...)``
+    statement each.  The default on SQLite, where the connections are
+    also put in WAL mode with ``synchronous=NORMAL``.
+
+``copy``
+    Rows streamed with ``COPY ... FROM STDIN``.  The default on
+    PostgreSQL with psycopg2.
+
+Each chunk is its own transaction, so a large batch does not hold one
+huge transaction; if a chunk fails, `BulkWriteError` says how many rows
+were written before it.  Writing with ``atomic=True`` puts all the
+chunks in one transaction instead.
+"""
+import time
+from cStringIO import StringIO
+from datetime import date, datetime
+from sqlalchemy import event
+
+class BulkWriteError(Exception):
+    """Raised when a chunk of rows could not be inserted
+
+    `written` is the number of rows (from the start) that were
+    inserted and committed before the failure; `original` is the
+    exception from the database.
+    """
+
+    # Error messages can include all the parameters of a statement;
+    # only this much of the message is kept:
+    max_message = 500
+
+    def __init__(self, table_name, start, end, total, original):
+        self.written = start
+        self.original = original
+        message = str(original)
+        if len(message) > self.max_message:
+            message = message[:self.max_message] + '...'
+        Exception.__init__(
+            self, 'Error inserting rows %s-%s (of %s) into %s: %s: %s'
+            % (start, end-1, total, table_name,
+               original.__class__.__name__, message))
+
+class ExecuteManyWriter(object):
+    """Inserts chunks of rows with the DBAPI ``executemany``
+
+    The SQL is built once with the driver's positional markers, and
+    the rows are sent as plain tuples.  Drivers with only named
+    parameters fall back to the SQLAlchemy insert.
+    """
+
+    name = 'executemany'
+
+    _paramstyle_markers = {
+        'qmark': '?',
+        'format': '%s',
+        'pyformat': '%s',
+        }
+
+    def __init__(self, engine, table, columns, chunk_size=1000):
+        self.engine = engine
+        self.dialect = engine.dialect
+        self.table = table
+        self.columns = [table.c[name] for name in columns]
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+        self.seconds = 0.0
+        self.last_rate = None
+        self.bind_processors = []
+        for index, column in enumerate(self.columns):
+            # The dialect's own type (SQLite's DATETIME formats dates
+            # as text, for instance):
+            processor = column.type.dialect_impl(
+                self.dialect).bind_processor(self.dialect)
+            if processor is not None:
+                self.bind_processors.append((index, processor))
+        self.configure_engine(engine)
+        self.prepare()
+
+    def configure_engine(self, engine):
+        """Sets up anything the writer needs on each new connection"""
+        pass
+
+    def markers(self):
+        """Returns the parameter markers for one row, or None if the
+        driver doesn't have positional parameters"""
+        paramstyle = self.dialect.paramstyle
+        if paramstyle == 'numeric':
+            return [':%s' % (index+1) for index in range(len(self.columns))]
+        if paramstyle in self._paramstyle_markers:
+            return [self._paramstyle_markers[paramstyle]] * len(self.columns)
+        return None
+
+    def prepare(self):
+        markers = self.markers()
+        if markers is None:
+            self.insert_sql = None
+            return
+        self.insert_sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            self.table_sql(), self.columns_sql(), ', '.join(markers))
+
+    def table_sql(self):
+        return self.dialect.identifier_preparer.format_table(self.table)
+
+    def columns_sql(self):
+        preparer = self.dialect.identifier_preparer
+        return ', '.join([preparer.format_column(column)
+                          for column in self.columns])
+
+    def write(self, conn, rows, atomic=False):
+        """Inserts all the `rows`, a chunk (and transaction) at a time,
+        or all in one transaction if `atomic`"""
+        if not rows:
+            return
+        start_time = time.time()
+        total = len(rows)
+        outer = None
+        if atomic:
+            outer = conn.begin()
+        try:
+            for start in xrange(0, total, self.chunk_size):
+                chunk = rows[start:start+self.chunk_size]
+                trans = None
+                if outer is None:
+                    trans = conn.begin()
+                try:
+                    self.write_chunk(conn, chunk)
+                except Exception, e:
+                    if trans is not None:
+                        trans.rollback()
+                    raise BulkWriteError(self.table.name, start,
+                                         start+len(chunk), total, e)
+                if trans is not None:
+                    trans.commit()
+            if outer is not None:
+                outer.commit()
+        except BulkWriteError, e:
+            if outer is not None:
+                outer.rollback()
+                e.written = 0
+            self.record_time(e.written, start_time)
+            raise
+        self.record_time(total, start_time)
+
+    def record_time(self, count, start_time):
+        seconds = time.time() - start_time
+        self.rows_written += count
+        self.seconds += seconds
+        if count and seconds:
+            self.last_rate = count / seconds
+
+    def rate(self):
+        """The average rows per second of everything written"""
+        if not self.seconds:
+            return None
+        return self.rows_written / self.seconds
+
+    def process(self, rows):
+        """Applies the column types' bind processors to `rows`"""
+        processors = self.bind_processors
+        if not processors:
+            return rows
+        processed = []
+        for row in rows:
+            row = list(row)
+            for index, processor in processors:
+                row[index] = processor(row[index])
+            processed.append(row)
+        return processed
+
+    def write_chunk(self, conn, rows):
+        if self.insert_sql is None:
+            names = [column.name for column in self.columns]
+            conn.execute(self.table.insert(),
+                         [dict(zip(names, row)) for row in rows])
+            return
+        cursor = conn.connection.cursor()
+        try:
+            cursor.executemany(self.insert_sql, self.process(rows))
+        finally:
+            cursor.close()
+
+class ValuesWriter(ExecuteManyWriter):
+    """Inserts each chunk with multi-row ``INSERT ... VALUES``
+    statements"""
+
+    name = 'values'
+
+    # SQLite allows at most this many parameters in a statement (in
+    # versions before 3.32):
+    max_parameters = 999
+
+    def __init__(self, engine, table, columns, chunk_size=1000):
+        ExecuteManyWriter.__init__(self, engine, table, columns, chunk_size)
+        self.statement_rows = max(
+            1, self.max_parameters // len(self.columns))
+
+    def configure_engine(self, engine):
+        # Once for each engine, however many writers (e.g., one for
+        # each partition) are made for it:
+        if (engine.dialect.name != 'sqlite'
+            or getattr(engine, '_vaineye_pragmas', False)):
+            return
+        engine._vaineye_pragmas = True
+        event.listen(engine, 'connect', _sqlite_pragmas)
+        if engine.url.database not in (None, '', ':memory:'):
+            # Connections already in the pool don't have the pragmas
+            # (an in-memory database would be lost, though):
+            engine.dispose()
+
+    def prepare(self):
+        markers = self.markers()
+        if markers is None or self.dialect.paramstyle == 'numeric':
+            self.insert_sql = None
+            return
+        self.row_sql = '(%s)' % ', '.join(markers)
+        self.insert_sql = 'INSERT INTO %s (%s) VALUES ' % (
+            self.table_sql(), self.columns_sql())
+        self._statements = {}
+
+    def write_chunk(self, conn, rows):
+        if self.insert_sql is None:
+            return ExecuteManyWriter.write_chunk(self, conn, rows)
+        rows = self.process(rows)
+        cursor = conn.connection.cursor()
+        try:
+            for start in xrange(0, len(rows), self.statement_rows):
+                statement_rows = rows[start:start+self.statement_rows]
+                params = []
+                for row in statement_rows:
+                    params.extend(row)
+                cursor.execute(self.statement(len(statement_rows)), params)
+        finally:
+            cursor.close()
+
+    def statement(self, count):
+        """The insert of `count` rows"""
+        sql = self._statements.get(count)
+        if sql is None:
+            sql = self._statements[count] = (
+                self.insert_sql + ', '.join([self.row_sql] * count))
+        return sql
+
+def _sqlite_pragmas(dbapi_conn, connection_record):
+    cursor = dbapi_conn.cursor()
+    try:
+        # WAL lets readers (the viewer) go on while requests are
+        # written; with it, NORMAL only syncs at checkpoints
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA cache_size=-16000')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+    finally:
+        cursor.close()
+
+class CopyWriter(ExecuteManyWriter):
+    """Streams each chunk with PostgreSQL's ``COPY FROM STDIN``
+    (psycopg2 only)"""
+
+    name = 'copy'
+
+    def __init__(self, engine, table, columns, chunk_size=50000):
+        ExecuteManyWriter.__init__(self, engine, table, columns, chunk_size)
+
+    def prepare(self):
+        self.insert_sql = None
+        self.copy_sql = 'COPY %s (%s) FROM STDIN' % (
+            self.table_sql(), self.columns_sql())
+
+    def write_chunk(self, conn, rows):
+        data = StringIO()
+        write = data.write
+        for row in self.process(rows):
+            write('\t'.join([_copy_value(value) for value in row]))
+            write('\n')
+        data.seek(0)
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(self.copy_sql, data)
+        finally:
+            cursor.close()
+
+_copy_escapes = [('\\', '\\\\'), ('\t', '\\t'), ('\n', '\\n'), ('\r', '\\r')]
+
+def _copy_value(value):
+    """Formats one value for the text format of COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf8')
+    elif isinstance(value, (datetime, date)):
+        return value.isoformat()
+    elif isinstance(value, float):
+        return repr(value)
+    elif not isinstance(value, str):
+        return str(value)
+    for char, escaped in _copy_escapes:
+        if char in value:
+            value = value.replace(char, escaped)
+    return value
+
+writers = dict((writer.name, writer)
+               for writer in (ExecuteManyWriter, ValuesWriter, CopyWriter))
+
+def make_writer(engine, table, columns, name=None, chunk_size=None):
+    """Creates the writer called `name` (one of `writers`), or the
+    best one for the `engine` if `name` is None"""
+    if name is None:
+        dialect = engine.dialect
+        if dialect.name == 'sqlite':
+            name = 'values'
+        elif (dialect.name in ('postgresql', 'postgres')
+              and dialect.driver == 'psycopg2'):
+            name = 'copy'
+        else:
+            name = 'executemany'
+    if name not in writers:
+        raise ValueError(
+            'Bad bulk writer %r (should be one of %s)'
+            % (name, ', '.join(sorted(writers))))
+    if chunk_size is None:
+        return writers[name](engine, table, columns)
+    return writers[name](engine, table, columns, chunk_size=chunk_size)
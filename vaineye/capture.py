@@ -0,0 +1,157 @@
+"""
+Compact records of captured requests
+
+These are built on the request path (or while reading a log file), so
+they hold only the raw values, and don't require SQLAlchemy.
+"""
+import struct
+import time
+from datetime import datetime
+
+class CapturedRequest(object):
+    """One request that has not been written to the database yet
+
+    `date` may be None, in which case it is computed from
+    `start_time` when the request is written.  `first_byte_time` is
+    only known when the response body is measured (see
+    `vaineye.statuswatch.MeasuredAppIter`).  `sample_weight` is how
+    many requests this one stands for (see `vaineye.sampling`).
+    `ip_location` is filled in by `RequestTracker.add_geoip`.
+    """
+
+    __slots__ = ('ip', 'date', 'start_time', 'end_time', 'method',
+                 'scheme', 'host', 'path', 'query_string', 'user_agent',
+                 'referrer', 'response_code', 'response_bytes',
+                 'content_type', 'first_byte_time', 'sample_weight',
+                 'ip_location')
+
+    def __init__(self, ip, date, start_time, end_time, method, scheme,
+                 host, path, query_string, user_agent, referrer,
+                 response_code, response_bytes=None, content_type=None,
+                 first_byte_time=None, sample_weight=1, ip_location=None):
+        self.ip = ip
+        self.date = date
+        self.start_time = start_time
+        self.end_time = end_time
+        self.method = method
+        self.scheme = scheme
+        self.host = host
+        self.path = path
+        self.query_string = query_string
+        self.user_agent = user_agent
+        self.referrer = referrer
+        self.response_code = response_code
+        self.response_bytes = response_bytes
+        self.content_type = content_type
+        self.first_byte_time = first_byte_time
+        self.sample_weight = sample_weight
+        self.ip_location = ip_location
+
+    def __repr__(self):
+        return '<%s %s %s://%s%s %s>' % (
+            self.__class__.__name__, self.method, self.scheme,
+            self.host, self.path, self.response_code)
+
+def capture_request(environ, start_time, end_time, status, response_headers):
+    """Create a `CapturedRequest` from a WSGI environment and the
+    response status and headers"""
+    response_bytes = content_type = None
+    for header_name, header_value in response_headers:
+        header_name = header_name.lower()
+        if header_name == 'content-length':
+            response_bytes = int(header_value)
+        elif header_name == 'content-type':
+            content_type = header_value
+    get = environ.get
+    return CapturedRequest(
+        environ['REMOTE_ADDR'], None, start_time, end_time,
+        environ['REQUEST_METHOD'], environ['wsgi.url_scheme'],
+        get('HTTP_HOST', ''),
+        get('SCRIPT_NAME', '') + get('PATH_INFO', ''),
+        get('QUERY_STRING', ''), get('HTTP_USER_AGENT', ''),
+        get('HTTP_REFERER', ''),
+        int(status.split(None, 1)[0]), response_bytes, content_type)
+
+# The fixed part of a packed request: the total length of the record,
+# the four times (NaN for None), the sample weight, the response code
+# and size (-1 for None), and the length of each of the strings that
+# follow it (0xffff for None):
+_packed_header = struct.Struct('<IddddfHq9H')
+_packed_strings = ('ip', 'method', 'scheme', 'host', 'path', 'query_string',
+                   'user_agent', 'referrer', 'content_type')
+_none_length = 0xffff
+_nan = float('nan')
+# The smallest a packed request can be:
+min_packed_size = _packed_header.size
+
+def pack_request(request):
+    """Packs a `CapturedRequest` into a compact string (the location
+    is not kept)"""
+    strings = []
+    lengths = []
+    for name in _packed_strings:
+        value = getattr(request, name)
+        if value is None:
+            lengths.append(_none_length)
+            continue
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        value = value[:_none_length-1]
+        strings.append(value)
+        lengths.append(len(value))
+    if request.date is not None:
+        date = time.mktime(request.date.timetuple()) + request.date.microsecond/1e6
+    else:
+        date = _nan
+    response_bytes = request.response_bytes
+    if response_bytes is None:
+        response_bytes = -1
+    body = ''.join(strings)
+    return _packed_header.pack(
+        _packed_header.size + len(body),
+        _or_nan(request.start_time), _or_nan(request.end_time),
+        _or_nan(request.first_byte_time), date, request.sample_weight,
+        request.response_code, response_bytes, *lengths) + body
+
+def unpack_request(data, offset=0):
+    """Unpacks a request packed by `pack_request`, starting at
+    `offset` in `data`
+
+    Returns ``(request, next_offset)``.  The strings come back as
+    UTF-8 encoded ``str``.
+    """
+    fields = _packed_header.unpack_from(data, offset)
+    (length, start_time, end_time, first_byte_time, date,
+     sample_weight, response_code, response_bytes) = fields[:8]
+    pos = offset + _packed_header.size
+    values = {}
+    for name, size in zip(_packed_strings, fields[8:]):
+        if size == _none_length:
+            values[name] = None
+        else:
+            values[name] = data[pos:pos+size]
+            pos += size
+    if response_bytes == -1:
+        response_bytes = None
+    if date != date:
+        date = None
+    else:
+        date = datetime.fromtimestamp(date)
+    request = CapturedRequest(
+        values['ip'], date, _or_none(start_time), _or_none(end_time),
+        values['method'], values['scheme'], values['host'],
+        values['path'], values['query_string'], values['user_agent'],
+        values['referrer'], response_code, response_bytes,
+        values['content_type'], _or_none(first_byte_time), sample_weight)
+    return request, offset + length
+
+def _or_nan(value):
+    if value is None:
+        return _nan
+    return value
+
+def _or_none(value):
+    # NaN is the only value not equal to itself
+    if value != value:
+        return None
+    return value
@@ -0,0 +1,54 @@
+"""
+How far each log file has been imported
+
+``vaineye-import`` records, for each file, how many bytes (of the
+uncompressed log) and lines have been written, in the same
+transaction as the requests.  Importing a file again starts from
+there, so an interrupted import can be run again and a file that has
+already been imported is skipped.
+
+Files are told apart by their first line rather than their name, so
+``access.log`` is still recognised after it has been rotated to
+``access.log.1`` and then compressed to ``access.log.2.gz``.
+"""
+from datetime import datetime
+from hashlib import sha1
+from sqlalchemy import Table, Column, Integer, BigInteger, String, DateTime
+from sqlalchemy import select
+
+def fingerprint(first_line):
+    """The fingerprint of a file starting with `first_line`"""
+    return sha1(first_line).hexdigest()
+
+class Checkpoints(object):
+    """The checkpoints table of one `RequestTracker`"""
+
+    def __init__(self, metadata, table_prefix=''):
+        self.table = Table(
+            table_prefix+'import_checkpoints', metadata,
+            Column('id', Integer, primary_key=True),
+            Column('fingerprint', String(40), unique=True),
+            Column('filename', String(250)),
+            Column('byte_offset', BigInteger),
+            Column('lines', BigInteger),
+            Column('updated', DateTime))
+
+    def get(self, conn, fingerprint):
+        """Returns ``(offset, lines)`` imported of the file with
+        `fingerprint`, or ``(0, 0)``"""
+        table = self.table
+        row = conn.execute(
+            select([table.c.byte_offset, table.c.lines],
+                   table.c.fingerprint == fingerprint)).first()
+        if row is None:
+            return 0, 0
+        return row[0], row[1]
+
+    def set(self, conn, fingerprint, filename, offset, lines):
+        table = self.table
+        values = dict(filename=filename, byte_offset=offset, lines=lines,
+                      updated=datetime.now())
+        result = conn.execute(
+            table.update(table.c.fingerprint == fingerprint), **values)
+        if not result.rowcount:
+            conn.execute(table.insert(), fingerprint=fingerprint, **values)
@@ -0,0 +1,130 @@
+"""
+Collects the requests spooled by worker processes into the database
+"""
+import optparse
+import sys
+import time
+from vaineye.model import RequestTracker
+from vaineye.spool import SpoolSegment
+
+parser = optparse.OptionParser(
+    usage='%prog [OPTIONS] DB_CONNECTION SPOOL_DIR'
+    )
+parser.add_option(
+    '--table-prefix',
+    metavar='PREFIX',
+    help='The prefix to prepend on the table(s) created by the system',
+    default='')
+
+parser.add_option(
+    '-b', '--batch',
+    metavar='COUNT',
+    help='The most requests to insert at once (default 10000)',
+    default='10000')
+
+parser.add_option(
+    '-i', '--interval',
+    metavar='SECONDS',
+    help='How long to wait when there is nothing to collect (default 5)',
+    default='5')
+
+parser.add_option(
+    '--once',
+    action='store_true',
+    help='Collect what is there now, then exit')
+
+parser.add_option(
+    '--normalized',
+    action='store_true',
+    help='Create the tables with the normalized schema (an existing '
+    'normalized schema is used without this)')
+
+parser.add_option(
+    '--partition',
+    metavar='month|week|day',
+    help='Create a table for each month, week or day (existing '
+    'partitions are used without this)')
+
+parser.add_option(
+    '--rollups',
+    action='store_true',
+    help='Start keeping hourly counts for the summaries (they are kept '
+    'without this once started)')
+
+class SpoolCollector(object):
+    """Moves requests from spool segments into a `RequestTracker`"""
+
+    def __init__(self, request_tracker, spool_dir, batch_size=10000):
+        self.request_tracker = request_tracker
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+
+    def collect(self):
+        """Writes one batch of spooled requests (from as many segments
+        as it takes), and removes segments that are finished
+
+        Returns the number of requests written.
+        """
+        tracker = self.request_tracker
+        segments = []
+        count = 0
+        try:
+            for filename in SpoolSegment.find(self.spool_dir):
+                if count >= self.batch_size:
+                    break
+                try:
+                    segment = SpoolSegment(filename)
+                except (IOError, ValueError):
+                    # Not fully created yet, or not ours
+                    continue
+                requests, end = segment.read(self.batch_size - count)
+                for request in requests:
+                    tracker.add_record(request)
+                count += len(requests)
+                segments.append((segment, end))
+            if count:
+                # If this fails the offsets are not committed, and the
+                # same requests are read again next time:
+                try:
+                    tracker.write_pending(atomic=True)
+                except:
+                    tracker.discard_pending()
+                    raise
+            for segment, end in segments:
+                segment.commit(end)
+                if segment.finished():
+                    segment.remove()
+                else:
+                    segment.close()
+            segments = []
+        finally:
+            for segment, end in segments:
+                segment.close()
+        return count
+
+    def run(self, interval=5):
+        """Collect forever"""
+        while True:
+            if self.collect() < self.batch_size:
+                time.sleep(interval)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.error('You must give a DB_CONNECTION string and SPOOL_DIR')
+    request_tracker = RequestTracker(args[0], options.table_prefix,
+                                     normalized=options.normalized or None,
+                                     partition=options.partition,
+                                     rollups=options.rollups or None)
+    collector = SpoolCollector(request_tracker, args[1],
+                               batch_size=int(options.batch))
+    if options.once:
+        while collector.collect():
+            pass
+    else:
+        collector.run(float(options.interval))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+"""
+Folds old requests into daily aggregates and deletes them
+"""
+import optparse
+import sys
+from datetime import datetime, timedelta
+from sqlalchemy import select
+from vaineye.aggregates import count_requests, day_start
+from vaineye.model import RequestTracker
+
+parser = optparse.OptionParser(
+    usage='%prog [OPTIONS] DB_CONNECTION'
+    )
+parser.add_option(
+    '--table-prefix',
+    metavar='PREFIX',
+    help='The prefix to prepend on the table(s) created by the system',
+    default='')
+
+parser.add_option(
+    '-k', '--keep-days',
+    metavar='DAYS',
+    help='Keep the requests of this many days (default 30)',
+    default='30')
+
+parser.add_option(
+    '-b', '--batch',
+    metavar='COUNT',
+    help='The most requests to move in one transaction (default 10000)',
+    default='10000')
+
+class Compactor(object):
+    """Moves requests from a `RequestTracker` into its aggregates, a
+    batch at a time"""
+
+    def __init__(self, request_tracker, batch_size=10000):
+        self.request_tracker = request_tracker
+        self.batch_size = batch_size
+
+    def compact(self, before, callback=None):
+        """Moves all the requests from before the day `before` starts,
+        returning how many were moved
+
+        `callback` is called with the number moved so far after each
+        batch.
+        """
+        rt = self.request_tracker
+        before = day_start(before)
+        conn = rt.engine.connect()
+        try:
+            # Before anything is moved, so that readers know to look
+            # at the aggregates:
+            trans = conn.begin()
+            compacted_until = rt.aggregates.compacted_until(conn)
+            if compacted_until is None or compacted_until < before:
+                rt.aggregates.set_compacted_until(conn, before)
+            trans.commit()
+            moved = 0
+            for table, query in rt.storage_tables(rt.table.c.date < before):
+                while True:
+                    count = self.move_batch(conn, table, query)
+                    if not count:
+                        break
+                    moved += count
+                    if callback:
+                        callback(moved)
+        finally:
+            conn.close()
+        if rt.partition:
+            # These are empty now
+            rt.drop_partitions(before)
+        return moved
+
+    def move_batch(self, conn, table, query):
+        """Moves up to `batch_size` requests from `table` that match
+        `query`, in one transaction"""
+        rt = self.request_tracker
+        trans = conn.begin()
+        try:
+            select_query = select([table], query).order_by(table.c.id)
+            requests = [dict(row) for row in
+                        conn.execute(select_query.limit(self.batch_size))]
+            if requests:
+                rt.aggregates.add(conn, count_requests(requests))
+                rt.delete_rows(conn, table,
+                               [request['id'] for request in requests])
+        except:
+            trans.rollback()
+            raise
+        trans.commit()
+        return len(requests)
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    options, args = parser.parse_args(args)
+    if len(args) < 1:
+        parser.error('You must give a DB_CONNECTION string')
+    request_tracker = RequestTracker(args[0], options.table_prefix)
+    compactor = Compactor(request_tracker, batch_size=int(options.batch))
+    before = datetime.now() - timedelta(days=int(options.keep_days))
+    def callback(moved):
+        sys.stdout.write('\rMoved %s requests' % moved)
+        sys.stdout.flush()
+    moved = compactor.compact(before, callback)
+    print '\rMoved %s requests from before %s' % (
+        moved, day_start(before).strftime('%Y-%m-%d'))
+
+if __name__ == '__main__':
+    sys.exit(main())
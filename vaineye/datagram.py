@@ -0,0 +1,74 @@
+"""
+Sends captured requests as datagrams to a local ingest daemon
+
+The middleware packs each request (see `vaineye.capture.pack_request`)
+into a single datagram and sends it without waiting for anything;
+``vaineye-ingest`` (`vaineye.ingest`) receives them, batches them and
+writes them through `vaineye.model.RequestTracker`.  Several
+application servers can share one ingest daemon.
+"""
+import socket
+import urlparse
+from vaineye.capture import pack_request
+
+def parse_sink(sink):
+    """Parses a sink description into ``(family, address)``
+
+    ``unix:/path/to/socket`` is a Unix datagram socket,
+    ``udp://host:port`` is a UDP socket.
+    """
+    if sink.startswith('unix:'):
+        path = sink[len('unix:'):]
+        if path.startswith('//'):
+            path = path[2:]
+        if not path:
+            raise ValueError('No socket path in sink %r' % sink)
+        return socket.AF_UNIX, path
+    if sink.startswith('udp://'):
+        netloc = urlparse.urlsplit(sink)[1]
+        if ':' not in netloc:
+            raise ValueError('No port in sink %r' % sink)
+        host, port = netloc.rsplit(':', 1)
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    raise ValueError(
+        'Bad sink %r (should be unix:/path or udp://host:port)' % sink)
+
+class DatagramEmitter(object):
+    """Sends one datagram per captured request
+
+    If the daemon is not there, or is so far behind that a send would
+    wait longer than `send_timeout` seconds, the request is dropped
+    (and counted).
+    """
+
+    def __init__(self, sink, send_timeout=0.01):
+        self.family, self.address = parse_sink(sink)
+        self.send_timeout = send_timeout
+        self.sent = 0
+        self.dropped = 0
+        self._socket = None
+
+    def _connect(self):
+        self._socket = socket.socket(self.family, socket.SOCK_DGRAM)
+        self._socket.settimeout(self.send_timeout)
+
+    def put(self, record):
+        """Send one `CapturedRequest`"""
+        if self._socket is None:
+            self._connect()
+        try:
+            self._socket.sendto(pack_request(record), self.address)
+        except socket.error:
+            self.dropped += 1
+        else:
+            self.sent += 1
+
+    def update_stats(self, stats):
+        stats['captured'] += self.sent + self.dropped
+        stats['flushed'] += self.sent
+        stats['dropped'] += self.dropped
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
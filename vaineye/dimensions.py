@@ -0,0 +1,144 @@
+"""
+Dimension tables for the normalized request schema
+
+In the normalized schema (see `vaineye.model.RequestTracker`) each
+request row holds small integer keys in place of repeated strings like
+the host, path or user agent.  A `Dimension` is the table those keys
+point into, plus an in-process cache of the keys already known.
+"""
+import hashlib
+from sqlalchemy import Table, Column, Integer, String, select
+from vaineye.geolocate import LRUCache
+
+class Dimension(object):
+    """A table of distinct values (or tuples of values), each with an
+    integer id
+
+    Values are found by a digest of the value, which keeps the unique
+    index small even for long values (and possible for ``Text``).
+    """
+
+    # The most values to look up in one query:
+    lookup_chunk = 500
+
+    def __init__(self, name, metadata, columns, cache_size=100000):
+        """`columns` is a list of ``Column`` holding the value; a key
+        is a tuple of the values of these columns"""
+        self.name = name
+        self.value_columns = [column.name for column in columns]
+        self.table = Table(
+            name, metadata,
+            Column('id', Integer, primary_key=True),
+            Column('digest', String(40), nullable=False, unique=True),
+            *columns)
+        self.cache = LRUCache(cache_size)
+        # Ids looked up or added in a transaction that hasn't been
+        # committed yet:
+        self._uncommitted = {}
+
+    def ids(self, conn, keys):
+        """Returns the id of each of `keys`, adding the keys that are
+        new to the table
+
+        A key of all None has no id (None).  Outside a transaction the
+        new keys are inserted and committed right away, so that they
+        are known even if the requests that use them are not written.
+        If `conn` is in a transaction the keys are added in it, and
+        their ids are only cached once `commit` is called (`rollback`
+        forgets them, as the database may give them to other keys).
+        """
+        cache = self.cache
+        result = [None] * len(keys)
+        missing = {}
+        for index, key in enumerate(keys):
+            if key is None:
+                continue
+            id = cache.get(key)
+            if id is None:
+                missing.setdefault(key, []).append(index)
+            else:
+                result[index] = id
+        if missing:
+            found = self._find(conn, missing)
+            new = [key for key in missing if key not in found]
+            if new:
+                self._insert(conn, new)
+                found.update(self._find(conn, new))
+            if conn.in_transaction():
+                cache = self._uncommitted
+            for key, indexes in missing.iteritems():
+                id = found[key]
+                cache[key] = id
+                for index in indexes:
+                    result[index] = id
+        return result
+
+    def commit(self):
+        """Caches the ids from the transaction that has just been
+        committed"""
+        for key, id in self._uncommitted.iteritems():
+            self.cache[key] = id
+        self._uncommitted = {}
+
+    def rollback(self):
+        """Forgets the ids from the transaction that has just been
+        rolled back"""
+        self._uncommitted = {}
+
+    def _find(self, conn, keys):
+        """Returns ``{key: id}`` for those of `keys` in the table"""
+        by_digest = dict((_digest(key), key) for key in keys)
+        digests = list(by_digest)
+        table = self.table
+        found = {}
+        for start in xrange(0, len(digests), self.lookup_chunk):
+            chunk = digests[start:start+self.lookup_chunk]
+            query = select([table.c.digest, table.c.id],
+                           table.c.digest.in_(chunk))
+            for digest, id in conn.execute(query):
+                found[by_digest[digest]] = id
+        return found
+
+    def _insert(self, conn, keys):
+        rows = []
+        for key in keys:
+            row = dict(zip(self.value_columns, key))
+            row['digest'] = _digest(key)
+            rows.append(row)
+        trans = self._begin(conn)
+        try:
+            conn.execute(self.table.insert(), rows)
+        except:
+            trans.rollback()
+            # Most likely another writer added some of the same keys;
+            # add them one at a time, skipping the ones that are there
+            for row in rows:
+                trans = self._begin(conn)
+                try:
+                    conn.execute(self.table.insert(), row)
+                except:
+                    trans.rollback()
+                    if not self._find(conn, [self._key(row)]):
+                        raise
+                else:
+                    trans.commit()
+            return
+        trans.commit()
+
+    def _begin(self, conn):
+        # Within the caller's transaction a savepoint, so a failed
+        # insert can be undone without undoing the whole transaction
+        if conn.in_transaction():
+            return conn.begin_nested()
+        return conn.begin()
+
+    def _key(self, row):
+        return tuple([row[name] for name in self.value_columns])
+
+def _digest(key):
+    parts = []
+    for value in key:
+        if isinstance(value, str):
+            value = value.decode('utf8', 'replace')
+        parts.append(repr(value))
+    return hashlib.sha1(u'\x00'.join(parts).encode('utf8')).hexdigest()
@@ -0,0 +1,215 @@
+"""
+Follows log files as they are written (``vaineye-import --follow``)
+
+Each file is read as lines are added to it, and the requests are
+written in small batches: when `batch_size` have built up, or every
+`flush_interval` seconds.  How far each file has got is recorded with
+the requests (see `vaineye.checkpoints`), so following can be stopped
+and started again without losing or repeating anything.
+
+Rotation is noticed when the file name points to a different file
+(logrotate's default of renaming the old file): the rest of the old
+file is read, then the new one is opened.  When a file gets smaller or
+its first line changes (logrotate's ``copytruncate``) it is read again
+from the start.
+"""
+import os
+import sys
+import time
+from vaineye.apachelog import parse_apache_line
+from vaineye.checkpoints import fingerprint
+
+class TailedFile(object):
+    """One file being followed"""
+
+    # How much to read at a time:
+    read_size = 1024 * 1024
+
+    def __init__(self, filename, request_tracker):
+        self.filename = filename
+        self.request_tracker = request_tracker
+        self.file = None
+        self.open()
+
+    def open(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.filename, 'rb')
+        stat = os.fstat(self.file.fileno())
+        self.inode = (stat.st_dev, stat.st_ino)
+        self.restart()
+
+    def restart(self):
+        """Starts from the beginning of the file (or its checkpoint)"""
+        self.key = None
+        self.offset = 0
+        self.lines = 0
+        self.partial = ''
+        self.file.seek(0)
+
+    def _start(self):
+        # The fingerprint needs the whole first line:
+        self.file.seek(0)
+        first_line = self.file.readline()
+        if not first_line.endswith('\n'):
+            self.file.seek(0)
+            return False
+        self.key = fingerprint(first_line)
+        self.offset, self.lines = self.request_tracker.import_checkpoint(
+            self.key)
+        self.file.seek(self.offset)
+        return True
+
+    def read_lines(self):
+        """Returns the next complete lines added since the last call,
+        from about `read_size` bytes; an empty list when there are
+        none"""
+        if self.key is None and not self._start():
+            return []
+        lines = []
+        while not lines:
+            data = self.file.read(self.read_size)
+            if not data:
+                return []
+            lines = (self.partial + data).splitlines(True)
+            if lines[-1].endswith('\n'):
+                self.partial = ''
+            else:
+                self.partial = lines.pop()
+        for line in lines:
+            self.offset += len(line)
+        self.lines += len(lines)
+        return lines
+
+    def check(self):
+        """Returns ``'rotated'`` if the file name now points to another
+        file, ``'truncated'`` if the file got smaller, or None"""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            # Renamed, and the new file isn't there yet
+            return None
+        if (stat.st_dev, stat.st_ino) != self.inode:
+            return 'rotated'
+        if stat.st_size < self.offset + len(self.partial):
+            return 'truncated'
+        if self.key is not None:
+            # It may have been truncated and written past where this
+            # had got to since the last check:
+            self.file.seek(0)
+            first_line = self.file.readline()
+            self.file.seek(self.offset + len(self.partial))
+            if fingerprint(first_line) != self.key:
+                return 'truncated'
+        return None
+
+    def close(self):
+        self.file.close()
+
+class LogFollower(object):
+    """Follows `filenames`, adding what is written to them to a
+    `RequestTracker`"""
+
+    def __init__(self, request_tracker, filenames, batch_size=1000,
+                 flush_interval=5.0, poll_interval=1.0,
+                 default_scheme='http', default_host='localhost',
+                 log_format=None):
+        self.request_tracker = request_tracker
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.poll_interval = poll_interval
+        if log_format:
+            from vaineye.logformat import get_parser
+            self.parse = get_parser(log_format, default_scheme, default_host)
+        else:
+            self.parse = lambda line: parse_apache_line(
+                line, default_scheme, default_host)
+        self.files = [TailedFile(filename, request_tracker)
+                      for filename in filenames]
+        self.lines = 0
+        self._pending = 0
+        self._checkpoints = {}
+        self._last_write = time.time()
+
+    def run(self):
+        """Follows the files until interrupted"""
+        try:
+            while True:
+                if not self.poll():
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        self.close()
+
+    def poll(self):
+        """Reads what has been added to each file, writing when it is
+        time to; returns the number of lines read"""
+        read = 0
+        for tailed in self.files:
+            read += self._read(tailed)
+            state = tailed.check()
+            if state == 'rotated':
+                read += self._read(tailed)
+                print '%s: rotated' % tailed.filename
+                tailed.open()
+            elif state == 'truncated':
+                print '%s: truncated' % tailed.filename
+                tailed.restart()
+        if self._pending >= self.batch_size or (
+            (self._pending or self._checkpoints)
+            and time.time() - self._last_write >= self.flush_interval):
+            self.write()
+        return read
+
+    def _read(self, tailed):
+        """Adds all the lines `tailed` has, writing each time
+        `batch_size` build up"""
+        read = 0
+        while True:
+            lines = tailed.read_lines()
+            if not lines:
+                return read
+            read += self._add_lines(tailed, lines)
+            if self._pending >= self.batch_size and not self.write():
+                # Leave the rest in the file until the database is back
+                return read
+
+    def _add_lines(self, tailed, lines):
+        add_record = self.request_tracker.add_record
+        parse = self.parse
+        for line in lines:
+            try:
+                add_record(parse(line))
+            except ValueError, e:
+                print >> sys.stdout, str(e)
+                continue
+            self._pending += 1
+        self.lines += len(lines)
+        self._checkpoints[tailed.key] = (
+            tailed.filename, tailed.offset, tailed.lines)
+        return len(lines)
+
+    def write(self):
+        """Writes the pending requests; if that fails they are kept
+        for the next try"""
+        self._last_write = time.time()
+        checkpoints = self._checkpoints
+        def record_checkpoints(conn):
+            for key, (filename, offset, lines) in checkpoints.items():
+                self.request_tracker.checkpoints.set(
+                    conn, key, filename, offset, lines)
+        try:
+            self.request_tracker.write_pending(
+                before_commit=record_checkpoints)
+        except Exception, e:
+            print >> sys.stderr, 'Error writing requests: %s' % e
+            return False
+        self._checkpoints = {}
+        self._pending = 0
+        return True
+
+    def close(self):
+        if self._pending or self._checkpoints:
+            self.write()
+        for tailed in self.files:
+            tailed.close()
@@ -0,0 +1,200 @@
+"""
+Cached GeoIP lookups of request addresses
+"""
+import socket
+import struct
+from collections import OrderedDict
+from vaineye.ziptostate import zip_to_state, zip_to_state_many
+
+def parse_address(ip):
+    """Parses an IPv4 or IPv6 address into ``(version, number)``
+
+    IPv4 addresses mapped into IPv6 (``::ffff:1.2.3.4``) come back as
+    IPv4.  Returns None if `ip` is not an address.
+    """
+    try:
+        packed = socket.inet_pton(socket.AF_INET, ip)
+    except (socket.error, ValueError, TypeError):
+        pass
+    else:
+        return 4, _to_number(packed)
+    try:
+        packed = socket.inet_pton(socket.AF_INET6, ip)
+    except (socket.error, ValueError, TypeError):
+        return None
+    number = _to_number(packed)
+    if number >> 32 == 0xffff:
+        return 4, number & 0xffffffff
+    return 6, number
+
+def _to_number(packed):
+    number = 0
+    for char in packed:
+        number = (number << 8) | ord(char)
+    return number
+
+def _network(text):
+    address, bits = text.split('/')
+    version, number = parse_address(address)
+    size = version == 4 and 32 or 128
+    return number >> (size - int(bits)), size - int(bits)
+
+# Networks that are private, loopback, link-local, multicast,
+# documentation or otherwise not routed, as ``(prefix, host bits)``:
+_reserved = {
+    4: [_network(text) for text in [
+        '0.0.0.0/8', '10.0.0.0/8', '100.64.0.0/10', '127.0.0.0/8',
+        '169.254.0.0/16', '172.16.0.0/12', '192.0.0.0/24',
+        '192.0.2.0/24', '192.168.0.0/16', '198.18.0.0/15',
+        '198.51.100.0/24', '203.0.113.0/24', '224.0.0.0/4',
+        '240.0.0.0/4']],
+    6: [_network(text) for text in [
+        '::/127', '100::/64', '2001:db8::/32', 'fc00::/7', 'fe80::/10',
+        'fec0::/10', 'ff00::/8']],
+    }
+
+def is_private_address(ip):
+    """True if `ip` is not a public address (including when it's not
+    an address at all)"""
+    parsed = parse_address(ip)
+    if parsed is None:
+        return True
+    return _is_reserved(*parsed)
+
+def _is_reserved(version, number):
+    for prefix, host_bits in _reserved[version]:
+        if number >> host_bits == prefix:
+            return True
+    return False
+
+class LRUCache(object):
+    """A dictionary that keeps only the `max_size` most recently used
+    items, and counts its hits and misses"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        data = self._data
+        if key in data:
+            del data[key]
+        elif len(data) >= self.max_size:
+            data.popitem(last=False)
+        data[key] = value
+
+    def __len__(self):
+        return len(self._data)
+
+# Stored in the cache for addresses that have no location:
+_no_location = object()
+
+class GeoLocator(object):
+    """Looks up the location of addresses with a pygeoip database,
+    remembering recent results
+
+    If `cache_by_prefix` is true, all the addresses in a /24 (IPv4) or
+    /48 (IPv6) share one cache entry, which makes the cache go much
+    further at the cost of some precision.
+    """
+
+    def __init__(self, geo_ip, cache_size=10000, cache_by_prefix=False):
+        self.geo_ip = geo_ip
+        self.cache = LRUCache(cache_size)
+        self.cache_by_prefix = cache_by_prefix
+
+    def cache_key(self, ip):
+        if not self.cache_by_prefix:
+            return ip
+        parsed = parse_address(ip)
+        if parsed is None:
+            return ip
+        version, number = parsed
+        if version == 4:
+            return 4, number >> 8
+        return 6, number >> 80
+
+    def lookup(self, ip):
+        """Returns the location record for `ip` (with a ``state`` key
+        added), or None if it has none
+
+        Errors from the database are not caught (or cached).
+        """
+        key = self.cache_key(ip)
+        rec = self.cache.get(key)
+        if rec is None:
+            rec = self._lookup(ip)
+            if rec is not None:
+                rec['state'] = zip_to_state(rec.get('postal_code'))
+            self.cache[key] = rec or _no_location
+        elif rec is _no_location:
+            return None
+        return rec
+
+    def lookup_many(self, ips):
+        """Like `lookup`, for each of `ips`, returning a list
+
+        Each distinct address is only looked at once, and the states
+        of all the new records are found together.
+        """
+        found = {}
+        new = []
+        cache = self.cache
+        for ip in ips:
+            if ip in found:
+                continue
+            key = self.cache_key(ip)
+            rec = cache.get(key)
+            if rec is None:
+                rec = self._lookup(ip)
+                if rec is not None:
+                    new.append(rec)
+                cache[key] = rec or _no_location
+            elif rec is _no_location:
+                rec = None
+            found[ip] = rec
+        if new:
+            states = zip_to_state_many(
+                [location.get('postal_code') for location in new])
+            for location, state in zip(new, states):
+                location['state'] = state
+        return [found[ip] for ip in ips]
+
+    def _lookup(self, ip):
+        """Looks `ip` up in the database, without the state"""
+        parsed = parse_address(ip)
+        if parsed is None or _is_reserved(*parsed):
+            return None
+        version, number = parsed
+        if version == 4 and ':' in ip:
+            # IPv4 mapped into IPv6; the database wants it plain
+            ip = socket.inet_ntoa(struct.pack('>I', number))
+        try:
+            rec = self.geo_ip.record_by_addr(ip)
+        except SystemError:
+            # No database at all
+            raise
+        except Exception:
+            if version == 6:
+                # Most databases only know about IPv4
+                return None
+            raise
+        if not rec:
+            return None
+        return rec
+
+    def stats(self):
+        return dict(hits=self.cache.hits, misses=self.cache.misses,
+                    size=len(self.cache))
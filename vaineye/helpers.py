@@ -33,6 +33,12 @@ class wsgi_unwrap(object):
         return self.wsgi_app
 
 def fnum(n):
+    if isinstance(n, basestring) and '.' in n:
+        # Used as a Mako filter we get the text of the number
+        n = float(n)
+    if isinstance(n, float):
+        # Weighted counts (see vaineye.sampling) aren't whole numbers
+        n = int(round(n))
     n = ''.join(reversed(str(n)))
     return ''.join(reversed(','.join(
         [n[i:i+3] for i in range(0, len(n), 3)])))
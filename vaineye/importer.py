@@ -3,10 +3,18 @@ Imports Apache log files
 """
 import optparse
 import sys
+import time
+from collections import deque
 from vaineye.model import RequestTracker
+from vaineye.checkpoints import fingerprint
+from vaineye.logformat import LogParser, formats
+from vaineye.follow import LogFollower
+from vaineye import apachelog
 
 parser = optparse.OptionParser(
-    usage='%prog [OPTIONS] DB_CONNECTION < apache/access.log'
+    usage='%prog [OPTIONS] DB_CONNECTION [LOG_FILE...] < apache/access.log\n\n'
+    'LOG_FILEs may be compressed with gzip (.gz) or bzip2 (.bz2).  Each is\n'
+    'imported from where the last import of it stopped.'
     )
 parser.add_option(
     '-H', '--host',
@@ -28,8 +36,58 @@ parser.add_option(
 parser.add_option(
     '-b', '--batch',
     metavar='COUNT',
-    help='The number of entries to insert at once',
-    default='240000')
+    help='The number of entries to insert at once (default 240000, or '
+    '1000 with --follow)')
+
+parser.add_option(
+    '--normalized',
+    action='store_true',
+    help='Create the tables with the normalized schema (an existing '
+    'normalized schema is used without this)')
+
+parser.add_option(
+    '--index-profile',
+    metavar='PROFILE',
+    help='The indexes to create the tables with (see vaineye-indexes; '
+    'default "default")',
+    default='default')
+
+parser.add_option(
+    '--partition',
+    metavar='month|week|day',
+    help='Create a table for each month, week or day (existing '
+    'partitions are used without this)')
+
+parser.add_option(
+    '--rollups',
+    action='store_true',
+    help='Start keeping hourly counts for the summaries (they are kept '
+    'without this once started)')
+
+parser.add_option(
+    '-f', '--log-format',
+    metavar='FORMAT',
+    help='The Apache LogFormat or nginx log_format of the logs, or one '
+    'of: ' + ', '.join(sorted(formats)) + ' (default: combined)')
+
+parser.add_option(
+    '-j', '--jobs',
+    metavar='N',
+    help='Parse with N processes (default 1)',
+    default='1')
+
+parser.add_option(
+    '--follow',
+    action='store_true',
+    help='Keep reading the LOG_FILEs as they are written (and rotated), '
+    'until interrupted')
+
+parser.add_option(
+    '--flush-interval',
+    metavar='SECONDS',
+    help='With --follow, the longest to wait before writing what has '
+    'been read (default 5)',
+    default='5')
 
 def main(args=None, stdin=sys.stdin):
     if args is None:
@@ -37,17 +95,68 @@ def main(args=None, stdin=sys.stdin):
     options, args = parser.parse_args(args)
     if len(args) < 1:
         parser.error('You must give a DB_CONNECTION string')
-    insert_count = int(options.batch)
-    request_tracker = RequestTracker(args[0], options.table_prefix)
+    if options.follow and not args[1:]:
+        parser.error('You must give the LOG_FILEs to --follow')
+    if options.batch:
+        insert_count = int(options.batch)
+    elif options.follow:
+        insert_count = 1000
+    else:
+        insert_count = 240000
+    if options.log_format:
+        try:
+            LogParser(options.log_format)
+        except ValueError, e:
+            parser.error(str(e))
+    request_tracker = RequestTracker(args[0], options.table_prefix,
+                                     normalized=options.normalized or None,
+                                     index_profile=options.index_profile,
+                                     partition=options.partition,
+                                     rollups=options.rollups or None)
+    if options.follow:
+        follower = LogFollower(
+            request_tracker, args[1:], batch_size=insert_count,
+            flush_interval=float(options.flush_interval),
+            default_scheme=options.scheme, default_host=options.host,
+            log_format=options.log_format)
+        follower.run()
+        return
+    start_time = time.time()
+    jobs = int(options.jobs)
+    if jobs > 1 or args[1:] or options.log_format:
+        importer = ParallelImporter(
+            request_tracker, jobs=jobs, batch_size=insert_count,
+            default_scheme=options.scheme, default_host=options.host,
+            log_format=options.log_format)
+        if args[1:]:
+            for filename in args[1:]:
+                importer.import_file(filename)
+        else:
+            importer.import_stream(stdin)
+        importer.close()
+        lines = importer.lines
+    else:
+        lines = import_serial(request_tracker, stdin, insert_count,
+                              options.scheme, options.host)
+    seconds = time.time() - start_time
+    print 'done: %s lines in %.1f sec (%d lines/sec).' % (
+        lines, seconds, lines / max(seconds, 0.001))
+
+def import_serial(request_tracker, stdin, insert_count, default_scheme,
+                  default_host):
+    """Imports lines from `stdin` one at a time in this process,
+    returning the number of lines"""
+    lines = 0
     done = False
     while not done:
         done = True
         for index, line in enumerate(stdin):
+            lines += 1
             try:
                 request_tracker.import_apache_line(
                     line,
-                    default_host=options.host,
-                    default_scheme=options.scheme)
+                    default_host=default_host,
+                    default_scheme=default_scheme)
             except ValueError, e:
                 print >> sys.stdout, str(e)
             if not index % 1000:
@@ -66,12 +175,181 @@ def main(args=None, stdin=sys.stdin):
                 sys.stdout.write('write...')
                 sys.stdout.flush()
         request_tracker.write_pending(writer)
+        rate = request_tracker.stats()['rows_per_second']
+        if rate:
+            sys.stdout.write(' %d rows/sec\n' % rate)
+            sys.stdout.flush()
         if not done:
             sys.stdout.write('\ncontinuing...')
             sys.stdout.flush()
             import gc
             gc.collect()
-    print 'done.'
+    return lines
+
+class ParallelImporter(object):
+    """Parses log files in a pool of `jobs` processes, and writes what
+    they parse from this process
+
+    Files are split into chunks at line boundaries (see
+    `vaineye.apachelog.split_file`); each worker parses a chunk and
+    sends back the requests packed together.  Compressed files (and
+    streams) are read here and handed out in blocks of lines.  The
+    requests are written `batch_size` at a time, along with how far
+    each file has got (see `vaineye.checkpoints`).  Lines are in
+    `log_format` if it is given (see `vaineye.logformat`).
+    """
+
+    # Lines of a stream (which can't be split up front) per chunk:
+    stream_chunk_lines = 20000
+
+    def __init__(self, request_tracker, jobs=1, batch_size=100000,
+                 default_scheme='http', default_host='localhost',
+                 log_format=None):
+        self.request_tracker = request_tracker
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.default_scheme = default_scheme
+        self.default_host = default_host
+        self.log_format = log_format
+        self.lines = 0
+        self.errors = 0
+        self._pending = 0
+        # {fingerprint: (filename, offset, lines)} to record with the
+        # next write:
+        self._checkpoints = {}
+        if jobs > 1:
+            import multiprocessing
+            self.pool = multiprocessing.Pool(jobs)
+        else:
+            self.pool = None
+
+    def _map(self, calls):
+        """Yields ``(tag, func(*args))`` for each ``(tag, (func,
+        args))`` of `calls`, in order
+
+        Only a few chunks are handed to the pool ahead of the one
+        being written, so a large file is never all in memory.
+        """
+        if self.pool is None:
+            for tag, (func, args) in calls:
+                yield tag, func(*args)
+            return
+        waiting = deque()
+        for tag, (func, args) in calls:
+            waiting.append((tag, self.pool.apply_async(func, args)))
+            if len(waiting) > self.jobs * 2:
+                tag, result = waiting.popleft()
+                yield tag, result.get()
+        while waiting:
+            tag, result = waiting.popleft()
+            yield tag, result.get()
+
+    def import_file(self, filename):
+        """Imports `filename` (which may be compressed) from where the
+        last import of it stopped"""
+        f = apachelog.open_log(filename)
+        try:
+            first_line = f.readline()
+            if not first_line:
+                return
+            key = fingerprint(first_line)
+            offset, lines = self.request_tracker.import_checkpoint(key)
+            if lines:
+                print '%s: resuming after line %s' % (filename, lines)
+            if apachelog.is_compressed(filename):
+                f.seek(offset)
+                chunks = self._stream_chunks(f, offset)
+            else:
+                chunks = [
+                    (end, (apachelog.parse_range, (
+                        filename, start, end,
+                        self.default_scheme, self.default_host,
+                        self.log_format)))
+                    for start, end in apachelog.split_file(filename,
+                                                           start=offset)]
+                if not chunks:
+                    print '%s: already imported' % filename
+                    return
+            self._add_results(chunks, (key, filename, lines))
+        finally:
+            f.close()
+
+    def import_stream(self, stream):
+        self._add_results(self._stream_chunks(stream, 0), None)
+
+    def _stream_chunks(self, stream, offset):
+        """Yields ``(offset, (func, args))`` for blocks of lines of
+        `stream`, with the offset after each block"""
+        for lines in _line_chunks(stream, self.stream_chunk_lines):
+            offset += sum([len(line) for line in lines])
+            yield offset, (apachelog.parse_lines, (
+                lines, self.default_scheme, self.default_host,
+                self.log_format))
+
+    def _add_results(self, chunks, checkpoint):
+        """Adds the requests parsed from `chunks` (``(offset, (func,
+        args))``), recording the offset of each with the
+        ``(fingerprint, filename, lines)`` of `checkpoint`"""
+        add_record = self.request_tracker.add_record
+        if checkpoint is not None:
+            key, filename, lines = checkpoint
+        for offset, (packed, count, errors) in self._map(chunks):
+            for error in errors:
+                print >> sys.stdout, error
+            for request in apachelog.unpack_requests(packed):
+                add_record(request)
+            self.lines += count + len(errors)
+            self.errors += len(errors)
+            self._pending += count
+            if checkpoint is not None:
+                lines += count + len(errors)
+                self._checkpoints[key] = (filename, offset, lines)
+            sys.stdout.write('.')
+            sys.stdout.flush()
+            if self._pending >= self.batch_size:
+                self.write()
+
+    def write(self):
+        sys.stdout.write('writing db...')
+        sys.stdout.flush()
+        checkpoints = self._checkpoints
+        self._checkpoints = {}
+        def record_checkpoints(conn):
+            for key, (filename, offset, lines) in checkpoints.items():
+                self.request_tracker.checkpoints.set(
+                    conn, key, filename, offset, lines)
+        try:
+            self.request_tracker.write_pending(
+                before_commit=record_checkpoints)
+        except:
+            # The requests are written again by the next import
+            self.request_tracker.discard_pending()
+            raise
+        self._pending = 0
+        rate = self.request_tracker.stats()['rows_per_second']
+        if rate:
+            sys.stdout.write(' %d rows/sec\n' % rate)
+        else:
+            sys.stdout.write('\n')
+        sys.stdout.flush()
+
+    def close(self):
+        if self._pending or self._checkpoints:
+            self.write()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+def _line_chunks(stream, count):
+    while True:
+        lines = []
+        for line in stream:
+            lines.append(line)
+            if len(lines) >= count:
+                break
+        if not lines:
+            return
+        yield lines
 
 def first_lines(stream, count):
     for i in xrange(count):
@@ -0,0 +1,168 @@
+"""
+Index profiles for the requests table, and a command to apply them
+
+Every index on the requests table is kept up to date on every insert,
+so which indexes to have is a trade between how fast requests can be
+written and how fast they can be queried:
+
+``write-optimized``
+    Only ``date`` and ``(date, response_code)``, which is all the
+    summaries use.
+
+``default``
+    An index on each of the columns that were always indexed.
+
+``ad-hoc``
+    The default indexes, plus composite indexes for looking at paths
+    and referrers over time (and the ids of the normalized schema).
+
+Indexes are named ``ix_<table>_<column>[_<column>...]``.  A profile
+only decides the indexes of tables that are created; use
+``vaineye-indexes`` to change the indexes of an existing table.
+"""
+import optparse
+import sys
+import time
+from sqlalchemy import Index, inspect
+
+_default = [
+    ('date',), ('request_method',), ('scheme',), ('host',), ('path',),
+    ('referrer',), ('response_code',), ('content_type',),
+    ('ip_country_code',), ('ip_city',), ('ip_postal_code',), ('ip_state',),
+    ]
+
+profiles = {
+    'write-optimized': [('date',), ('date', 'response_code')],
+    'default': _default,
+    'ad-hoc': _default + [
+        ('date', 'response_code'), ('path', 'date'), ('referrer', 'date'),
+        ('host_id',), ('path_id',), ('referrer_id',), ('content_type_id',),
+        ('location_id',)],
+    }
+
+def index_name(table, columns):
+    return 'ix_%s_%s' % (table.name, '_'.join(columns))
+
+def profile_indexes(table, profile):
+    """Returns ``[(name, columns)]`` of the indexes `profile` gives
+    `table`; indexes on columns the table doesn't have are left out"""
+    if profile not in profiles:
+        raise ValueError(
+            'Bad index profile %r (should be one of %s)'
+            % (profile, ', '.join(sorted(profiles))))
+    result = []
+    for columns in profiles[profile]:
+        for name in columns:
+            if name not in table.c:
+                break
+        else:
+            result.append((index_name(table, columns), columns))
+    return result
+
+def add_profile_indexes(table, profile):
+    """Adds the indexes of `profile` to `table` (to be created along
+    with it)"""
+    for name, columns in profile_indexes(table, profile):
+        Index(name, *[table.c[column] for column in columns])
+
+parser = optparse.OptionParser(
+    usage='%prog [OPTIONS] DB_CONNECTION [PROFILE]\n\n'
+    'Creates the indexes of PROFILE (one of: '
+    + ', '.join(sorted(profiles)) + ') that are missing.\n'
+    'Without PROFILE, lists the indexes there are.'
+    )
+parser.add_option(
+    '--table-prefix',
+    metavar='PREFIX',
+    help='The prefix to prepend on the table(s) created by the system',
+    default='')
+
+parser.add_option(
+    '--drop',
+    action='store_true',
+    help='Also drop the ix_* indexes that are not in PROFILE')
+
+parser.add_option(
+    '-n', '--dry-run',
+    action='store_true',
+    help="Show what would be done, but don't do it")
+
+def existing_indexes(engine, table):
+    """Returns ``{name: columns}`` of the non-unique indexes on
+    `table`"""
+    result = {}
+    for index in inspect(engine).get_indexes(table.name):
+        if not index.get('unique'):
+            result[index['name']] = tuple(index['column_names'])
+    return result
+
+def main(args=None):
+    from vaineye.model import RequestTracker
+    if args is None:
+        args = sys.argv[1:]
+    options, args = parser.parse_args(args)
+    if not args:
+        parser.error('You must give a DB_CONNECTION string')
+    request_tracker = RequestTracker(args[0], options.table_prefix)
+    if request_tracker.partition:
+        tables = [request_tracker.partition_table(partition.name)
+                  for partition in request_tracker.partitions()]
+    else:
+        tables = [request_tracker.insert_table]
+    for table in tables:
+        if len(tables) > 1:
+            print '%s:' % table.name
+        if len(args) < 2:
+            show_indexes(request_tracker.engine, table)
+        else:
+            apply_profile(request_tracker.engine, table, args[1],
+                          drop=options.drop, dry_run=options.dry_run)
+
+def show_indexes(engine, table):
+    existing = existing_indexes(engine, table)
+    for name in sorted(existing):
+        print '%s (%s)' % (name, ', '.join(existing[name]))
+    for profile in sorted(profiles):
+        wanted = profile_indexes(table, profile)
+        if dict(wanted) == existing:
+            print 'This is the %s profile' % profile
+
+def apply_profile(engine, table, profile, drop=False, dry_run=False):
+    existing = existing_indexes(engine, table)
+    wanted = profile_indexes(table, profile)
+    conn = engine.connect()
+    if engine.dialect.name in ('postgresql', 'postgres'):
+        # CONCURRENTLY can't be used in a transaction
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+    prefix = 'ix_%s_' % table.name
+    if drop:
+        wanted_names = set([name for name, columns in wanted])
+        for name in sorted(existing):
+            if name.startswith(prefix) and name not in wanted_names:
+                index = _make_index(table, name, existing[name])
+                _run('Dropping %s' % name, dry_run, index.drop, conn)
+    for name, columns in wanted:
+        if name in existing:
+            continue
+        index = _make_index(table, name, columns)
+        _run('Creating %s' % name, dry_run, index.create, conn)
+    conn.close()
+
+def _make_index(table, name, columns):
+    # Concurrently lets requests be written while PostgreSQL builds
+    # (or drops) the index
+    return Index(name, *[table.c[column] for column in columns],
+                 postgresql_concurrently=True)
+
+def _run(message, dry_run, func, conn):
+    sys.stdout.write(message + '...')
+    sys.stdout.flush()
+    if dry_run:
+        print ' (dry run)'
+        return
+    start = time.time()
+    func(conn)
+    print ' %.1f sec' % (time.time() - start)
+
+if __name__ == '__main__':
+    sys.exit(main())
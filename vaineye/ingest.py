@@ -0,0 +1,153 @@
+"""
+Daemon that receives request datagrams and writes them to the database
+
+See `vaineye.datagram` for the sending side.
+"""
+import optparse
+import os
+import socket
+import sys
+import time
+import traceback
+from vaineye.capture import unpack_request
+from vaineye.datagram import parse_sink
+from vaineye.model import RequestTracker
+
+parser = optparse.OptionParser(
+    usage='%prog [OPTIONS] DB_CONNECTION SINK\n\n'
+    'SINK is unix:/path/to/socket or udp://127.0.0.1:PORT'
+    )
+parser.add_option(
+    '--table-prefix',
+    metavar='PREFIX',
+    help='The prefix to prepend on the table(s) created by the system',
+    default='')
+
+parser.add_option(
+    '-b', '--batch',
+    metavar='COUNT',
+    help='Write after this many requests have been received (default 1000)',
+    default='1000')
+
+parser.add_option(
+    '-i', '--interval',
+    metavar='SECONDS',
+    help='Write at least this often (default 5)',
+    default='5')
+
+parser.add_option(
+    '--max-pending',
+    metavar='COUNT',
+    help='The most requests to hold while the database is unavailable '
+    '(default 1000000)',
+    default='1000000')
+
+parser.add_option(
+    '--normalized',
+    action='store_true',
+    help='Create the tables with the normalized schema (an existing '
+    'normalized schema is used without this)')
+
+parser.add_option(
+    '--partition',
+    metavar='month|week|day',
+    help='Create a table for each month, week or day (existing '
+    'partitions are used without this)')
+
+parser.add_option(
+    '--rollups',
+    action='store_true',
+    help='Start keeping hourly counts for the summaries (they are kept '
+    'without this once started)')
+
+class IngestServer(object):
+    """Receives datagrams on `sink` and writes them through
+    `request_tracker` in batches"""
+
+    # Bigger than any packed request we send:
+    max_datagram = 65536
+    # Room for bursts that arrive while a batch is being written:
+    receive_buffer = 8*1024*1024
+
+    def __init__(self, request_tracker, sink, batch_size=1000, interval=5):
+        self.request_tracker = request_tracker
+        self.batch_size = batch_size
+        self.interval = interval
+        self.bad_datagrams = 0
+        family, address = parse_sink(sink)
+        if family == socket.AF_UNIX and os.path.exists(address):
+            # Left from an earlier daemon
+            os.unlink(address)
+        self.socket = socket.socket(family, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                               self.receive_buffer)
+        self.socket.bind(address)
+
+    def serve_forever(self):
+        received = 0
+        last_write = time.time()
+        while True:
+            timeout = last_write + self.interval - time.time()
+            if timeout > 0:
+                if self.receive(timeout):
+                    received += 1
+                if received < self.batch_size:
+                    continue
+            self.write()
+            received = 0
+            last_write = time.time()
+
+    def receive(self, timeout):
+        """Waits up to `timeout` seconds for a datagram, and adds the
+        request in it; returns True if a request was added"""
+        self.socket.settimeout(timeout)
+        try:
+            data = self.socket.recv(self.max_datagram)
+        except socket.timeout:
+            return False
+        try:
+            request, end = unpack_request(data)
+        except Exception:
+            request = None
+        if request is None or end != len(data):
+            # Garbage, or cut short because it was too big:
+            self.bad_datagrams += 1
+            return False
+        self.request_tracker.add_record(request)
+        return True
+
+    def write(self):
+        """Write what has been received; if the database is
+        unavailable the requests are kept for the next write"""
+        try:
+            self.request_tracker.write_pending()
+        except Exception:
+            sys.stderr.write('Error writing vaineye requests:\n')
+            traceback.print_exc(file=sys.stderr)
+
+    def close(self):
+        self.write()
+        self.socket.close()
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    options, args = parser.parse_args(args)
+    if len(args) < 2:
+        parser.error('You must give a DB_CONNECTION string and SINK')
+    request_tracker = RequestTracker(args[0], options.table_prefix,
+                                     max_pending=int(options.max_pending),
+                                     normalized=options.normalized or None,
+                                     partition=options.partition,
+                                     rollups=options.rollups or None)
+    server = IngestServer(request_tracker, args[1],
+                          batch_size=int(options.batch),
+                          interval=float(options.interval))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
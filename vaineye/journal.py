@@ -0,0 +1,162 @@
+"""
+On-disk journal of captured requests waiting to be written
+
+With a journal, `vaineye.statuswatch.BackgroundFlusher` appends each
+captured request to a file (packed with
+`vaineye.capture.pack_request`) before anything else, and writes to
+the database from the file.  A request is only removed once the
+database has committed it: while the database is down requests pile
+up on disk rather than in memory, and if the process dies they are
+written by the next process that uses the same directory.
+
+Each process has its own journal file.  It starts with a header that
+holds the offset of the first request not yet committed; once
+everything has been committed the file is truncated back to the
+header.  A torn or zero-filled tail (left by a crash or a power loss)
+is cut off when it is read.
+"""
+import errno
+import glob
+import os
+import struct
+import time
+from vaineye.capture import pack_request, unpack_request, min_packed_size
+
+_magic = 'VEJN'
+_version = 1
+# magic, version, committed offset:
+_header = struct.Struct('<4sHxxQ')
+_length = struct.Struct('<I')
+
+class Journal(object):
+    """One journal file
+
+    Appends are buffered and synced to disk every `sync_count`
+    requests or `sync_interval` seconds, whichever comes first (and
+    before anything is read back).  Only one thread should use a
+    journal.
+    """
+
+    def __init__(self, filename, sync_count=100, sync_interval=1.0):
+        self.filename = filename
+        self.sync_count = sync_count
+        self.sync_interval = sync_interval
+        if os.path.exists(filename):
+            self._file = open(filename, 'r+b')
+            header = self._file.read(_header.size)
+            if len(header) < _header.size:
+                # Created but the header was never written
+                self._write_header(_header.size)
+            else:
+                magic, version, committed = _header.unpack(header)
+                if magic != _magic or version != _version:
+                    raise ValueError(
+                        '%s is not a vaineye journal file' % filename)
+                self.committed = committed
+        else:
+            self._file = open(filename, 'w+b')
+            self._write_header(_header.size)
+        self._file.seek(0, 2)
+        self.end = self._file.tell()
+        self.appended = 0
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _write_header(self, committed):
+        self._file.seek(0)
+        self._file.write(_header.pack(_magic, _version, committed))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.committed = committed
+
+    @classmethod
+    def find_orphans(cls, journal_dir):
+        """The journal files in `journal_dir` of processes that are no
+        longer running"""
+        orphans = []
+        for filename in sorted(glob.glob(
+            os.path.join(journal_dir, 'vaineye-*.journal'))):
+            pid = os.path.basename(filename).split('-')[1].split('.')[0]
+            try:
+                os.kill(int(pid), 0)
+            except ValueError:
+                continue
+            except OSError, e:
+                if e.errno == errno.ESRCH:
+                    orphans.append(filename)
+        return orphans
+
+    def append(self, record):
+        """Adds one `CapturedRequest` to the end"""
+        data = pack_request(record)
+        self._file.seek(self.end)
+        self._file.write(data)
+        self.end += len(data)
+        self.appended += 1
+        self._unsynced += 1
+        if (self._unsynced >= self.sync_count
+            or time.time() - self._last_sync >= self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """Makes sure everything appended is on disk"""
+        if self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._unsynced = 0
+        self._last_sync = time.time()
+
+    def has_pending(self):
+        """True if there are requests that have not been committed"""
+        return self.committed < self.end
+
+    def read(self, limit=None):
+        """Reads the requests that have not been committed, up to
+        `limit` of them
+
+        Returns ``(requests, end)``; pass `end` to `commit` once the
+        requests are in the database.
+        """
+        self.sync()
+        self._file.seek(self.committed)
+        pos = self.committed
+        requests = []
+        while pos < self.end and (limit is None or len(requests) < limit):
+            prefix = self._file.read(_length.size)
+            if len(prefix) == _length.size:
+                length = _length.unpack(prefix)[0]
+            if (len(prefix) < _length.size or length < min_packed_size
+                or pos + length > self.end):
+                # Cut short or zeroed by a crash while it was written;
+                # nothing after this can be trusted
+                self._truncate(pos)
+                break
+            rest = self._file.read(length - _length.size)
+            request, next_pos = unpack_request(prefix + rest)
+            requests.append(request)
+            pos += length
+        return requests, pos
+
+    def _truncate(self, end):
+        self._file.flush()
+        self._file.truncate(end)
+        os.fsync(self._file.fileno())
+        self.end = end
+
+    def commit(self, end):
+        """Marks everything up to `end` as written to the database,
+        truncating the file if that is everything"""
+        if end >= self.end:
+            self._file.flush()
+            self._file.truncate(_header.size)
+            self.end = _header.size
+            end = _header.size
+        self._write_header(end)
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def remove(self):
+        self._file.close()
+        os.unlink(self.filename)
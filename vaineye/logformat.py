@@ -0,0 +1,289 @@
+"""
+Parsers for log files in any Apache ``LogFormat`` or nginx
+``log_format``
+
+A format string is compiled once into a regular expression that only
+captures the fields a request is made from; everything else in the
+line is matched with non-capturing groups.  For example::
+
+    parser = LogParser('%v %h %l %u %t "%r" %>s %b %D')
+    request = parser.parse(line)
+
+Apache formats use ``%`` directives and nginx formats use ``$``
+variables.  These are understood:
+
+=====================  ==========================  =====================
+Field                  Apache                      nginx
+=====================  ==========================  =====================
+IP address             ``%h``, ``%a``              ``$remote_addr``
+Date                   ``%t``                      ``$time_local``,
+                                                   ``$msec``
+Request line           ``%r``                      ``$request``
+Method                 ``%m``                      ``$request_method``
+Path and query string                              ``$request_uri``
+Path                   ``%U``                      ``$uri``
+Query string           ``%q``                      ``$args``
+Status                 ``%s``, ``%>s``             ``$status``
+Bytes                  ``%b``, ``%B``,             ``$body_bytes_sent``,
+                       ``%O``                      ``$bytes_sent``
+Referrer               ``%{Referer}i``             ``$http_referer``
+User-Agent             ``%{User-Agent}i``          ``$http_user_agent``
+Host                   ``%v``, ``%V``,             ``$host``,
+                       ``%{Host}i``                ``$server_name``,
+                                                   ``$http_host``
+Scheme                                             ``$scheme``
+Duration               ``%D``, ``%T``,             ``$request_time``
+                       ``%{ms}T``, ``%{us}T``
+=====================  ==========================  =====================
+
+Any other directive or variable is skipped.  The duration becomes the
+request's processing time.  Without a host or scheme field the
+defaults given to the parser are used.
+"""
+import re
+import mimetypes
+from datetime import datetime
+from vaineye.apachelog import parse_apache_time
+from vaineye.capture import CapturedRequest
+
+# Well-known formats, which can be given by name:
+formats = {
+    'common': '%h %l %u %t "%r" %>s %b',
+    'combined': '%h %l %u %t "%r" %>s %b "%{Referer}i" "%{User-Agent}i"',
+    'vhost_combined': ('%v:%p %h %l %u %t "%r" %>s %O "%{Referer}i" '
+                       '"%{User-Agent}i"'),
+    'nginx': ('$remote_addr - $remote_user [$time_local] "$request" '
+              '$status $body_bytes_sent "$http_referer" "$http_user_agent"'),
+    }
+
+# The field each directive fills in:
+_apache_fields = {
+    'h': 'ip', 'a': 'ip',
+    't': 'bracketed_date',
+    'r': 'request',
+    'm': 'method',
+    'U': 'path',
+    'q': 'query',
+    's': 'status',
+    'b': 'bytes', 'B': 'bytes', 'O': 'bytes',
+    'v': 'host', 'V': 'host',
+    'D': 'microseconds',
+    'T': 'seconds',
+    }
+
+_apache_braced_fields = {
+    ('referer', 'i'): 'referrer',
+    ('user-agent', 'i'): 'user_agent',
+    ('host', 'i'): 'host',
+    ('ms', 'T'): 'milliseconds',
+    ('us', 'T'): 'microseconds',
+    ('s', 'T'): 'seconds',
+    }
+
+_nginx_fields = {
+    'remote_addr': 'ip',
+    'time_local': 'date',
+    'msec': 'timestamp',
+    'request': 'request',
+    'request_method': 'method',
+    'request_uri': 'target',
+    'uri': 'path',
+    'args': 'args',
+    'status': 'status',
+    'body_bytes_sent': 'bytes',
+    'bytes_sent': 'bytes',
+    'http_referer': 'referrer',
+    'http_user_agent': 'user_agent',
+    'host': 'host',
+    'server_name': 'host',
+    'http_host': 'host',
+    'scheme': 'scheme',
+    'request_time': 'seconds',
+    }
+
+# Patterns for fields that can't just be "anything up to the next
+# character"; the request line is captured as two groups:
+_field_patterns = {
+    'bracketed_date': r'\[([^\]]*)\]',
+    'request': r'([A-Z]+)\s+(\S+)(?:\s+HTTP/[\d.]*)?',
+    'status': r'(\d{3})',
+    'bytes': r'(\d+|-)',
+    'microseconds': r'(\d+)',
+    'milliseconds': r'(\d+)',
+    'seconds': r'(\d+(?:\.\d*)?|-)',
+    'timestamp': r'(\d+(?:\.\d*)?)',
+    }
+
+# Fields that are parsed the same way as another:
+_group_names = {'bracketed_date': 'date', 'args': 'query'}
+
+_apache_directive_re = re.compile(
+    r'%(?:[<>]|!?\d{3}(?:,\d{3})*)?(?:\{([^}]*)\})?([a-zA-Z%])')
+_nginx_variable_re = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+
+def parse_format(format):
+    """Splits a format string into a list of literal strings and
+    ``(field,)`` tuples (field is None for fields that aren't used)"""
+    format = formats.get(format, format)
+    if _apache_directive_re.search(format):
+        return _split(format, _apache_directive_re, _apache_field)
+    return _split(format, _nginx_variable_re, _nginx_field)
+
+def _apache_field(match):
+    braced, letter = match.groups()
+    if letter == '%':
+        return '%'
+    if braced is not None:
+        return (_apache_braced_fields.get((braced.lower(), letter)),)
+    return (_apache_fields.get(letter),)
+
+def _nginx_field(match):
+    return (_nginx_fields.get(match.group(1) or match.group(2)),)
+
+def _split(format, regex, make_field):
+    parts = []
+    pos = 0
+    for match in regex.finditer(format):
+        if match.start() > pos:
+            parts.append(format[pos:match.start()])
+        parts.append(make_field(match))
+        pos = match.end()
+    if pos < len(format):
+        parts.append(format[pos:])
+    # Join up adjacent literals (from %%):
+    joined = []
+    for part in parts:
+        if isinstance(part, str) and joined and isinstance(joined[-1], str):
+            joined[-1] += part
+        else:
+            joined.append(part)
+    return joined
+
+class LogParser(object):
+    """Parses lines in one log format into `CapturedRequest` objects"""
+
+    def __init__(self, format, default_scheme='http',
+                 default_host='localhost'):
+        self.format = format
+        self.default_scheme = default_scheme
+        self.default_host = default_host
+        pattern = []
+        # {field: index in match.groups()}
+        self.groups = groups = {}
+        count = 0
+        parts = parse_format(format)
+        for index, part in enumerate(parts):
+            if isinstance(part, str):
+                pattern.append(re.escape(part))
+                continue
+            field = part[0]
+            if field in _field_patterns:
+                field_pattern = _field_patterns[field]
+            else:
+                # Anything up to the next literal character:
+                following = parts[index+1:index+2]
+                if following and isinstance(following[0], str):
+                    field_pattern = '([^%s]*)' % re.escape(following[0][0])
+                else:
+                    field_pattern = '(.*?)'
+            if field is None:
+                # Matched, but nothing is kept:
+                field_pattern = re.sub(r'\((?!\?)', '(?:', field_pattern)
+            elif field == 'request':
+                groups['method'] = count
+                groups['target'] = count + 1
+                count += 2
+            else:
+                groups[_group_names.get(field, field)] = count
+                count += 1
+            pattern.append(field_pattern)
+        self.regex = re.compile(''.join(pattern) + r'\s*$')
+        if 'date' not in groups and 'timestamp' not in groups:
+            raise ValueError(
+                'The log format %r has no date (%%t or $time_local)'
+                % format)
+        if 'target' not in groups and 'path' not in groups:
+            raise ValueError(
+                'The log format %r has no path (%%r, %%U, $request or $uri)'
+                % format)
+
+    def parse(self, line):
+        """Parses one line, raising ValueError if it can't be"""
+        match = self.regex.match(line)
+        if not match:
+            raise ValueError('Bad line, cannot parse: %r' % line)
+        values = match.groups()
+        groups = self.groups
+        get = groups.get
+        if 'date' in groups:
+            date, start_time = parse_apache_time(values[groups['date']])
+        else:
+            start_time = float(values[groups['timestamp']])
+            date = datetime.fromtimestamp(start_time)
+        index = get('target')
+        if index is not None:
+            path = values[index]
+            if '?' in path:
+                path, query_string = path.split('?', 1)
+            else:
+                query_string = ''
+        else:
+            query_string = ''
+        index = get('path')
+        if index is not None:
+            path = values[index]
+        index = get('query')
+        if index is not None:
+            query_string = values[index]
+            if query_string.startswith('?'):
+                query_string = query_string[1:]
+            elif query_string == '-':
+                query_string = ''
+        index = get('method')
+        method = values[index] if index is not None else 'GET'
+        index = get('ip')
+        ip = values[index] if index is not None else ''
+        index = get('status')
+        response_code = int(values[index]) if index is not None else 200
+        index = get('bytes')
+        if index is None or values[index] == '-':
+            response_bytes = 0
+        else:
+            response_bytes = int(values[index])
+        referrer = user_agent = ''
+        index = get('referrer')
+        if index is not None:
+            referrer = values[index]
+            if referrer == '-':
+                referrer = ''
+        index = get('user_agent')
+        if index is not None:
+            user_agent = values[index]
+        index = get('host')
+        host = values[index] if index is not None else self.default_host
+        index = get('scheme')
+        scheme = values[index] if index is not None else self.default_scheme
+        end_time = duration = None
+        for field, scale in (('seconds', 1.0), ('milliseconds', 1e-3),
+                             ('microseconds', 1e-6)):
+            index = get(field)
+            if index is not None and values[index] != '-':
+                duration = float(values[index]) * scale
+        if duration is not None:
+            end_time = start_time + duration
+        content_type, encoding = mimetypes.guess_type(path)
+        return CapturedRequest(
+            ip, date, start_time, end_time, method, scheme, host, path,
+            query_string, user_agent, referrer, response_code,
+            response_bytes, content_type)
+
+# Parsers by (format, default_scheme, default_host), so each process
+# compiles a format once:
+_parsers = {}
+
+def get_parser(format, default_scheme='http', default_host='localhost'):
+    """Returns the `LogParser` function for `format`"""
+    key = (format, default_scheme, default_host)
+    if key not in _parsers:
+        _parsers[key] = LogParser(format, default_scheme, default_host).parse
+    return _parsers[key]
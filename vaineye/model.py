@@ -1,15 +1,17 @@
 """
 Model that stores and retrieves the requests from the database
 """
-import time
 import urlparse
-from datetime import datetime, timedelta
-import re
+import random
+import threading
+from collections import deque
+from datetime import datetime
 import os
-import mimetypes
 from sqlalchemy import MetaData, Table
 from sqlalchemy import Column, Integer, String, Text, DateTime, Float
 from sqlalchemy import create_engine, select, and_, alias, func
+from sqlalchemy import inspect, event
+from sqlalchemy.sql.visitors import replacement_traverse
 try:
     import pygeoip
 except ImportError:
@@ -20,47 +22,285 @@ else:
     geo_ip = pygeoip.GeoIP(os.path.join(os.path.dirname(__file__),
                                         'GeoLiteCity.dat'))
                         
-from vaineye.ziptostate import zip_to_state
+from vaineye.geolocate import GeoLocator
+from vaineye.capture import capture_request
+from vaineye.dimensions import Dimension
+from vaineye.bulkload import make_writer, BulkWriteError
+from vaineye.indexes import add_profile_indexes
+from vaineye import partitions
+from vaineye.aggregates import Aggregates, Rollups
+from vaineye.aggregates import count_requests, hour_start
+from vaineye.checkpoints import Checkpoints
+from vaineye.apachelog import parse_apache_line
 
 class RequestTracker(object):
     """Instances of ths track requests, both storing and fetching"""
 
-    def __init__(self, db, table_prefix=''):
-        """Instantiate with the SQLAlchemy database connection string"""
+    overflow_policies = ('drop-oldest', 'drop-newest', 'sample')
+
+    def __init__(self, db, table_prefix='', max_pending=None,
+                 overflow='drop-oldest', overflow_sample_rate=0.1,
+                 geoip_cache_size=10000, geoip_cache_by_prefix=False,
+                 normalized=None, bulk_writer=None, insert_chunk_size=None,
+                 index_profile='default', partition=None, fetch_size=1000,
+                 rollups=None):
+        """Instantiate with the SQLAlchemy database connection string
+
+        `max_pending` is the most requests that will be buffered
+        waiting for `write_pending` (None means no limit).  When the
+        buffer is full, `overflow` decides what is lost:
+        ``'drop-oldest'`` makes room by discarding the oldest buffered
+        request, ``'drop-newest'`` discards the new one, and
+        ``'sample'`` keeps the new request (in place of the oldest)
+        only `overflow_sample_rate` of the time.  What is lost is
+        counted in `stats()`.
+
+        GeoIP locations of the last `geoip_cache_size` addresses (or
+        networks, with `geoip_cache_by_prefix`) are remembered; see
+        `vaineye.geolocate.GeoLocator`.
+
+        If `normalized` is true the requests are stored in the
+        normalized schema: the host, path, user agent, referrer,
+        content type and location are kept once each in their own
+        tables, and each request row holds only their ids (see
+        `vaineye.dimensions`).  `table` is then a query that joins
+        these back together, with the same columns as the plain
+        table.  If `normalized` is None the normalized schema is used
+        if its tables exist already.
+
+        Rows are inserted by the `bulk_writer` (``'executemany'``,
+        ``'values'`` or ``'copy'``; by default the best one for the
+        database), `insert_chunk_size` rows per transaction; see
+        `vaineye.bulkload`.
+
+        If the requests table has to be created, it gets the indexes
+        of `index_profile` (see `vaineye.indexes`).
+
+        If `partition` is ``'month'``, ``'week'`` or ``'day'`` the
+        requests are written to a separate table for each month (etc.)
+        instead of one table; see `vaineye.partitions`.  `table` then
+        has no rows of its own, but queries written against it are
+        run on each partition that overlaps the query's date range.
+        If `partition` is None the table is partitioned if there are
+        partitions already.  The normalized schema can't be
+        partitioned.  Requests already in a plain table when
+        partitioning is turned on stay there, and are still read (and
+        compacted) along with the partitions.
+
+        `requests` and `grouped_requests` stream their results from
+        the database (with a server-side cursor where the driver has
+        one), `fetch_size` rows at a time.
+
+        If `rollups` is true, hourly counts for the summaries are kept
+        up to date as requests are written (see
+        `vaineye.aggregates.Rollups`).  If it is None they are kept if
+        they have been started already.
+        """
+        if overflow not in self.overflow_policies:
+            raise ValueError(
+                'Bad overflow policy %r (should be one of %s)'
+                % (overflow, ', '.join(self.overflow_policies)))
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.overflow_sample_rate = overflow_sample_rate
+        self.fetch_size = fetch_size
+        self.geo_locator = GeoLocator(geo_ip, cache_size=geoip_cache_size,
+                                      cache_by_prefix=geoip_cache_by_prefix)
         self.engine = create_engine(db, pool_recycle=3600)
+        if self.engine.dialect.name == 'sqlite':
+            _sqlite_transactions(self.engine)
         self.sql_metadata = MetaData()
-        self.table = Table(
-            table_prefix+'requests', self.sql_metadata,
+        if normalized is None:
+            normalized = self.engine.has_table(table_prefix+'request_facts')
+        self.normalized = normalized
+        self.table_name = table_prefix+'requests'
+        if partition is None and not normalized:
+            found = self.partitions()
+            if found:
+                partition = found[-1].kind
+        if partition is not None and partition not in partitions.kinds:
+            raise ValueError(
+                'Bad partition %r (should be one of %s)'
+                % (partition, ', '.join(sorted(partitions.kinds))))
+        if partition and normalized:
+            raise ValueError('The normalized schema cannot be partitioned')
+        self.partition = partition
+        self.index_profile = index_profile
+        self._writer_options = dict(name=bulk_writer,
+                                    chunk_size=insert_chunk_size)
+        if partition:
+            # Only used to write queries; never created:
+            self.table = Table(self.table_name, MetaData(),
+                               *self._request_columns())
+            self.insert_table_columns = self.insert_columns
+            self.writer = None
+            self._partition_writers = {}
+            # Written to before the requests were partitioned:
+            self.unpartitioned = self.engine.has_table(self.table_name)
+        else:
+            if normalized:
+                self._make_normalized_tables(table_prefix)
+            else:
+                self.table = Table(
+                    self.table_name, self.sql_metadata,
+                    *self._request_columns())
+                self.insert_table = self.table
+                self.insert_table_columns = self.insert_columns
+            add_profile_indexes(self.insert_table, index_profile)
+            self.table_insert = self.insert_table.insert()
+            self.writer = make_writer(
+                self.engine, self.insert_table, self.insert_table_columns,
+                **self._writer_options)
+        # Counts of requests that have been compacted:
+        self.aggregates = Aggregates(self.sql_metadata, table_prefix)
+        self.checkpoints = Checkpoints(self.sql_metadata, table_prefix)
+        if rollups is None:
+            rollups = self.engine.has_table(table_prefix+'requests_rollups')
+        if rollups:
+            self.rollups = Rollups(self.sql_metadata, table_prefix)
+        else:
+            self.rollups = None
+        self.sql_metadata.create_all(self.engine)
+        if not partition:
+            self.add_missing_columns(self.insert_table)
+        elif self.unpartitioned:
+            self.add_missing_columns(self.table)
+        if self.rollups is not None:
+            conn = self.engine.connect()
+            try:
+                self.rollups.start(conn)
+            finally:
+                conn.close()
+        # Request threads append to the right, write_pending pops from
+        # the left; both are atomic, so neither side takes a lock:
+        self._pending = deque()
+        self._local = threading.local()
+        self._counters = []
+        self._counters_lock = threading.Lock()
+        self.flushed = 0
+        self.flush_dropped = 0
+
+    def _request_columns(self):
+        """The columns of the plain requests table"""
+        return [
             Column('id', Integer, primary_key=True),
             Column('ip', String(15)),
-            Column('date', DateTime, index=True),
+            Column('date', DateTime),
             Column('processing_time', Float),
-            Column('request_method', String(15), index=True),
-            Column('scheme', String(10), index=True),
-            Column('host', String(100), index=True),
-            Column('path', String(250), index=True),
+            Column('time_to_first_byte', Float),
+            Column('request_method', String(15)),
+            Column('scheme', String(10)),
+            Column('host', String(100)),
+            Column('path', String(250)),
             Column('query_string', String(250)),
             Column('user_agent', Text),
-            Column('referrer', String(250), index=True),
-            Column('response_code', Integer, index=True),
+            Column('referrer', String(250)),
+            Column('response_code', Integer),
             Column('response_bytes', Integer),
-            Column('content_type', String(200), index=True),
-            Column('ip_country_code', String(100), index=True),
+            Column('content_type', String(200)),
+            Column('sample_weight', Float),
+            Column('ip_country_code', String(100)),
             Column('ip_country_code3', String(100)), # ?
             Column('ip_country_name', String(100)), # Redundant?
             Column('ip_region', String(150)),
-            Column('ip_city', String(250), index=True),
-            Column('ip_postal_code', String(50), index=True),
+            Column('ip_city', String(250)),
+            Column('ip_postal_code', String(50)),
             Column('ip_latitude', Float), # String?
             Column('ip_longitude', Float), # String?
             Column('ip_dma_code', Integer), # ?
             Column('ip_area_code', Integer),
             ## FIXME: redundant with ip_region:
-            Column('ip_state', String(2), index=True),
-            )
-        self.table_insert = self.table.insert()
-        self.sql_metadata.create_all(self.engine)
-        self._pending = []
+            Column('ip_state', String(2)),
+            ]
+
+    # Columns added to the requests table since it was first
+    # released, which tables created before then won't have:
+    added_columns = ('time_to_first_byte', 'sample_weight')
+
+    def add_missing_columns(self, table):
+        """Adds any of the `added_columns` that `table` doesn't have
+        (``create_all`` leaves existing tables alone)"""
+        def existing():
+            return set([column['name'] for column in
+                        inspect(self.engine).get_columns(table.name)])
+        missing = [name for name in self.added_columns
+                   if name in table.c and name not in existing()]
+        if not missing:
+            return
+        dialect = self.engine.dialect
+        preparer = dialect.identifier_preparer
+        for name in missing:
+            column = table.c[name]
+            try:
+                self.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+                    preparer.format_table(table),
+                    preparer.format_column(column),
+                    column.type.compile(dialect=dialect)))
+            except Exception:
+                # Another process may have just added it
+                if name not in existing():
+                    raise
+
+    # In the normalized schema, the columns kept in dimension tables,
+    # with the name of each table (after the table prefix):
+    dimension_columns = (
+        ('request_hosts', ('host',)),
+        ('request_paths', ('path',)),
+        ('request_user_agents', ('user_agent',)),
+        ('request_referrers', ('referrer',)),
+        ('request_content_types', ('content_type',)),
+        ('request_locations', (
+            'ip_country_code', 'ip_country_code3', 'ip_country_name',
+            'ip_region', 'ip_city', 'ip_postal_code', 'ip_latitude',
+            'ip_longitude', 'ip_dma_code', 'ip_area_code', 'ip_state')),
+        )
+
+    def _make_normalized_tables(self, table_prefix):
+        """Sets up the tables of the normalized schema, and `table` as
+        a query over them"""
+        columns = self._request_columns()
+        by_name = dict((column.name, column) for column in columns)
+        in_dimension = {}
+        self.dimensions = []
+        id_columns = []
+        for table_name, names in self.dimension_columns:
+            dimension = Dimension(
+                table_prefix+table_name, self.sql_metadata,
+                [Column(name, by_name[name].type) for name in names])
+            id_name = '%s_id' % table_name[len('request_'):-1]
+            id_columns.append(Column(id_name, Integer))
+            self.dimensions.append(
+                (dimension, [self.insert_columns.index(name)
+                             for name in names]))
+            for name in names:
+                in_dimension[name] = dimension
+        fact_columns = [
+            column for column in columns if column.name not in in_dimension]
+        facts = Table(table_prefix+'request_facts', self.sql_metadata,
+                      *(fact_columns + id_columns))
+        self.insert_table = facts
+        self.insert_table_columns = tuple(
+            [name for name in self.insert_columns
+             if name not in in_dimension]
+            + [column.name for column in id_columns])
+        self._fact_indexes = [
+            self.insert_columns.index(name)
+            for name in self.insert_table_columns
+            if name in self.insert_columns]
+        joined = facts
+        for (dimension, indexes), id_column in zip(self.dimensions,
+                                                   id_columns):
+            joined = joined.outerjoin(
+                dimension.table,
+                facts.c[id_column.name] == dimension.table.c.id)
+        selected = []
+        for column in columns:
+            if column.name in in_dimension:
+                selected.append(in_dimension[column.name].table.c[column.name])
+            else:
+                selected.append(facts.c[column.name])
+        self.table = select(selected, from_obj=[joined]).alias(
+            table_prefix+'requests')
 
     def add_request(self, environ, start_time, end_time,
                     status, response_headers):
@@ -71,104 +311,448 @@ class RequestTracker(object):
         pending list; `write_pending` writes from this list and should
         be called periodically and at process exit.
         """
-        request = {
-            'REMOTE_ADDR': environ['REMOTE_ADDR'],
-            'vaineye.date': datetime.now(),
-            'vaineye.start_time': time.time(),
-            'REQUEST_METHOD': environ['REQUEST_METHOD'],
-            'wsgi.url_scheme': environ['wsgi.url_scheme'],
-            'HTTP_HOST': environ.get('HTTP_HOST', ''),
-            'SCRIPT_NAME': environ.get('SCRIPT_NAME', ''),
-            'PATH_INFO': environ.get('PATH_INFO', ''),
-            'QUERY_STRING': environ.get('QUERY_STRING', ''),
-            'HTTP_USER_AGENT': environ.get('HTTP_USER_AGENT', ''),
-            'HTTP_REFERER': environ.get('HTTP_REFERER', ''),
-            }
-        request['vaineye.response_code'] = int(status.split(None, 1)[0])
-        for header_name, header_value in response_headers:
-            header_name = header_name.lower()
-            if header_name == 'content-length':
-                request['vaineye.response_bytes'] = int(header_value)
-            elif header_name == 'content-type':
-                request['vaineye.content_type'] = header_value
-        request['vaineye.end_time'] = time.time()
-        ## FIXME: should I just be creating SQLAlchemy bound inserts
-        ## that I can execute later?
-        self._pending.append(request)
-
-    def write_pending(self, callback=None):
-        """Write all the pending requests added by `add_request`"""
-        conn = self.engine.connect()
-        total = len(self._pending)
-        all_values = []
-        for index, request in enumerate(self._pending):
+        self.add_record(capture_request(
+            environ, start_time, end_time, status, response_headers))
+
+    def add_record(self, request):
+        """Adds a `vaineye.capture.CapturedRequest` to the pending
+        list"""
+        try:
+            counters = self._local.counters
+        except AttributeError:
+            counters = self._thread_counters()
+        counters.captured += 1
+        pending = self._pending
+        if self.max_pending is not None and len(pending) >= self.max_pending:
+            if (self.overflow == 'drop-newest'
+                or (self.overflow == 'sample'
+                    and random.random() >= self.overflow_sample_rate)):
+                counters.dropped += 1
+                return
+            try:
+                pending.popleft()
+            except IndexError:
+                # write_pending emptied it in the meantime
+                pass
+            else:
+                counters.dropped += 1
+        pending.append(request)
+
+    def _thread_counters(self):
+        """Creates the counters for the current thread; each thread
+        only ever increments its own"""
+        counters = self._local.counters = CaptureCounters()
+        self._counters_lock.acquire()
+        try:
+            self._counters.append(counters)
+        finally:
+            self._counters_lock.release()
+        return counters
+
+    def stats(self):
+        """Returns a dictionary of counters:
+
+        ``captured``: requests given to `add_record`
+        ``flushed``: requests written to the database
+        ``dropped``: requests discarded because the buffer was full
+        ``pending``: requests waiting to be written
+        ``rows_per_second``: the insert rate of the last write
+        """
+        self._counters_lock.acquire()
+        try:
+            all_counters = list(self._counters)
+        finally:
+            self._counters_lock.release()
+        captured = dropped = 0
+        for counters in all_counters:
+            captured += counters.captured
+            dropped += counters.dropped
+        return dict(captured=captured,
+                    flushed=self.flushed,
+                    dropped=dropped + self.flush_dropped,
+                    pending=len(self._pending),
+                    rows_per_second=self.writer and self.writer.last_rate)
+
+    def capture_request(self, environ, start_time, end_time,
+                        status, response_headers):
+        """Creates the record for one request, without adding it to
+        the pending list
+
+        The record holds only what is needed from `environ`, so it
+        can be handed to another thread and added there with
+        `add_record`.
+        """
+        return capture_request(
+            environ, start_time, end_time, status, response_headers)
+
+    # The order of the values in the rows that `request_row` creates:
+    insert_columns = (
+        'ip', 'date', 'processing_time', 'time_to_first_byte',
+        'request_method', 'scheme', 'host', 'path', 'query_string',
+        'user_agent', 'referrer', 'response_code', 'response_bytes',
+        'content_type', 'sample_weight',
+        'ip_country_code', 'ip_country_code3', 'ip_country_name',
+        'ip_region', 'ip_city', 'ip_postal_code', 'ip_latitude',
+        'ip_longitude', 'ip_dma_code', 'ip_area_code', 'ip_state')
+
+    # The keys of a GeoIP record, in the order of the ip_* columns:
+    location_fields = (
+        'country_code', 'country_code3', 'country_name', 'region',
+        'city', 'postal_code', 'latitude', 'longitude', 'dma_code',
+        'area_code', 'state')
+
+    _empty_location = (None,) * len(location_fields)
+
+    def request_row(self, request):
+        """Turns a `CapturedRequest` into a tuple of parameters, in the
+        order of `insert_columns`"""
+        if request.end_time and request.start_time:
+            processing_time = request.end_time - request.start_time
+        else:
+            processing_time = None
+        if request.first_byte_time and request.start_time:
+            time_to_first_byte = request.first_byte_time - request.start_time
+        else:
+            time_to_first_byte = None
+        date = request.date
+        if not date:
+            date = datetime.fromtimestamp(request.start_time)
+        row = (
+            _decode(request.ip), date, processing_time, time_to_first_byte,
+            request.method,
+            _decode(request.scheme), _decode(request.host),
+            ## urllib.quote?:
+            _decode(request.path), _decode(request.query_string),
+            _decode(request.user_agent), _decode(request.referrer),
+            request.response_code, request.response_bytes,
+            _decode(request.content_type), request.sample_weight)
+        location = request.ip_location
+        if location:
+            values = []
+            for name in self.location_fields:
+                value = location.get(name)
+                if isinstance(value, str):
+                    try:
+                        ## FIXME: right encoding?
+                        value = value.decode('latin1')
+                    except UnicodeDecodeError, e:
+                        raise ValueError("Bad item: %r, %s" % (value, e))
+                values.append(value)
+            row += tuple(values)
+        else:
+            row += self._empty_location
+        return row
+
+    def write_pending(self, callback=None, atomic=False,
+                      before_commit=None):
+        """Write all the pending requests added by `add_request`
+
+        Requests added while this runs are left for the next call.  If
+        the insert fails the requests that were not written are put
+        back (still limited by `max_pending`) and the exception is
+        raised.  With `atomic` either all the requests are written or
+        none are.
+
+        `before_commit` is called with the connection after the
+        requests are inserted, in the same transaction (which makes
+        the write atomic).  The `rollups` are added to in the same
+        way.
+        """
+        pending = self._pending
+        popleft = pending.popleft
+        requests = [popleft() for i in xrange(len(pending))]
+        total = len(requests)
+        self.add_geoip_many(requests)
+        rows = []
+        for index, request in enumerate(requests):
             if callback:
                 callback(index, total)
-            if request.get('vaineye.end_time'):
-                processing_time = request['vaineye.end_time'] - request['vaineye.start_time']
-            else:
-                processing_time = None
-            date = request.get('vaineye.date')
-            if not date:
-                date = datetime.fromtimestamp(request['vaineye.start_time'])
-            self.add_geoip(request)
-            self.encode_request(request)
-            values = {
-                'ip': request['REMOTE_ADDR'],
-                'date': date,
-                'processing_time': processing_time,
-                'request_method': request['REQUEST_METHOD'],
-                'scheme': request['wsgi.url_scheme'],
-                'host': request.get('HTTP_HOST'),
-                ## urllib.quote?:
-                'path': request.get('SCRIPT_NAME', '')+request.get('PATH_INFO', ''),
-                'query_string': request.get('QUERY_STRING', ''),
-                'user_agent': request.get('HTTP_USER_AGENT', ''),
-                'referrer': request.get('HTTP_REFERER', ''),
-                'response_code': request['vaineye.response_code'],
-                'response_bytes': request.get('vaineye.response_bytes'),
-                'content_type': request.get('vaineye.content_type'),
-                }
-            if request.get('vaineye.ip_location'):
-                for name, value in request['vaineye.ip_location'].items():
-                    if isinstance(value, str):
-                        try:
-                            ## FIXME: right encoding?
-                            value = value.decode('latin1')
-                        except UnicodeDecodeError, e:
-                            raise ValueError("Bad item: %r, %s" % (value, e))
-                    values['ip_%s' % name] = value
-            else:
-                values.update(self._empty_ip_location)
-            all_values.append(values)
-            ins = self.table_insert.values(values)
+            rows.append(self.request_row(request))
         if callback:
             callback()
+        if self.partition:
+            # So each partition's rows are together:
+            order = sorted(xrange(total), key=lambda index: rows[index][1])
+            requests = [requests[index] for index in order]
+            rows = [rows[index] for index in order]
+        try:
+            conn = self.engine.connect()
+            try:
+                if before_commit is None and self.rollups is None:
+                    self.insert_rows(conn, rows, atomic=atomic)
+                else:
+                    trans = conn.begin()
+                    try:
+                        self.insert_rows(conn, rows, atomic=True)
+                        if self.rollups is not None:
+                            self.add_rollups(conn, rows)
+                        if before_commit is not None:
+                            before_commit(conn)
+                    except:
+                        trans.rollback()
+                        self._end_dimensions(committed=False)
+                        raise
+                    try:
+                        trans.commit()
+                    except:
+                        self._end_dimensions(committed=False)
+                        raise
+                    self._end_dimensions(committed=True)
+            finally:
+                conn.close()
+        except BulkWriteError, e:
+            self.flushed += e.written
+            self._put_back(requests[e.written:])
+            raise
+        except:
+            self._put_back(requests)
+            raise
+        self.flushed += total
+
+    def _end_dimensions(self, committed):
+        """Tells the dimensions whether the transaction they added new
+        values in was committed"""
+        if not self.normalized:
+            return
+        for dimension, indexes in self.dimensions:
+            if committed:
+                dimension.commit()
+            else:
+                dimension.rollback()
+
+    def add_rollups(self, conn, rows):
+        """Adds rows created by `request_row` to the hourly `rollups`"""
+        columns = self.insert_columns
+        self.rollups.add(conn, count_requests(
+            [dict(zip(columns, row)) for row in rows], hour_start))
+
+    def rollups_since(self):
+        """The first hour the `rollups` count completely, or None if
+        there are no rollups"""
+        if self.rollups is None:
+            return None
+        conn = self.engine.connect()
+        try:
+            return self.rollups.since(conn)
+        finally:
+            conn.close()
+
+    def rollup_requests(self, kind, start, end):
+        """Returns the hourly counts of `kind` from `start` up to
+        `end`, added up for each key; see
+        `vaineye.aggregates.Aggregates.requests`"""
+        conn = self.engine.connect()
+        try:
+            for request in self.rollups.requests(conn, kind, start, end,
+                                                 by_period=False):
+                yield request
+        finally:
+            conn.close()
+
+    def discard_pending(self):
+        """Throws away all the pending requests (e.g., when they will
+        be re-read from somewhere else)"""
+        self._pending.clear()
+
+    def _put_back(self, requests):
+        """Returns requests that could not be written to the front of
+        the pending list, trimming it back to `max_pending`"""
+        pending = self._pending
+        pending.extendleft(reversed(requests))
+        if self.max_pending is None:
+            return
+        if self.overflow == 'drop-newest':
+            discard = pending.pop
+        else:
+            discard = pending.popleft
+        while len(pending) > self.max_pending:
+            try:
+                discard()
+            except IndexError:
+                break
+            self.flush_dropped += 1
+
+    def insert_rows(self, conn, rows, atomic=False):
+        """Inserts rows created by `request_row` with the `writer`"""
+        if not rows:
+            return
+        if self.partition:
+            return self._insert_partitioned(conn, rows, atomic)
+        if self.normalized:
+            rows = self.fact_rows(conn, rows)
+        self.writer.write(conn, rows, atomic=atomic)
+
+    def _insert_partitioned(self, conn, rows, atomic):
+        """Inserts rows created by `request_row`, sorted by date, each
+        into its partition"""
+        kind = self.partition
+        groups = []
+        for row in rows:
+            start = partitions.partition_start(kind, row[1])
+            if not groups or groups[-1][0] != start:
+                groups.append((start, []))
+            groups[-1][1].append(row)
+        writers = [self.partition_writer(start) for start, group in groups]
+        outer = None
+        if atomic:
+            outer = conn.begin()
+        written = 0
         try:
-            conn.execute(self.table_insert, all_values)
-        except Exception, e:
-            # This query can result in brutally large error messages
-            msg = str(e)
-            if len(msg) > 80:
-                msg = str(e.__class__)
-                raise Exception('Error in insert: %s' % msg)
+            for writer, (start, group) in zip(writers, groups):
+                self.writer = writer
+                try:
+                    writer.write(conn, group, atomic=atomic)
+                except BulkWriteError, e:
+                    e.written += written
+                    raise
+                written += len(group)
+        except BulkWriteError, e:
+            if outer is not None:
+                outer.rollback()
+                e.written = 0
+            raise
+        except:
+            if outer is not None:
+                outer.rollback()
             raise
-        self._pending = []
+        if outer is not None:
+            outer.commit()
 
-    def encode_request(self, request):
-        for key, value in request.items():
-            if isinstance(value, str):
-                request[key] = value.decode('utf8', 'replace')
+    def partition_writer(self, start):
+        """Returns the writer for the partition starting at `start`,
+        creating the partition if it doesn't exist"""
+        writer = self._partition_writers.get(start)
+        if writer is None:
+            name = partitions.partition_name(
+                self.table_name, self.partition, start)
+            table = self.partition_table(name)
+            table.create(self.engine, checkfirst=True)
+            writer = self._partition_writers[start] = make_writer(
+                self.engine, table, self.insert_columns,
+                **self._writer_options)
+        return writer
 
-    _empty_ip_location = {
-        'ip_country_code': None, 'ip_country_code3': None,
-        'ip_country_name': None, 'ip_region': None,
-        'ip_city': None, 'ip_postal_code': None,
-        'ip_latitude': None, 'ip_longitude': None,
-        'ip_dma_code': None, 'ip_area_code': None}
+    def partition_table(self, name):
+        """The ``Table`` of the partition called `name`"""
+        table = self.sql_metadata.tables.get(name)
+        if table is None:
+            table = Table(name, self.sql_metadata, *self._request_columns())
+            add_profile_indexes(table, self.index_profile)
+        return table
 
-    def requests(self, query, callback=None):
-        """Returns all the requests that match the SQLAlchemy `query`
+    def partitions(self, low=None, high=None):
+        """Returns the existing partitions (as
+        `vaineye.partitions.Partition`), oldest first, optionally only
+        those with dates from `low` to `high`"""
+        found = partitions.find_partitions(
+            inspect(self.engine).get_table_names(), self.table_name)
+        return [partition for partition in found
+                if partition.overlaps(low, high)]
+
+    def drop_partitions(self, before):
+        """Drops the partitions that end before the datetime `before`,
+        returning their names"""
+        dropped = []
+        for partition in self.partitions():
+            if partition.end <= before:
+                self.partition_table(partition.name).drop(self.engine)
+                self.sql_metadata.remove(self.sql_metadata.tables[partition.name])
+                for start, writer in self._partition_writers.items():
+                    if writer.table.name == partition.name:
+                        del self._partition_writers[start]
+                dropped.append(partition.name)
+        return dropped
+
+    def delete_rows(self, conn, table, ids):
+        """Deletes the requests with the given `ids` from `table` (one
+        of the tables from `storage_tables`)"""
+        if self.normalized:
+            table = self.insert_table
+        # Keeps the parameters under SQLite's limit:
+        for start in xrange(0, len(ids), 500):
+            conn.execute(table.delete(table.c.id.in_(ids[start:start+500])))
+
+    def compacted_until(self):
+        """The date up to which requests may have been moved to the
+        aggregates (see `vaineye.aggregates`), or None"""
+        conn = self.engine.connect()
+        try:
+            return self.aggregates.compacted_until(conn)
+        finally:
+            conn.close()
+
+    def import_checkpoint(self, fingerprint):
+        """Returns ``(offset, lines)`` already imported of a log file;
+        see `vaineye.checkpoints`"""
+        conn = self.engine.connect()
+        try:
+            return self.checkpoints.get(conn, fingerprint)
+        finally:
+            conn.close()
+
+    def aggregated_requests(self, kind, start=None, end=None):
+        """Returns the daily counts of `kind` from `start` up to `end`;
+        see `vaineye.aggregates.Aggregates.requests`"""
+        conn = self.engine.connect()
+        try:
+            for request in self.aggregates.requests(conn, kind, start, end):
+                yield request
+        finally:
+            conn.close()
+
+    def storage_tables(self, query=None):
+        """Returns ``[(table, query)]``: the tables that hold requests
+        (that might match `query`), each with `query` rewritten to
+        use that table"""
+        if not self.partition:
+            return [(self.table, query)]
+        low, high = partitions.date_bounds(query, self.table.c.date)
+        result = []
+        if self.unpartitioned:
+            # Older than any partition
+            result.append((self.table, query))
+        for partition in self.partitions(low, high):
+            table = self.partition_table(partition.name)
+            result.append((table, self._adapt(query, table)))
+        return result
+
+    def _adapt(self, query, table):
+        if query is None:
+            return None
+        template = self.table
+        def replace(element):
+            if getattr(element, 'table', None) is template:
+                return table.c[element.name]
+            return None
+        return replacement_traverse(query, {}, replace)
+
+    def fact_rows(self, conn, rows):
+        """Turns rows created by `request_row` into rows for the
+        normalized request table, in the order of
+        `insert_table_columns`, finding (or adding) the ids of their
+        dimension values"""
+        fact_indexes = self._fact_indexes
+        facts = [[row[index] for index in fact_indexes] for row in rows]
+        for dimension, indexes in self.dimensions:
+            keys = []
+            for row in rows:
+                key = tuple([row[index] for index in indexes])
+                for value in key:
+                    if value is not None:
+                        break
+                else:
+                    key = None
+                keys.append(key)
+            for fact, id in zip(facts, dimension.ids(conn, keys)):
+                fact.append(id)
+        return facts
+
+    def requests(self, query, callback=None, columns=None):
+        """Returns all the requests that match the SQLAlchemy `query`,
+        as `RequestRow` objects
+
+        Only the `columns` (a list of names) are read if given, along
+        with ``sample_weight``; otherwise all of them are.
 
         `callback` is a function called with two values
         ``callback(row_number, total_rows)``, and at the start with
@@ -177,119 +761,211 @@ class RequestTracker(object):
 
         If `count` is true, then first there will be a count to see
         how many rows will be returned.
+
+        The connection is closed when all the rows have been read, or
+        when the generator is closed (or garbage collected) before
+        that.
         """
-        conn = self.engine.connect()
-        q = select([self.table],
-                   query)
-        result = conn.execute(q)
+        tables = self.storage_tables(query)
         total = [None]
         def total_callback():
-            count_query = select([func.count('*')], query)
-            total[0] = list(conn.execute(count_query))[0][0]
+            # On its own connection, as some drivers can't run another
+            # query while a streamed result is open
+            count = 0
+            count_conn = self.engine.connect()
+            try:
+                for table, table_query in tables:
+                    count_query = select([func.count('*')], table_query,
+                                         from_obj=[table])
+                    count += count_conn.execute(count_query).scalar()
+            finally:
+                count_conn.close()
+            total[0] = count
         if callback:
             callback(None, None, total_callback)
-        for index, row in enumerate(result):
-            row = dict(row)
-            url = urlparse.urlunsplit((row['scheme'],
-                                       row['host'],
-                                       row['path'],
-                                       row['query_string'],
-                                       ''))
-            row['url'] = url
-            if callback:
-                callback(index, total[0], total_callback)
-            yield row
-
-    apache_line_re = re.compile(r'''
-    (?P<ip>[\d.:a-fA-F]+)          \s+  # IP Address
-    (?P<ident>[^\s]+)              \s+  # ident (usually -)
-    (?P<user>[^\s]+)               \s+  # logged-in user (usually -)
-    \[(?P<date>[^\]]*)\]           \s+  # date
-    "(?P<method>[A-Z]+)            \s+  # Start of the request string
-    (?P<path>[^ ]+)                \s+  # Requested path
-    HTTP/(?P<http_version>[\d.]*)" \s+  # The version
-    (?P<status>\d+)                \s+  # Response status version
-    (?P<bytes>\d+|-)               \s+  # Bytes in response (- is 0)
-    "(?P<referrer>[^"]*)"          \s+  # Referrer
-    "(?P<user_agent>[^"]*)"             # User-Agent
-    ''', re.VERBOSE)
-
-    apache_date_format = '%d/%b/%Y:%H:%M:%S'
+        if columns is None:
+            columns = [column.name for column in self.table.c]
+        elif 'sample_weight' not in columns:
+            columns = list(columns) + ['sample_weight']
+        positions = dict((name, index) for index, name in enumerate(columns))
+        conn = self.engine.connect()
+        try:
+            rows = self._select_rows(conn, tables, columns)
+            for index, row in enumerate(rows):
+                if callback:
+                    callback(index, total[0], total_callback)
+                yield RequestRow(row, positions)
+        finally:
+            # The result first, then its connection:
+            rows.close()
+            conn.close()
+
+    def grouped_requests(self, query, columns, callback=None):
+        """Returns the requests that match the SQLAlchemy `query`,
+        counted by the database: one dictionary for each distinct
+        value of `columns`, with the total ``sample_weight`` of the
+        requests that have it
+
+        There is also a ``url`` if `columns` include the scheme, host,
+        path and query string.  `callback` is called like for
+        `requests`, with the number of groups and an unknown total.
+        A value may come back more than once when the requests are in
+        more than one partition.
+        """
+        conn = self.engine.connect()
+        try:
+            index = 0
+            for table, table_query in self.storage_tables(query):
+                group = [table.c[name] for name in columns]
+                weight = func.sum(func.coalesce(table.c.sample_weight, 1))
+                group_query = select(group + [weight], table_query).group_by(
+                    *group)
+                for row in self.stream_rows(conn, group_query):
+                    request = dict(zip(columns, row))
+                    request['sample_weight'] = row[-1]
+                    if 'host' in request and 'query_string' in request:
+                        request['url'] = urlparse.urlunsplit((
+                            request['scheme'], request['host'],
+                            request['path'], request['query_string'], ''))
+                    if callback:
+                        callback(index, -1)
+                    index += 1
+                    yield request
+        finally:
+            conn.close()
+
+    def _select_rows(self, conn, tables, columns):
+        for table, query in tables:
+            select_query = select([table.c[name] for name in columns], query)
+            for row in self.stream_rows(conn, select_query):
+                yield row
+
+    def stream_rows(self, conn, query):
+        """Yields the rows of `query`, fetching `fetch_size` at a time
+        through a server-side cursor (``stream_results``) where the
+        driver has one, so the whole result is never in memory"""
+        result = conn.execution_options(stream_results=True).execute(query)
+        try:
+            while True:
+                rows = result.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            result.close()
 
     def import_apache_line(self, line, default_scheme='http', default_host='localhost'):
         """Import one line of an Apache common-format log file.
 
         Apache log files do not contain the request domain or scheme,
         so these must be provided"""
-        match = self.apache_line_re.match(line)
-        if not match:
-            raise ValueError("Bad line, cannot parse: %r" % line)
-        d = match.groupdict()
-        date = datetime.fromtimestamp(
-            time.mktime(time.strptime(d['date'].split(None, 1)[0], self.apache_date_format)))
-        date = date + timedelta(hours=int(d['date'].split(None, 1)[1]))
-        if '?' in d['path']:
-            path, query_string = d['path'].split('?', 1)
-        else:
-            path = d['path']
-            query_string = ''
-        if not d.get('bytes') or d['bytes'] == '-':
-            bytes = 0
-        else:
-            bytes = int(d['bytes'])
-        referrer = d['referrer']
-        if referrer == '-':
-            referrer = ''
-        user_agent = d['user_agent']
-        if user_agent == '-':
-            user_agent = '-'
-        content_type, encoding = mimetypes.guess_type(path)
-        request = {
-            'REMOTE_ADDR': d['ip'],
-            'vaineye.date': date,
-            'vaineye.start_time': None,
-            'vaineye.end_time': None,
-            'REQUEST_METHOD': d['method'],
-            'wsgi.url_scheme': default_scheme,
-            'HTTP_HOST': default_host,
-            'SCRIPT_NAME': '',
-            'PATH_INFO': path,
-            'QUERY_STRING': query_string,
-            'HTTP_USER_AGENT': user_agent,
-            'HTTP_REFERER': referrer,
-            'vaineye.response_code': int(d['status']),
-            'vaineye.response_bytes': bytes,
-            'vaineye.content_type': content_type,
-            'vaineye.ip_location': None,
-            }
-        self._pending.append(request)
+        self.add_record(
+            parse_apache_line(line, default_scheme, default_host))
 
     _geoip_warned = False
 
     def add_geoip(self, request):
         """Given a request record, add geo-ip data if possible"""
-        if (not geo_ip or request.get('vaineye.ip_location')
-            or not request.get('REMOTE_ADDR')):
+        self.add_geoip_many([request])
+
+    def add_geoip_many(self, requests):
+        """Adds geo-ip data to all the request records that can have
+        it, looking up each address once"""
+        if not geo_ip:
             return
-        start = int(request['REMOTE_ADDR'].split('.', 1)[0])
-        if start in (127, 10, 192):
+        requests = [request for request in requests
+                    if request.ip and not request.ip_location]
+        if not requests:
             return
         try:
-            rec = geo_ip.record_by_addr(request['REMOTE_ADDR'])
+            locations = self.geo_locator.lookup_many(
+                [request.ip for request in requests])
         except SystemError, e:
             if not self._geoip_warned:
                 import sys
-                print >> sys.stderr, 'Error: %s (for IP: %s)' % (e, request['REMOTE_ADDR'])
+                print >> sys.stderr, 'Error: %s' % e
                 print >> sys.stderr, 'You must get this:'
                 print >> sys.stderr, 'http://geolite.maxmind.com/download/geoip/database/GeoLiteCity.dat.gz'
                 print >> sys.stderr, 'Per instructions: http://www.maxmind.com/app/installation?city=1'
                 self._geoip_warned = True
             return
-        if not rec:
-            return
-        if rec.get('postal_code'):
-            state = zip_to_state(rec['postal_code'])
-        else:
-            state = None
-        rec['state'] = state
-        request['vaineye.ip_location'] = rec
+        for request, rec in zip(requests, locations):
+            request.ip_location = rec
+
+class CaptureCounters(object):
+    """Per-thread counters kept by `RequestTracker.add_record`"""
+
+    __slots__ = ('captured', 'dropped')
+
+    def __init__(self):
+        self.captured = 0
+        self.dropped = 0
+
+class RequestRow(object):
+    """One request from `RequestTracker.requests`, which can be used
+    like a (read-only) dictionary of its columns
+
+    There is also a ``url`` key, made from the scheme, host, path and
+    query string when it is asked for.
+    """
+
+    __slots__ = ('_values', '_positions')
+
+    _url_columns = ('scheme', 'host', 'path', 'query_string')
+
+    def __init__(self, values, positions):
+        # `positions` is {column name: index in values}, shared by all
+        # the rows of a query
+        self._values = values
+        self._positions = positions
+
+    def __getitem__(self, name):
+        try:
+            return self._values[self._positions[name]]
+        except KeyError:
+            if name == 'url' and self._has_url():
+                return urlparse.urlunsplit(
+                    tuple([self[column] for column in self._url_columns])
+                    + ('',))
+            raise
+
+    def _has_url(self):
+        for column in self._url_columns:
+            if column not in self._positions:
+                return False
+        return True
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return name in self._positions or (name == 'url' and self._has_url())
+
+    def keys(self):
+        keys = list(self._positions)
+        if self._has_url():
+            keys.append('url')
+        return keys
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, dict(self))
+
+def _decode(value):
+    if isinstance(value, str):
+        return value.decode('utf8', 'replace')
+    return value
+
+def _sqlite_transactions(engine):
+    """Has SQLAlchemy begin SQLite transactions itself; the pysqlite
+    driver's own handling commits before a ``SAVEPOINT``, so nested
+    transactions (``begin_nested``) wouldn't work"""
+    def connect(dbapi_conn, connection_record):
+        dbapi_conn.isolation_level = None
+    def begin(conn):
+        conn.execute('BEGIN')
+    event.listen(engine, 'connect', connect)
+    event.listen(engine, 'begin', begin)
@@ -0,0 +1,129 @@
+"""
+Time partitions of the requests table
+
+A partitioned requests table is a set of tables with the same columns,
+one per month (or week, or day), named like ``requests_m201001``,
+``requests_w20100104`` or ``requests_d20100104`` after the partition
+kind and the date it starts.  Old partitions are removed by dropping
+their table, and a query for a date range only reads the partitions
+that overlap it.
+"""
+import re
+from datetime import datetime, timedelta
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.expression import BinaryExpression, BindParameter
+from sqlalchemy.sql.expression import BooleanClauseList
+
+kinds = {'month': 'm', 'week': 'w', 'day': 'd'}
+_kind_letters = dict((letter, kind) for kind, letter in kinds.items())
+
+def partition_start(kind, date):
+    """The start of the `kind` partition `date` falls in"""
+    if kind == 'month':
+        return datetime(date.year, date.month, 1)
+    start = datetime(date.year, date.month, date.day)
+    if kind == 'week':
+        # Weeks start on Monday
+        start -= timedelta(days=start.weekday())
+    return start
+
+def partition_end(kind, start):
+    """The start of the next partition after the one starting at
+    `start`"""
+    if kind == 'month':
+        if start.month == 12:
+            return datetime(start.year+1, 1, 1)
+        return datetime(start.year, start.month+1, 1)
+    if kind == 'week':
+        return start + timedelta(days=7)
+    return start + timedelta(days=1)
+
+def partition_name(base, kind, start):
+    if kind == 'month':
+        return '%s_%s%s' % (base, kinds[kind], start.strftime('%Y%m'))
+    return '%s_%s%s' % (base, kinds[kind], start.strftime('%Y%m%d'))
+
+def parse_partition_name(base, name):
+    """Returns ``(kind, start)`` if `name` is the name of a partition
+    of `base`, otherwise None"""
+    match = re.match(r'^%s_([mwd])(\d{6}|\d{8})$' % re.escape(base), name)
+    if not match:
+        return None
+    kind = _kind_letters[match.group(1)]
+    digits = match.group(2)
+    try:
+        if kind == 'month' and len(digits) == 6:
+            return kind, datetime.strptime(digits, '%Y%m')
+        if kind != 'month' and len(digits) == 8:
+            return kind, datetime.strptime(digits, '%Y%m%d')
+    except ValueError:
+        pass
+    return None
+
+class Partition(object):
+    """One existing partition table"""
+
+    def __init__(self, name, kind, start):
+        self.name = name
+        self.kind = kind
+        self.start = start
+        self.end = partition_end(kind, start)
+
+    def overlaps(self, low, high):
+        """True if any date from `low` to `high` (either of which may be
+        None, for no limit) is in this partition"""
+        if low is not None and self.end <= low:
+            return False
+        if high is not None and self.start > high:
+            return False
+        return True
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.name)
+
+def find_partitions(table_names, base):
+    """Returns a list of `Partition` for the names in `table_names`
+    that are partitions of `base`, oldest first"""
+    partitions = []
+    for name in table_names:
+        parsed = parse_partition_name(base, name)
+        if parsed is not None:
+            partitions.append(Partition(name, *parsed))
+    partitions.sort(key=lambda partition: partition.start)
+    return partitions
+
+def date_bounds(clause, column):
+    """Finds the range of `column` that the SQLAlchemy `clause` allows,
+    as ``(low, high)``; either may be None if it can't be told
+
+    Only comparisons of `column` with a value that are ANDed together
+    (at any depth) are looked at.
+    """
+    low = high = None
+    for expr in _conjuncts(clause):
+        if not isinstance(expr, BinaryExpression):
+            continue
+        if expr.left is not column or not isinstance(expr.right, BindParameter):
+            continue
+        value = expr.right.value
+        if not isinstance(value, datetime):
+            continue
+        op = expr.operator
+        if op in (operators.ge, operators.gt, operators.eq):
+            if low is None or value > low:
+                low = value
+        if op in (operators.le, operators.lt, operators.eq):
+            if high is None or value < high:
+                high = value
+    return low, high
+
+def _conjuncts(clause):
+    if clause is None:
+        return
+    if (isinstance(clause, BooleanClauseList)
+        and clause.operator is operators.and_):
+        for sub in clause.clauses:
+            for expr in _conjuncts(sub):
+                yield expr
+    else:
+        yield clause
@@ -0,0 +1,91 @@
+"""
+Sampling of captured requests
+
+Rules look like::
+
+    status:5*=1 status:4*=1 type:text/html=1 type:image/*=0.01 path:/static/*=0.05
+
+Each rule is ``KIND:PATTERN=RATE``, where ``KIND`` is ``path``,
+``type`` (the content type, without parameters) or ``status`` (the
+response code), ``PATTERN`` is a wildcard pattern, and ``RATE`` is the
+fraction of matching requests to keep.  A rule of just ``*=RATE``
+matches everything.  The first rule that matches decides; requests no
+rule matches are all kept.
+
+A request that is kept gets a `sample_weight` of ``1/RATE``, and the
+summaries count it that many times, so the totals stay unbiased.
+"""
+import fnmatch
+import random
+import re
+
+class SamplingRule(object):
+    """One ``KIND:PATTERN=RATE`` rule"""
+
+    kinds = ('path', 'type', 'status')
+
+    def __init__(self, kind, pattern, rate):
+        if kind is not None and kind not in self.kinds:
+            raise ValueError(
+                'Bad sampling rule kind %r (should be one of %s)'
+                % (kind, ', '.join(self.kinds)))
+        if not 0 < rate <= 1:
+            raise ValueError('Bad sampling rate %r (should be >0 and <=1)' % rate)
+        self.kind = kind
+        self.pattern = pattern
+        self.rate = rate
+        self.weight = 1.0 / rate
+        self._match = re.compile(fnmatch.translate(pattern)).match
+
+    @classmethod
+    def parse(cls, text):
+        """Parses one rule from its text"""
+        if '=' not in text:
+            raise ValueError('Bad sampling rule %r (no =RATE)' % text)
+        pattern, rate = text.rsplit('=', 1)
+        if pattern == '*':
+            kind = None
+        elif ':' in pattern:
+            kind, pattern = pattern.split(':', 1)
+        else:
+            raise ValueError('Bad sampling rule %r (no KIND:)' % text)
+        return cls(kind, pattern, float(rate))
+
+    def matches(self, request):
+        if self.kind is None:
+            return True
+        if self.kind == 'path':
+            value = request.path
+        elif self.kind == 'type':
+            value = (request.content_type or '').split(';', 1)[0].strip()
+        else:
+            value = str(request.response_code)
+        return self._match(value) is not None
+
+    def __repr__(self):
+        return '<%s %s:%s=%s>' % (self.__class__.__name__, self.kind or '',
+                                  self.pattern, self.rate)
+
+class Sampler(object):
+    """Decides which captured requests to keep"""
+
+    def __init__(self, rules, random=random.random):
+        """`rules` is a string (see the module docstring) or a list of
+        `SamplingRule`"""
+        if isinstance(rules, basestring):
+            rules = [SamplingRule.parse(text)
+                     for text in rules.replace(',', ' ').split()]
+        self.rules = rules
+        self.random = random
+        self.skipped = 0
+
+    def weight(self, request):
+        """Returns the `sample_weight` to store for `request`, or 0 if
+        it should not be stored at all"""
+        for rule in self.rules:
+            if rule.matches(request):
+                if rule.rate >= 1 or self.random() < rule.rate:
+                    return rule.weight
+                self.skipped += 1
+                return 0
+        return 1.0
@@ -0,0 +1,202 @@
+"""
+Append-only, memory-mapped spool files of captured requests
+
+Under a pre-forking server each worker process appends the requests
+it captures to its own spool segment with `SpoolWriter`, and never
+touches the database.  A separate collector (``vaineye-collector``,
+see `vaineye.collector`) reads the segments with `SpoolSegment`,
+writes them to the database and removes what it has committed.
+
+A segment is a fixed-size file.  It starts with a header that holds
+the writer's pid, how far the writer has written, how far the
+collector has committed, and whether the writer has moved on to a new
+segment; the packed requests (see `vaineye.capture.pack_request`)
+follow.
+"""
+import errno
+import glob
+import mmap
+import os
+import struct
+import threading
+from vaineye.capture import pack_request, unpack_request
+
+_magic = 'VESP'
+_version = 2
+# magic, version, flags, pid, write_end, read_end:
+_header = struct.Struct('<4sHHIQQ')
+_header_size = 64
+_write_end_offset = 12
+_read_end_offset = 20
+_flags_offset = 6
+_sealed = 1
+
+class SpoolWriter(object):
+    """Appends captured requests to the current process's spool
+    segment
+
+    Segments are created lazily, and again after a fork, so the
+    writer can be created before a server forks its workers.
+    """
+
+    def __init__(self, spool_dir, segment_size=4*1024*1024):
+        self.spool_dir = spool_dir
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+        self._pid = None
+        self._sequence = 0
+        self._map = None
+        self._file = None
+        self._write_end = _header_size
+        if not os.path.exists(spool_dir):
+            os.makedirs(spool_dir)
+
+    def put(self, record):
+        """Append one `CapturedRequest`"""
+        data = pack_request(record)
+        self.lock.acquire()
+        try:
+            if self._pid != os.getpid():
+                self._open_segment()
+            end = self._write_end + len(data)
+            if end > self.segment_size:
+                if len(data) > self.segment_size - _header_size:
+                    self.dropped += 1
+                    return
+                self._seal()
+                self._open_segment()
+                end = self._write_end + len(data)
+            self._map[self._write_end:end] = data
+            # Only now is the record visible to the collector:
+            struct.pack_into('<Q', self._map, _write_end_offset, end)
+            self._write_end = end
+            self.written += 1
+        finally:
+            self.lock.release()
+
+    def update_stats(self, stats):
+        stats['captured'] += self.written + self.dropped
+        stats['flushed'] += self.written
+        stats['dropped'] += self.dropped
+
+    def close(self):
+        """Seal the current segment"""
+        self.lock.acquire()
+        try:
+            if self._pid == os.getpid():
+                self._seal()
+        finally:
+            self.lock.release()
+
+    def _open_segment(self):
+        if self._pid != os.getpid():
+            # A new process: the inherited segment belongs to the parent
+            self._pid = os.getpid()
+            self._map = self._file = None
+            self._sequence = 0
+        while True:
+            self._sequence += 1
+            filename = os.path.join(
+                self.spool_dir, 'vaineye-%s-%s.spool' % (self._pid, self._sequence))
+            try:
+                fd = os.open(filename, os.O_RDWR|os.O_CREAT|os.O_EXCL, 0644)
+            except OSError, e:
+                if e.errno == errno.EEXIST:
+                    # Left over from an earlier process with our pid
+                    continue
+                raise
+            break
+        self._file = os.fdopen(fd, 'r+b')
+        self._file.truncate(self.segment_size)
+        self._map = mmap.mmap(self._file.fileno(), self.segment_size)
+        self._write_end = _header_size
+        self._map[:_header.size] = _header.pack(
+            _magic, _version, 0, self._pid, _header_size, _header_size)
+
+    def _seal(self):
+        if self._map is None:
+            return
+        flags = struct.unpack_from('<H', self._map, _flags_offset)[0]
+        struct.pack_into('<H', self._map, _flags_offset, flags | _sealed)
+        self._map.close()
+        self._file.close()
+        self._map = self._file = None
+
+class SpoolSegment(object):
+    """A spool segment, as seen by the collector"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, 'r+b')
+        if os.fstat(self._file.fileno()).st_size < _header_size:
+            # The writer hasn't sized it yet
+            self._file.close()
+            raise ValueError('%s is not a complete spool file' % filename)
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, flags, pid, write_end, read_end = _header.unpack_from(self._map)
+        if magic != _magic or version != _version:
+            self.close()
+            raise ValueError('%s is not a vaineye spool file' % filename)
+        self.pid = pid
+
+    @classmethod
+    def find(cls, spool_dir):
+        """The names of all the segments in `spool_dir`"""
+        filenames = glob.glob(os.path.join(spool_dir, 'vaineye-*.spool'))
+        filenames.sort()
+        return filenames
+
+    @property
+    def read_end(self):
+        return struct.unpack_from('<Q', self._map, _read_end_offset)[0]
+
+    @property
+    def write_end(self):
+        return struct.unpack_from('<Q', self._map, _write_end_offset)[0]
+
+    @property
+    def sealed(self):
+        flags = struct.unpack_from('<H', self._map, _flags_offset)[0]
+        return bool(flags & _sealed)
+
+    def writer_alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError, e:
+            if e.errno == errno.ESRCH:
+                return False
+        return True
+
+    def read(self, limit=None):
+        """Reads the requests written but not yet committed
+
+        Returns ``(requests, end)``; pass `end` to `commit` once the
+        requests are in the database."""
+        pos = self.read_end
+        end = self.write_end
+        requests = []
+        while pos < end and (limit is None or len(requests) < limit):
+            request, pos = unpack_request(self._map, pos)
+            requests.append(request)
+        return requests, pos
+
+    def commit(self, end):
+        """Marks everything up to `end` as written to the database"""
+        struct.pack_into('<Q', self._map, _read_end_offset, end)
+
+    def finished(self):
+        """True if the writer is done with this segment and everything
+        in it has been committed"""
+        if self.read_end < self.write_end:
+            return False
+        return self.sealed or not self.writer_alive()
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def remove(self):
+        self.close()
+        os.unlink(self.filename)
@@ -2,97 +2,574 @@
 Middleware that tracks requests
 """
 import atexit
+import os
+import sys
 import threading
 import time
-from datetime import datetime
-from paste.request import construct_url
-from paste.util.import_string import simple_import
-from sqlalchemy import MetaData, Table
-from sqlalchemy import Integer, String, DateTime, Float
-from sqlalchemy import create_engine
-from vaineye.model import RequestTracker
+import traceback
+import types
+import Queue
+from vaineye.capture import capture_request
 
 class StatusWatcher(object):
     """Middleware that tracks requests"""
 
-    def __init__(self, app, db, table_prefix='',
+    def __init__(self, app, db=None, table_prefix='',
                  serialize_time=120, serialize_requests=100,
-                 _synchronous=False):
+                 max_queue=10000, queue_overflow='drop',
+                 max_pending=100000, pending_overflow='drop-oldest',
+                 measure_body=False, spool_dir=None,
+                 spool_size=4*1024*1024, sink=None, sample=None,
+                 normalized=None, index_profile='default', partition=None,
+                 journal_dir=None, rollups=None, _synchronous=False):
         """This wraps the `app` and saves data about each request.
 
         data is stored in `vaineye.model.RequestTracker`, instantiated
         with the `db` SQLAlchemy connection string.
 
-        Periodically data is written to the database (every
-        `serialize_time` seconds, or `serialize_requests` requests,
-        whichever comes first).  This writing happens in a background
-        thread.
+        Captured requests are handed to a single `BackgroundFlusher`
+        thread, which writes them to the database every
+        `serialize_time` seconds, or every `serialize_requests`
+        requests, whichever comes first.  At most `max_queue` requests
+        wait for that thread; `queue_overflow` says what happens when
+        the database falls behind and the queue fills up (see
+        `BackgroundFlusher`).
+
+        Requests that could not be written yet (e.g., while the
+        database is down) are kept up to `max_pending`, past which
+        `pending_overflow` decides which are lost (see
+        `RequestTracker`).
+
+        Normally a request is recorded when the application calls
+        ``start_response``, with the size from any Content-Length
+        header.  If `measure_body` is true the response body is
+        wrapped (see `MeasuredAppIter`), and the request is recorded
+        when the body has been sent, with the bytes actually sent, the
+        time to the first byte, and the time to the last byte as its
+        processing time.
+
+        If `spool_dir` is given, requests are not written to the
+        database at all.  Each process appends them to its own spool
+        file in that directory (see `vaineye.spool`), and
+        ``vaineye-collector`` moves them into the database; `db` is
+        not needed then.
+
+        Likewise if `sink` is given (``unix:/path/to/socket`` or
+        ``udp://127.0.0.1:PORT``) each request is sent as one datagram
+        to a ``vaineye-ingest`` daemon listening there (see
+        `vaineye.datagram`), and nothing else is done in-process.
+
+        `sample` gives sampling rules, like ``type:image/*=0.01``, so
+        that only some requests are stored, each with a weight that
+        makes up for the ones skipped (see `vaineye.sampling`).
+
+        `normalized` chooses the database schema, `index_profile` the
+        indexes it is created with, `partition` if the requests are
+        split into a table per month, week or day, and `rollups` if
+        hourly counts are kept for the summaries (see
+        `RequestTracker`).
+
+        If `journal_dir` is given, captured requests are kept in a
+        journal file there until the database has them, so they
+        survive database outages and restarts (see
+        `BackgroundFlusher`).
 
         For debugging purposes you can set `_synchronous` to True to
         have requests written out every request without spawning a
         thread."""
         self.app = app
-        self.request_tracker = RequestTracker(db, table_prefix=table_prefix)
-        self.serialize_time = serialize_time
-        self.serialize_requests = serialize_requests
+        if sample:
+            from vaineye.sampling import Sampler
+            self.sampler = Sampler(sample)
+        else:
+            self.sampler = None
+        self.measure_body = measure_body
         self._synchronous = _synchronous
-        self.write_pending_lock = threading.Lock()
-        self.last_written = time.time()
-        self.request_count = 0
-        if not _synchronous:
-            atexit.register(self.write_pending)
-
-    def write_pending(self):
-        """Write all pending requests"""
-        if not self.write_pending_lock.acquire(False):
-            # Someone else is currently serializing
+        # Where captured requests go: something with put(record),
+        # close() and update_stats(stats), or None to write each
+        # request to the tracker right away
+        if sink:
+            from vaineye.datagram import DatagramEmitter
+            self.request_tracker = None
+            self.sink = DatagramEmitter(sink)
+            atexit.register(self.close)
             return
-        try:
-            self.request_tracker.write_pending()
-            self.last_written = time.time()
-            self.request_counts = 0
-        finally:
-            self.write_pending_lock.release()
+        if spool_dir:
+            from vaineye.spool import SpoolWriter
+            self.request_tracker = None
+            self.sink = SpoolWriter(spool_dir, segment_size=spool_size)
+            atexit.register(self.close)
+            return
+        if not db:
+            raise ValueError('You must give a value for db, spool_dir or sink')
+        from vaineye.model import RequestTracker
+        self.request_tracker = RequestTracker(
+            db, table_prefix=table_prefix,
+            max_pending=max_pending, overflow=pending_overflow,
+            normalized=normalized, index_profile=index_profile,
+            partition=partition, rollups=rollups)
+        if _synchronous:
+            self.sink = None
+        else:
+            self.sink = BackgroundFlusher(
+                self.request_tracker,
+                flush_interval=serialize_time,
+                batch_size=serialize_requests,
+                max_queue=max_queue,
+                overflow=queue_overflow,
+                journal_dir=journal_dir)
+            atexit.register(self.close)
 
-    def write_in_thread(self):
-        """Write all pending requests, in a background thread"""
-        t = threading.Thread(target=self.write_pending)
-        t.start()
+    def stats(self):
+        """Returns the `RequestTracker.stats()` counters, with
+        whatever was dropped or is still waiting on the way to the
+        tracker (or spool) added in"""
+        if self.request_tracker is not None:
+            stats = self.request_tracker.stats()
+        else:
+            stats = dict(captured=0, flushed=0, dropped=0, pending=0)
+        if self.sink is not None:
+            self.sink.update_stats(stats)
+        if self.sampler is not None:
+            stats['sampled_out'] = self.sampler.skipped
+        return stats
+
+    def close(self):
+        """Write out everything that has been captured, and stop any
+        background thread"""
+        if self.sink is not None:
+            self.sink.close()
+
+    def record(self, record):
+        """Save one captured request"""
+        if self.sampler is not None:
+            weight = self.sampler.weight(record)
+            if not weight:
+                return
+            record.sample_weight = weight
+        if self.sink is None:
+            self.request_tracker.add_record(record)
+            self.request_tracker.write_pending()
+        else:
+            self.sink.put(record)
 
     def __call__(self, environ, start_response):
         """WSGI interface"""
-        self.request_count += 1
-        if not self._synchronous and (
-            self.request_count > self.serialize_requests
-            or time.time() - self.last_written > self.serialize_time):
-            self.write_in_thread()
         start_time = time.time()
+        if self.measure_body:
+            measured = []
+            def repl_start_response(status, headers, exc_info=None):
+                measured[:] = [status, headers]
+                return start_response(status, headers, exc_info)
+            app_iter = self.app(environ, repl_start_response)
+            return MeasuredAppIter.wrap(self, environ, start_time,
+                                        app_iter, measured)
         def repl_start_response(status, headers, exc_info=None):
             end_time = time.time()
-            self.request_tracker.add_request(
+            self.record(capture_request(
                 environ=environ,
                 start_time=start_time,
                 end_time=end_time,
                 status=status,
-                response_headers=headers)
-            if self._synchronous:
-                self.write_pending()
+                response_headers=headers))
             return start_response(status, headers, exc_info)
         return self.app(environ, repl_start_response)
 
+class MeasuredAppIter(object):
+    """Wraps a response body to count the bytes sent and time the
+    first and last of them
+
+    The request is recorded in `close()`, which the server calls
+    after the last byte has been sent.  Use `wrap` to create one.
+    """
+
+    # False when the body is sent without going through this, so only
+    # the Content-Length is known:
+    counted = True
+
+    def __init__(self, watcher, environ, start_time, app_iter, measured):
+        """`measured` is filled in with ``[status, headers]`` when the
+        application calls ``start_response`` (which may happen only
+        once the body is being iterated)"""
+        self.watcher = watcher
+        self.environ = environ
+        self.start_time = start_time
+        self.app_iter = app_iter
+        self._close = getattr(app_iter, 'close', None)
+        self.measured = measured
+        self.response_bytes = 0
+        self.first_byte_time = None
+
+    @classmethod
+    def wrap(cls, watcher, environ, start_time, app_iter, measured):
+        """Returns what to give the server in place of `app_iter`
+
+        An instance of the server's ``wsgi.file_wrapper`` is returned
+        as it is, so the server can still send the file its own way
+        (e.g., with ``sendfile``); only its ``close`` is replaced.  A
+        body with a length keeps its ``__len__``.
+        """
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if (isinstance(file_wrapper, (type, types.ClassType))
+            and isinstance(app_iter, file_wrapper)):
+            measuring = cls(watcher, environ, start_time, app_iter, measured)
+            measuring.counted = False
+            try:
+                app_iter.close = measuring.close
+            except (AttributeError, TypeError):
+                pass
+            else:
+                return app_iter
+        if hasattr(app_iter, '__len__'):
+            cls = SizedMeasuredAppIter
+        return cls(watcher, environ, start_time, app_iter, measured)
+
+    def __iter__(self):
+        chunks = iter(self.app_iter)
+        # Until the first non-empty chunk we need to look at each:
+        for chunk in chunks:
+            self.response_bytes += len(chunk)
+            if chunk:
+                self.first_byte_time = time.time()
+                yield chunk
+                break
+            yield chunk
+        # After that, only the count:
+        for chunk in chunks:
+            self.response_bytes += len(chunk)
+            yield chunk
+
+    def close(self):
+        end_time = time.time()
+        try:
+            if self._close is not None:
+                self._close()
+        finally:
+            if self.measured:
+                status, headers = self.measured
+                record = capture_request(
+                    environ=self.environ,
+                    start_time=self.start_time,
+                    end_time=end_time,
+                    status=status,
+                    response_headers=headers)
+                if self.counted:
+                    record.response_bytes = self.response_bytes
+                    record.first_byte_time = self.first_byte_time
+                self.watcher.record(record)
+
+class SizedMeasuredAppIter(MeasuredAppIter):
+    """A `MeasuredAppIter` of a body that has a length (servers use
+    this for Content-Length)"""
+
+    def __len__(self):
+        return len(self.app_iter)
+
+# Put on the queue to tell the flusher thread to drain and exit:
+_stop = object()
+
+class BackgroundFlusher(object):
+    """Owns the one thread that writes captured requests to the
+    database
+
+    Request threads only `put` records on a bounded queue; the thread
+    takes up to `batch_size` of them, or whatever arrived within
+    `flush_interval` seconds, and writes them with
+    `RequestTracker.write_pending`.
+
+    With a `journal_dir` the thread first appends the records to a
+    journal file there (see `vaineye.journal`), and writes them to the
+    database from the journal.  When a write fails the records stay
+    in the journal, and the next try waits twice as long as the last
+    (starting at `flush_interval`, up to `max_backoff` seconds).
+    """
+
+    # The most journaled records to write in one transaction:
+    journal_batch_size = 10000
+
+    overflow_policies = ('drop', 'block')
+
+    def __init__(self, request_tracker, flush_interval=120, batch_size=100,
+                 max_queue=10000, overflow='drop', block_timeout=1.0,
+                 journal_dir=None, max_backoff=1800):
+        """`overflow` is what `put` does when `max_queue` records are
+        already waiting: ``'drop'`` discards the new record right
+        away, ``'block'`` makes the request thread wait up to
+        `block_timeout` seconds for room (and then drops it).
+        Dropped records are counted in `dropped`."""
+        if overflow not in self.overflow_policies:
+            raise ValueError(
+                'Bad overflow policy %r (should be one of %s)'
+                % (overflow, ', '.join(self.overflow_policies)))
+        self.request_tracker = request_tracker
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        self.journal_dir = journal_dir
+        self.max_backoff = max_backoff
+        if journal_dir and not os.path.exists(journal_dir):
+            os.makedirs(journal_dir)
+        # The thread, queue and journal belong to the process that
+        # started them (see `_start`):
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self.thread = None
+        self.queue = None
+        self.journal = None
+        self.dropped = 0
+
+    def _start(self):
+        """Starts the flusher thread, with its queue and journal, for
+        this process
+
+        This is done on the first `put`, and again in a process
+        forked after that, so a pre-forking server can create the
+        middleware before it forks (a forked process has none of its
+        parent's threads).
+        """
+        self._pid = os.getpid()
+        self.queue = Queue.Queue(self.max_queue)
+        self.dropped = 0
+        if self.journal_dir:
+            from vaineye.journal import Journal
+            self.journal = Journal(os.path.join(
+                self.journal_dir, 'vaineye-%s.journal' % self._pid))
+            self.backoff = None
+            self.retry_at = 0
+            self.journaled = 0
+            self._orphans = []
+            self._orphan_count = 0
+            self._adopt_orphans()
+        self.thread = threading.Thread(target=self.run, name='vaineye-flusher')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _started(self):
+        """True if this process has started its thread"""
+        return self._pid == os.getpid()
+
+    def put(self, record):
+        """Hand one record (from `RequestTracker.capture_request`) to
+        the flusher thread"""
+        if not self._started():
+            self._start_lock.acquire()
+            try:
+                if not self._started():
+                    self._start()
+            finally:
+                self._start_lock.release()
+        try:
+            if self.overflow == 'block':
+                self.queue.put(record, True, self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+
+    def update_stats(self, stats):
+        if not self._started():
+            return
+        stats['dropped'] += self.dropped
+        stats['pending'] += self.queue.qsize()
+        if self.journal is not None:
+            stats['pending'] += self.journaled
+
+    def close(self, timeout=None):
+        """Drain the queue, write everything, and stop the thread"""
+        if not self._started() or not self.thread.isAlive():
+            return
+        self.queue.put(_stop)
+        self.thread.join(timeout)
+
+    def run(self):
+        """The body of the flusher thread"""
+        get = self.queue.get
+        if self.journal is not None:
+            add_record = self._journal_record
+        else:
+            add_record = self.request_tracker.add_record
+        while True:
+            deadline = time.time() + self.flush_interval
+            count = 0
+            stopping = False
+            while count < self.batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    record = get(True, timeout)
+                except Queue.Empty:
+                    break
+                if record is _stop:
+                    stopping = True
+                    break
+                add_record(record)
+                count += 1
+            if stopping:
+                # Anything still queued was put before the close
+                while True:
+                    try:
+                        record = self.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if record is not _stop:
+                        add_record(record)
+                        count += 1
+            if stopping and self.journal is not None:
+                # One last try, whatever the backoff
+                self.retry_at = 0
+            if count or self._journal_waiting():
+                self.flush()
+            if stopping:
+                if self.journal is not None:
+                    self.journal.close()
+                return
+
+    def _journal_record(self, record):
+        self.journal.append(record)
+        self.journaled += 1
+
+    def _journal_waiting(self):
+        if self.journal is None:
+            return False
+        return bool(self.journal.has_pending() or self._orphans)
+
+    def flush(self):
+        """Write the pending records; errors are reported but don't
+        stop the thread"""
+        if self.journal is not None:
+            return self.flush_journal()
+        try:
+            self.request_tracker.write_pending()
+        except Exception:
+            sys.stderr.write('Error writing vaineye requests:\n')
+            traceback.print_exc(file=sys.stderr)
+
+    def flush_journal(self):
+        """Write what is in the journals (this process's and any left
+        by processes that have died), unless still waiting after a
+        failure"""
+        if time.time() < self.retry_at:
+            return
+        tracker = self.request_tracker
+        own = self.journal
+        for journal in self._adopt_orphans() + [own]:
+            unreadable = False
+            while journal.has_pending():
+                try:
+                    requests, end = journal.read(self.journal_batch_size)
+                except Exception:
+                    self._set_aside(journal)
+                    unreadable = True
+                    break
+                for request in requests:
+                    tracker.add_record(request)
+                try:
+                    tracker.write_pending(atomic=True)
+                except Exception:
+                    # They are still in the journal:
+                    tracker.discard_pending()
+                    self.backoff = min(self.max_backoff,
+                                       self.backoff and self.backoff*2
+                                       or self.flush_interval)
+                    self.retry_at = time.time() + self.backoff
+                    sys.stderr.write(
+                        'Error writing vaineye requests (trying again in '
+                        '%s seconds):\n' % self.backoff)
+                    traceback.print_exc(file=sys.stderr)
+                    return
+                journal.commit(end)
+                if journal is own:
+                    self.journaled -= len(requests)
+            if journal is not own and not unreadable:
+                journal.remove()
+                self._orphans.remove(journal)
+        self.backoff = None
+
+    def _set_aside(self, journal):
+        """Moves a journal that can't be read to ``*.bad`` (where it
+        can be looked at), starting a new one if it is this
+        process's"""
+        from vaineye.journal import Journal
+        sys.stderr.write(
+            'Cannot read the vaineye journal %s; moving it to %s.bad:\n'
+            % (journal.filename, journal.filename))
+        traceback.print_exc(file=sys.stderr)
+        journal.close()
+        os.rename(journal.filename, journal.filename + '.bad')
+        if journal is self.journal:
+            self.journal = Journal(journal.filename)
+            self.journaled = 0
+        else:
+            self._orphans.remove(journal)
+
+    def _adopt_orphans(self):
+        """Takes over the journals of processes that have died,
+        returning all the ones taken over that aren't written yet"""
+        from vaineye.journal import Journal
+        for filename in Journal.find_orphans(self.journal_dir):
+            self._orphan_count += 1
+            claimed = os.path.join(
+                self.journal_dir, 'vaineye-%s-orphan%s.journal'
+                % (os.getpid(), self._orphan_count))
+            try:
+                os.rename(filename, claimed)
+            except OSError:
+                # Another process took it
+                continue
+            try:
+                self._orphans.append(Journal(claimed))
+            except ValueError:
+                sys.stderr.write('Ignoring bad journal file %s\n' % claimed)
+        return list(self._orphans)
+
 def make_status_watcher(app, global_conf, db=None, table_prefix='',
                         serialize_time=120,
                         serialize_requests=100,
+                        max_queue=10000,
+                        queue_overflow='drop',
+                        max_pending=100000,
+                        pending_overflow='drop-oldest',
+                        measure_body=False,
+                        spool_dir=None,
+                        spool_size=4*1024*1024,
+                        sink=None,
+                        sample=None,
+                        normalized=None,
+                        index_profile='default',
+                        partition=None,
+                        journal_dir=None,
+                        rollups=None,
                         _synchronous=False):
     """
     Adds a status tracker.  You must give it a database description
-    and a data_dir (where it will store file-based data)
+    (or a spool_dir or sink, see `StatusWatcher`)
     """
-    if not db:
-        raise ValueError('You must give a value for db')
+    if not db and not spool_dir and not sink:
+        raise ValueError('You must give a value for db, spool_dir or sink')
     from paste.deploy.converters import asbool
+    if normalized is not None:
+        normalized = asbool(normalized)
+    if rollups is not None:
+        rollups = asbool(rollups)
     return StatusWatcher(
         app, db=db, table_prefix=table_prefix,
         serialize_time=int(serialize_time),
         serialize_requests=int(serialize_requests),
+        max_queue=int(max_queue),
+        queue_overflow=queue_overflow,
+        max_pending=int(max_pending),
+        pending_overflow=pending_overflow,
+        measure_body=asbool(measure_body),
+        spool_dir=spool_dir,
+        spool_size=int(spool_size),
+        sink=sink,
+        sample=sample,
+        normalized=normalized,
+        index_profile=index_profile,
+        partition=partition or None,
+        journal_dir=journal_dir,
+        rollups=rollups,
         _synchronous=asbool(_synchronous))
@@ -16,10 +16,11 @@ from paste.urlparser import StaticURLParser
 from dateutil.parser import parse as parse_date
 from topp.utils.pretty_date import prettyDate as pretty_date
 from pygooglechart import MapChart
-from sqlalchemy import and_
+from sqlalchemy import and_, or_
 from webob import Request, Response
 from webob import exc
 from vaineye.model import RequestTracker
+from vaineye.aggregates import key_columns, hour_start, next_hour, next_day
 from vaineye.ziptostate import unabbreviate_state
 from vaineye.bag import Bag
 from vaineye.helpers import wsgi_wrap, wsgi_unwrap, fnum
@@ -158,7 +159,7 @@ class Summary(object):
         if self.all_content:
             self.id += '_all-content'
             self.description += ' including images, etc'
-        path = req.GET.get('path')
+        path = self.path = req.GET.get('path') or None
         if path:
             self.path_regex = re.compile(fnmatch.translate(path))
             self.id += '_path-%s' % urllib.quote(path, '')
@@ -186,10 +187,12 @@ class Summary(object):
         ''' % dict(base=base, description=cls.description, name=cls.name)
         return form
 
-    def merge_request(self, request, data):
+    def merge_request(self, request, data, weight=1):
         """Abstract method; merge one request into the data
 
-        Subclasses should add the request to the data"""
+        Subclasses should add the request to the data, counting it
+        `weight` times (more than once when the request was sampled,
+        see `vaineye.sampling`)"""
         raise NotImplementedError
 
     def blank_data(self):
@@ -207,13 +210,16 @@ class Summary(object):
             and request['content_type']
             and request['content_type'].split(';')[0] not in self.content_types):
             return True
-        if (self.start_date
-            and request['date'] < self.start_date):
+        # Counts from the database (see `group_by`) have no date or
+        # response code, as the query already limits those:
+        date = request.get('date')
+        if (self.start_date and date is not None
+            and date < self.start_date):
             return True
-        if (self.end_date
-            and request['date'] > self.end_date):
+        if (self.end_date and date is not None
+            and date > self.end_date):
             return True
-        if self.only_200 and request['response_code'] >= 300:
+        if self.only_200 and request.get('response_code', 200) >= 300:
             return True
         if self.path_regex and not self.path_regex.match(request['path']):
             return True
@@ -279,21 +285,87 @@ class Summary(object):
             end = self.end_date
         if self.start_date and self.start_date > start:
             start = self.start_date
+        ranges = [(start, end)]
+        since = None
+        if self.aggregate:
+            since = rt.rollups_since()
+        if since is not None:
+            # The whole hours from when the rollups are complete can
+            # be read from them:
+            rollup_start = max(next_hour(start), since)
+            compacted_until = rt.compacted_until()
+            if (compacted_until is not None
+                and rollup_start < compacted_until):
+                # Compacted days are only counted by the day, so the
+                # day the rollups start in is read from those counts
+                rollup_start = next_day(rollup_start)
+            rollup_end = hour_start(end)
+            if rollup_start < rollup_end:
+                for request in rt.rollup_requests(
+                    self.aggregate, rollup_start, rollup_end):
+                    if self.filter_request(request, data):
+                        continue
+                    self.merge_request(request, data,
+                                       request['sample_weight'])
+                ranges = [(start, rollup_start), (rollup_end, end)]
+        for range_start, range_end in ranges:
+            if range_start < range_end:
+                self.merge_requests(data, range_start, range_end, callback)
+        if callback:
+            callback()
+        data.time_updated = new_date
+        self.save_data(data)
+        return data
+
+    def merge_requests(self, data, start, end, callback):
+        """Merges the requests from `start` up to `end` into `data`,
+        from the requests table and the compacted aggregates"""
+        rt = self.controller.request_tracker
+        compacted_until = rt.compacted_until()
+        if (self.aggregate and compacted_until is not None
+            and start < compacted_until):
+            # Older requests may only be counted in the aggregates.
+            # These are by day, so the day `start` is in is only
+            # counted if `start` is at its beginning:
+            for request in rt.aggregated_requests(
+                self.aggregate, start, min(end, compacted_until)):
+                if self.filter_request(request, data):
+                    continue
+                self.merge_request(request, data, request['sample_weight'])
         query = and_(rt.table.c.date >= start,
                      rt.table.c.date < end)
         if self.only_200:
             query = and_(query, rt.table.c.response_code < 300)
+        query, exact = self.filter_query(query, rt)
         query = self.ammend_query(query, rt)
-        for index, request in enumerate(rt.requests(query, callback)):
-            if self.filter_request(request, data):
+        if self.group_by:
+            requests = rt.grouped_requests(query, self.group_by, callback)
+        else:
+            requests = rt.requests(query, callback, self.columns)
+        for index, request in enumerate(requests):
+            if not exact and self.filter_request(request, data):
                 #print 'filtered', request
                 continue
-            self.merge_request(request, data)
-        if callback:
-            callback()
-        data.time_updated = new_date
-        self.save_data(data)
-        return data
+            self.merge_request(request, data, request['sample_weight'] or 1)
+
+    def filter_query(self, query, rt):
+        """Adds the filters of `filter_request` to the SQLAlchemy
+        `query`, so the database leaves out the requests they would
+        filter
+
+        Returns ``(query, exact)``; if `exact` is false the query
+        lets through more than it should, and the requests still have
+        to go through `filter_request`.
+        """
+        exact = True
+        if not self.all_content:
+            query = and_(query, content_type_clause(
+                rt.table.c.content_type, self.content_types))
+        if self.path:
+            clause, exact = glob_clause(
+                rt.table.c.path, self.path, rt.engine.dialect.name)
+            query = and_(query, clause)
+        return query, exact
 
     def ammend_query(self, query, rt):
         """Ammends the SQLAlchemy query to add any parameters that are
@@ -301,6 +373,19 @@ class Summary(object):
         summary uses."""
         return query
 
+    # The kind of `vaineye.aggregates` counts that this summary can
+    # use for requests that have been compacted (None if it can't):
+    aggregate = None
+
+    # The columns `merge_request` and `filter_request` use (None for
+    # all of them); when the summary looks at each request (without
+    # `group_by`) only these are read from the database:
+    columns = None
+
+    # The columns to count the requests by in the database instead of
+    # returning every one (None to look at each request):
+    group_by = None
+
     @property
     def pickle_filename(self):
         """The filename where the cache pickle is kept"""
@@ -359,10 +444,12 @@ class HitsSummary(Summary):
     name = 'hits'
     description = 'Hits'
     only_200 = True
+    aggregate = 'hits'
+    group_by = key_columns['hits']
 
-    def merge_request(self, request, data):
+    def merge_request(self, request, data, weight=1):
         url = request['url']
-        data.requests.add(url)
+        data.requests.add(url, weight)
 
     def blank_data(self):
         data = Data()
@@ -375,6 +462,8 @@ class ReferrerSummary(Summary):
     name = 'referrers'
     description = 'Referrers'
     only_200 = True
+    aggregate = 'referrers'
+    group_by = key_columns['referrers']
 
     def __init__(self, controller, req):
         super(ReferrerSummary, self).__init__(controller, req)
@@ -424,7 +513,7 @@ class ReferrerSummary(Summary):
 
     _no_ip_regex = re.compile(r'[0-9:\.]+$')
 
-    def merge_request(self, request, data):
+    def merge_request(self, request, data, weight=1):
         referrer = request['referrer']
         if not referrer.strip():
             return
@@ -439,7 +528,7 @@ class ReferrerSummary(Summary):
         url_domain = urlparse.urlsplit(url)[1]
         if url_domain and url_domain == ref_domain:
             return
-        data.referrers.add((referrer, url))
+        data.referrers.add((referrer, url), weight)
 
     def blank_data(self):
         data = Data()
@@ -456,18 +545,20 @@ class LocationSummary(Summary):
     name = 'location'
     description = 'Location'
     only_200 = True
+    aggregate = 'locations'
+    group_by = key_columns['locations']
 
-    def merge_request(self, request, data):
+    def merge_request(self, request, data, weight=1):
         country_name = request['ip_country_name']
         country_code = request['ip_country_code']
         if country_name and country_code:
-            data.countries.add((country_name, country_code))
+            data.countries.add((country_name, country_code), weight)
         state = request['ip_state']
         if state:
-            data.states.add(state)
+            data.states.add(state, weight)
         city = request['ip_city']
         if state and city:
-            data.cities.add((state, city))
+            data.cities.add((state, city), weight)
 
     def ammend_query(self, query, rt):
         # Filter out requests without location data:
@@ -500,6 +591,49 @@ class LocationSummary(Summary):
         v['country_map_url'] = country_map.get_url()
         return v
 
+def _escape_like(value):
+    return (value.replace('\\', '\\\\').replace('%', '\\%')
+            .replace('_', '\\_'))
+
+def content_type_clause(column, content_types):
+    """A SQL clause for the requests `Summary.filter_request` keeps
+    with the `content_types`: those with no content type, or with one
+    of the types (with or without parameters like ``; charset=...``)"""
+    types = [content_type for content_type in content_types if content_type]
+    clauses = [column == None, column == '', column.in_(types)]
+    for content_type in types:
+        clauses.append(column.like(_escape_like(content_type) + ';%',
+                                   escape='\\'))
+    return or_(*clauses)
+
+def glob_clause(column, pattern, dialect_name):
+    """A SQL clause for the values of `column` that match the `fnmatch`
+    `pattern`; returns ``(clause, exact)``
+
+    The part of the pattern before the first wildcard becomes a range
+    on SQLite, which can use the index on the column.  SQLite's GLOB
+    is the same as `fnmatch`; elsewhere LIKE is used, which has no
+    ``[...]``, so for those patterns only the prefix is matched and
+    `exact` is false.
+    """
+    prefix = ''
+    for char in pattern:
+        if char in '*?[':
+            break
+        prefix += char
+    if dialect_name == 'sqlite':
+        clauses = []
+        if prefix:
+            clauses.append(column >= prefix)
+            clauses.append(
+                column < prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+        clauses.append(column.op('GLOB')(pattern.replace('[!', '[^')))
+        return and_(*clauses), True
+    if '[' in pattern:
+        return column.like(_escape_like(prefix) + '%', escape='\\'), False
+    like = _escape_like(pattern).replace('*', '%').replace('?', '_')
+    return column.like(like, escape='\\'), True
+
 class Data(object):
     """
     Holds the per-summary data.  This is basically just a dumb
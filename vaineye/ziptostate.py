@@ -2,164 +2,151 @@
 Converts zip codes to state codes.  Also converts state codes to state
 names.
 """
+from bisect import bisect_right
 
 # From data at:
 # http://www.novicksoftware.com/udfofweek/Vol2/T-SQL-UDF-Vol-2-Num-48-udf_Addr_Zip5ToST.htm
+#
+# (first zip, last zip, state); where these overlap the first one
+# listed wins:
+zip_ranges = (
+    (99501, 99950, 'AK'),
+    (35004, 36925, 'AL'),
+    (71601, 72959, 'AR'),
+    (75502, 75502, 'AR'),
+    (85001, 86556, 'AZ'),
+    (90001, 96162, 'CA'),
+    (80001, 81658, 'CO'),
+    ( 6001,  6389, 'CT'),
+    ( 6401,  6928, 'CT'),
+    (20001, 20039, 'DC'),
+    (20042, 20599, 'DC'),
+    (20799, 20799, 'DC'),
+    (19701, 19980, 'DE'),
+    (32004, 34997, 'FL'),
+    (30001, 31999, 'GA'),
+    (39901, 39901, 'GA'),
+    (96701, 96898, 'HI'),
+    (50001, 52809, 'IA'),
+    (68119, 68120, 'IA'),
+    (83201, 83876, 'ID'),
+    (60001, 62999, 'IL'),
+    (46001, 47997, 'IN'),
+    (66002, 67954, 'KS'),
+    (40003, 42788, 'KY'),
+    (70001, 71232, 'LA'),
+    (71234, 71497, 'LA'),
+    ( 1001,  2791, 'MA'),
+    ( 5501,  5544, 'MA'),
+    (20331, 20331, 'MD'),
+    (20335, 20797, 'MD'),
+    (20812, 21930, 'MD'),
+    ( 3901,  4992, 'ME'),
+    (48001, 49971, 'MI'),
+    (55001, 56763, 'MN'),
+    (63001, 65899, 'MO'),
+    (38601, 39776, 'MS'),
+    (71233, 71233, 'MS'),
+    (59001, 59937, 'MT'),
+    (27006, 28909, 'NC'),
+    (58001, 58856, 'ND'),
+    (68001, 68118, 'NE'),
+    (68122, 69367, 'NE'),
+    ( 3031,  3897, 'NH'),
+    ( 7001,  8989, 'NJ'),
+    (87001, 88441, 'NM'),
+    (88901, 89883, 'NV'),
+    ( 6390,  6390, 'NY'),
+    (10001, 14975, 'NY'),
+    (43001, 45999, 'OH'),
+    (73001, 73199, 'OK'),
+    (73401, 74966, 'OK'),
+    (97001, 97920, 'OR'),
+    (15001, 19640, 'PA'),
+    ( 2801,  2940, 'RI'),
+    (29001, 29948, 'SC'),
+    (57001, 57799, 'SD'),
+    (37010, 38589, 'TN'),
+    (73301, 73301, 'TX'),
+    (75001, 75501, 'TX'),
+    (75503, 79999, 'TX'),
+    (88510, 88589, 'TX'),
+    (84001, 84784, 'UT'),
+    (20040, 20041, 'VA'),
+    (20040, 20167, 'VA'),
+    (20042, 20042, 'VA'),
+    (22001, 24658, 'VA'),
+    ( 5001,  5495, 'VT'),
+    ( 5601,  5907, 'VT'),
+    (98001, 99403, 'WA'),
+    (53001, 54990, 'WI'),
+    (24701, 26886, 'WV'),
+    (82001, 83128, 'WY'),
+    )
+
+# Built from zip_ranges the first time they are needed:
+# _zip_starts[i] is the first zip of a run of zips that all belong
+# to _zip_states[i] (None for zips in no range)
+_zip_starts = None
+_zip_states = None
+
+def _build_tables():
+    global _zip_starts, _zip_states
+    points = set()
+    for low, high, state in zip_ranges:
+        points.add(low)
+        points.add(high+1)
+    starts = []
+    states = []
+    for point in sorted(points):
+        for low, high, state in zip_ranges:
+            if low <= point <= high:
+                break
+        else:
+            state = None
+        if states and states[-1] == state:
+            continue
+        starts.append(point)
+        states.append(state)
+    _zip_states = states
+    _zip_starts = starts
+
 def zip_to_state(zip):
     """Convert the zip or postal code to a state code.
 
     This returns None if it can't be converted"""
+    if zip is None:
+        return None
     if isinstance(zip, basestring):
         zip = zip.split('-', 1)[0]
         try:
             zip = int(zip, 10)
         except ValueError:
             return None
-    if zip >= 99501 and zip <= 99950:
-        return 'AK'
-    elif zip >= 35004 and zip <= 36925:
-        return 'AL'
-    elif zip >= 71601 and zip <= 72959:
-        return 'AR'
-    elif zip >= 75502 and zip <= 75502:
-        return 'AR'
-    elif zip >= 85001 and zip <= 86556:
-        return 'AZ'
-    elif zip >= 90001 and zip <= 96162:
-        return 'CA'
-    elif zip >= 80001 and zip <= 81658:
-        return 'CO'
-    elif zip >=  6001 and zip <=  6389:
-        return 'CT'
-    elif zip >=  6401 and zip <=  6928:
-        return 'CT'
-    elif zip >= 20001 and zip <= 20039:
-        return 'DC'
-    elif zip >= 20042 and zip <= 20599:
-        return 'DC'
-    elif zip >= 20799 and zip <= 20799:
-        return 'DC'
-    elif zip >= 19701 and zip <= 19980:
-        return 'DE'
-    elif zip >= 32004 and zip <= 34997:
-        return 'FL'
-    elif zip >= 30001 and zip <= 31999:
-        return 'GA'
-    elif zip >= 39901 and zip <= 39901:
-        return 'GA'
-    elif zip >= 96701 and zip <= 96898:
-        return 'HI'
-    elif zip >= 50001 and zip <= 52809:
-        return 'IA'
-    elif zip >= 68119 and zip <= 68120:
-        return 'IA'
-    elif zip >= 83201 and zip <= 83876:
-        return 'ID'
-    elif zip >= 60001 and zip <= 62999:
-        return 'IL'
-    elif zip >= 46001 and zip <= 47997:
-        return 'IN'
-    elif zip >= 66002 and zip <= 67954:
-        return 'KS'
-    elif zip >= 40003 and zip <= 42788:
-        return 'KY'
-    elif zip >= 70001 and zip <= 71232:
-        return 'LA'
-    elif zip >= 71234 and zip <= 71497:
-        return 'LA'
-    elif zip >=  1001 and zip <=  2791:
-        return 'MA'
-    elif zip >=  5501 and zip <=  5544:
-        return 'MA'
-    elif zip >= 20331 and zip <= 20331:
-        return 'MD'
-    elif zip >= 20335 and zip <= 20797:
-        return 'MD'
-    elif zip >= 20812 and zip <= 21930:
-        return 'MD'
-    elif zip >=  3901 and zip <=  4992:
-        return 'ME'
-    elif zip >= 48001 and zip <= 49971:
-        return 'MI'
-    elif zip >= 55001 and zip <= 56763:
-        return 'MN'
-    elif zip >= 63001 and zip <= 65899:
-        return 'MO'
-    elif zip >= 38601 and zip <= 39776:
-        return 'MS'
-    elif zip >= 71233 and zip <= 71233:
-        return 'MS'
-    elif zip >= 59001 and zip <= 59937:
-        return 'MT'
-    elif zip >= 27006 and zip <= 28909:
-        return 'NC'
-    elif zip >= 58001 and zip <= 58856:
-        return 'ND'
-    elif zip >= 68001 and zip <= 68118:
-        return 'NE'
-    elif zip >= 68122 and zip <= 69367:
-        return 'NE'
-    elif zip >=  3031 and zip <=  3897:
-        return 'NH'
-    elif zip >=  7001 and zip <=  8989:
-        return 'NJ'
-    elif zip >= 87001 and zip <= 88441:
-        return 'NM'
-    elif zip >= 88901 and zip <= 89883:
-        return 'NV'
-    elif zip >=  6390 and zip <=  6390:
-        return 'NY'
-    elif zip >= 10001 and zip <= 14975:
-        return 'NY'
-    elif zip >= 43001 and zip <= 45999:
-        return 'OH'
-    elif zip >= 73001 and zip <= 73199:
-        return 'OK'
-    elif zip >= 73401 and zip <= 74966:
-        return 'OK'
-    elif zip >= 97001 and zip <= 97920:
-        return 'OR'
-    elif zip >= 15001 and zip <= 19640:
-        return 'PA'
-    elif zip >=  2801 and zip <=  2940:
-        return 'RI'
-    elif zip >= 29001 and zip <= 29948:
-        return 'SC'
-    elif zip >= 57001 and zip <= 57799:
-        return 'SD'
-    elif zip >= 37010 and zip <= 38589:
-        return 'TN'
-    elif zip >= 73301 and zip <= 73301:
-        return 'TX'
-    elif zip >= 75001 and zip <= 75501:
-        return 'TX'
-    elif zip >= 75503 and zip <= 79999:
-        return 'TX'
-    elif zip >= 88510 and zip <= 88589:
-        return 'TX'
-    elif zip >= 84001 and zip <= 84784:
-        return 'UT'
-    elif zip >= 20040 and zip <= 20041:
-        return 'VA'
-    elif zip >= 20040 and zip <= 20167:
-        return 'VA'
-    elif zip >= 20042 and zip <= 20042:
-        return 'VA'
-    elif zip >= 22001 and zip <= 24658:
-        return 'VA'
-    elif zip >=  5001 and zip <=  5495:
-        return 'VT'
-    elif zip >=  5601 and zip <=  5907:
-        return 'VT'
-    elif zip >= 98001 and zip <= 99403:
-        return 'WA'
-    elif zip >= 53001 and zip <= 54990:
-        return 'WI'
-    elif zip >= 24701 and zip <= 26886:
-        return 'WV'
-    elif zip >= 82001 and zip <= 83128:
-        return 'WY'
-    return None
+    if _zip_starts is None:
+        _build_tables()
+    index = bisect_right(_zip_starts, zip) - 1
+    if index < 0:
+        return None
+    return _zip_states[index]
+
+def zip_to_state_many(zips):
+    """Converts each of the zip or postal codes in `zips`, returning a
+    list of state codes (or None)
+
+    Each distinct code is only converted once."""
+    seen = {}
+    result = []
+    for zip in zips:
+        try:
+            state = seen[zip]
+        except KeyError:
+            state = seen[zip] = zip_to_state(zip)
+        except TypeError:
+            # Unhashable, oh well
+            state = zip_to_state(zip)
+        result.append(state)
+    return result
 
 def unabbreviate_state(abbrev):
     """Given a state abbreviation, return the full state name"""